@@ -1,27 +1,167 @@
 import datetime
 
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.admin import UserAdmin
+from django.core.exceptions import FieldDoesNotExist
 from django.utils.translation import gettext_lazy as _
 
+from app.campaigns import requeue_sms_campaigns
+from app.jobs import requeue_import_jobs
 from app.models import *
-from car.utils import export_excel
+from car.routers import replica_action
+from car.utils import export_excel, APPROXIMATE_COUNT_THRESHOLD, ApproximateCountPaginator
 
 admin.site.site_header = '24h车服务后台管理系统'
 admin.site.site_title = '24h车服务'
 admin.site.index_title = '24h车服务后台管理系统'
 
 
-class SimpleModelAdmin(admin.ModelAdmin):
+class AppChangeList(ChangeList):
+    """
+    列表只读取 ModelAdmin.get_list_only_fields 返回的字段
+    """
+
+    def get_results(self, request):
+        # 只有显示的列表使用 .only()，批量操作（例如删除）重新调用 get_queryset，读取完整的数据，
+        # 删除信号需要读取的字段不会在数据删除以后再去数据库加载
+        only_fields = self.model_admin.get_list_only_fields(request)
+        if only_fields is not None:
+            self.queryset = self.queryset.only(*only_fields)
+        super().get_results(request)
+
+
+class ListQueryMixin:
+    """
+    后台列表的查询优化
+    list_select_related 根据 list_display 中的外键自动生成，并按关联模型的 str_fields（__str__ 使用的字段）继续关联，
+    例如 ServiceRecord 的 car 会同时关联 car__customer；没有 str_fields 的关联模型读取全部字段，不再继续关联
+    list_only_fields 不为 None 时列表通过 .only() 只读取 list_display 和关联数据 __str__ 需要的字段，
+    自定义的列表方法用到的其他字段需要写在 list_only_fields 中
+    approximate_count 为 True 时列表使用 ApproximateCountPaginator，条数超过 approximate_count_threshold 时使用估计条数
+    date_hierarchy_cache_timeout 不为 None 时缓存日期层级，见 app/templatetags/admin_cache.py
+    """
+    list_only_fields = None
+    str_fields_depth = 3
+    approximate_count = False
+    approximate_count_threshold = APPROXIMATE_COUNT_THRESHOLD
+    date_hierarchy_cache_timeout = None
+
+    def get_list_field_paths(self, model, names, prefix='', depth=0):
+        """
+        获取字段对应的查询路径
+        :param model: 数据模型
+        :param names: 字段名称，不是模型字段的忽略
+        :param prefix: 路径前缀
+        :param depth: 当前的关联层数
+        :return: 返回 (select_related 路径, only 字段路径)
+        """
+        related = list()
+        only = list()
+        opts = getattr(model, '_meta')
+        for name in names:
+            if not isinstance(name, str):
+                continue
+            try:
+                field = opts.get_field(name)
+            except FieldDoesNotExist:
+                continue
+            if field.many_to_many or field.one_to_many or not field.concrete:
+                continue
+            path = prefix + name
+            only.append(path)
+            if not field.is_relation:
+                continue
+            related.append(path)
+            str_fields = getattr(field.related_model, 'str_fields', None)
+            if str_fields is not None and depth + 1 < self.str_fields_depth:
+                r, o = self.get_list_field_paths(field.related_model, str_fields, path + '__', depth + 1)
+                related += r
+                only += o
+        return related, only
+
+    def get_list_select_related(self, request):
+        related, only = self.get_list_field_paths(self.model, self.get_list_display(request))
+        if isinstance(self.list_select_related, (list, tuple)):
+            related += [r for r in self.list_select_related if r not in related]
+        return related or self.list_select_related
+
+    def get_list_only_fields(self, request):
+        """
+        :return: 返回列表需要读取的字段，为 None 时读取全部字段
+        """
+        if self.list_only_fields is None:
+            return None
+        related, only = self.get_list_field_paths(self.model, self.get_list_display(request))
+        fields = only + [f for f in self.list_only_fields if f not in only]
+        if self.date_hierarchy and self.date_hierarchy not in fields:
+            fields.append(self.date_hierarchy)
+        return fields
+
+    def get_changelist(self, request, **kwargs):
+        return AppChangeList
+
+    def get_paginator(self, request, queryset, per_page, orphans=0, allow_empty_first_page=True):
+        if self.approximate_count:
+            return ApproximateCountPaginator(
+                queryset, per_page, orphans, allow_empty_first_page, count_threshold=self.approximate_count_threshold)
+        return super().get_paginator(request, queryset, per_page, orphans, allow_empty_first_page)
+
+
+class DueWithinListFilter(admin.SimpleListFilter):
+    """
+    到期范围筛选：已过期、7 天内、30 天内和 90 天内到期，按日期范围查询，可以使用日期字段的索引
+    """
+    title = _('到期范围')
+    parameter_name = 'due_within'
+    date_field = 'due_date'
+
+    def lookups(self, request, model_admin):
+        return [('expired', _('已过期')), ('7', _('7 天内到期')), ('30', _('30 天内到期')), ('90', _('90 天内到期'))]
+
+    def queryset(self, request, queryset):
+        today = datetime.date.today()
+        if self.value() == 'expired':
+            return queryset.filter(**{'{0}__lt'.format(self.date_field): today})
+        if self.value() in ('7', '30', '90'):
+            return queryset.filter(**{
+                '{0}__gte'.format(self.date_field): today,
+                '{0}__lte'.format(self.date_field): today + datetime.timedelta(days=int(self.value())),
+            })
+        return queryset
+
+
+class InsuranceDueWithinListFilter(DueWithinListFilter):
+    title = _('交强险到期')
+    parameter_name = 'insurance_due_within'
+    date_field = 'insurance_date'
+
+
+class AnnualInspectionDueWithinListFilter(DueWithinListFilter):
+    title = _('年检到期')
+    parameter_name = 'annual_inspection_due_within'
+    date_field = 'annual_inspection_date'
+
+
+class LargeTableMixin:
+    """
+    数据量大的列表：使用估计条数，不统计未筛选的总条数，日期层级缓存 10 分钟
+    """
+    approximate_count = True
+    show_full_result_count = False
+    date_hierarchy_cache_timeout = 600
+
+
+class SimpleModelAdmin(ListQueryMixin, admin.ModelAdmin):
     view_on_site = False
 
 
-class GeneralModelAdmin(admin.ModelAdmin):
+class GeneralModelAdmin(ListQueryMixin, admin.ModelAdmin):
     view_on_site = False
     date_hierarchy = 'datetime_created'
 
 
-class AutoUpdateUserModelAdmin(admin.ModelAdmin):
+class AutoUpdateUserModelAdmin(ListQueryMixin, admin.ModelAdmin):
     view_on_site = False
     readonly_fields = ('created_by', 'confirmed_by')
     date_hierarchy = 'datetime_created'
@@ -87,7 +227,7 @@ class WxUserAdmin(UserAdmin):
 
 
 @admin.register(PayedRecord)
-class PayedRecordAdmin(AutoUpdateUserModelAdmin):
+class PayedRecordAdmin(LargeTableMixin, AutoUpdateUserModelAdmin):
     date_hierarchy = 'payed_date'
     readonly_fields = [
         'credit_change', 'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated',
@@ -99,6 +239,7 @@ class PayedRecordAdmin(AutoUpdateUserModelAdmin):
         'total_price', 'total_payed', 'amount_payed', 'credit_payed', 'cash_payed', 'is_confirmed',
         'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated']
     list_display_links = ['pk', 'related_store', 'customer', 'total_price', 'total_payed', 'amount_payed']
+    list_only_fields = []
     search_fields = ['customer__name', 'customer__mobile', 'notes']
     autocomplete_fields = ['related_store', 'customer']
     list_filter = ['is_confirmed']
@@ -112,8 +253,9 @@ class PayedRecordAdmin(AutoUpdateUserModelAdmin):
             'credit_change', 'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')})
     )
 
+    @replica_action
     def save_execl(self, request, queryset):
-        filename = 'media/{0}_{1}.xls'.format('payed_record', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        filename = '{0}_{1}.xlsx'.format('payed_record', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
         headers = [
             'ID', '姓名', '手机号', '应收金额', '实收金额', '余额抵扣', '积分抵扣',
             '现金支付', '积分变更', '已确认',
@@ -130,7 +272,7 @@ class PayedRecordAdmin(AutoUpdateUserModelAdmin):
 
 
 @admin.register(AmountChangeRecord)
-class AmountChangeRecordAdmin(AutoUpdateUserModelAdmin):
+class AmountChangeRecordAdmin(LargeTableMixin, AutoUpdateUserModelAdmin):
     readonly_fields = [
         'current_amounts', 'related_payed_record',
         'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated']
@@ -138,6 +280,7 @@ class AmountChangeRecordAdmin(AutoUpdateUserModelAdmin):
         'pk', 'customer', 'amounts', 'current_amounts', 'change_type', 'notes',
         'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated']
     list_display_links = ['pk', 'customer', 'amounts', 'current_amounts', 'notes']
+    list_only_fields = []
     search_fields = ['customer__name', 'customer__mobile']
     list_filter = ['change_type']
     autocomplete_fields = ['customer']
@@ -146,8 +289,9 @@ class AmountChangeRecordAdmin(AutoUpdateUserModelAdmin):
         (_('操作记录'), {'fields': ('created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')})
     )
 
+    @replica_action
     def save_execl(self, request, queryset):
-        filename = 'media/{0}_{1}.xls'.format('amounts', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        filename = '{0}_{1}.xlsx'.format('amounts', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
         headers = [
             'ID', '姓名', '手机号', '金额变更', '变更后余额', '变更类型', '创建人员', '最后变更人员', '创建日期', '最后更新时间']
         columns = [
@@ -161,7 +305,7 @@ class AmountChangeRecordAdmin(AutoUpdateUserModelAdmin):
 
 
 @admin.register(CreditChangeRecord)
-class CreditChangeRecordAdmin(AutoUpdateUserModelAdmin):
+class CreditChangeRecordAdmin(LargeTableMixin, AutoUpdateUserModelAdmin):
     readonly_fields = [
         'current_credits', 'related_payed_record',
         'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated']
@@ -169,6 +313,7 @@ class CreditChangeRecordAdmin(AutoUpdateUserModelAdmin):
         'pk', 'customer', 'credits', 'current_credits', 'change_type', 'notes',
         'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated']
     list_display_links = ['pk', 'customer', 'credits', 'current_credits', 'notes']
+    list_only_fields = []
     search_fields = ['customer__name', 'customer__mobile']
     list_filter = ['change_type']
     autocomplete_fields = ['customer']
@@ -178,9 +323,10 @@ class CreditChangeRecordAdmin(AutoUpdateUserModelAdmin):
         (_('操作记录'), {'fields': ('created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')})
     )
 
+    @replica_action
     def save_execl(self, request, queryset):
 
-        filename = 'media/{0}_{1}.xls'.format('credits', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        filename = '{0}_{1}.xlsx'.format('credits', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
         headers = [
             'ID', '姓名', '手机号', '积分变更', '变更后积分', '变更类型', '创建人员', '最后变更人员', '创建日期', '最后更新时间']
         columns = [
@@ -241,7 +387,10 @@ class CarInfoAdmin(AutoUpdateUserModelAdmin):
         'pk', 'car_number', 'insurance_date', 'annual_inspection_date', 'bought_date', 'desc',
         'is_confirmed', 'is_active', 'customer', 'created_by']
     list_display_links = ['pk', 'car_number']
-    list_filter = ['is_active', 'is_confirmed', 'insurance_date', 'annual_inspection_date']
+    list_only_fields = []
+    list_filter = [
+        'is_active', 'is_confirmed', 'insurance_date', 'annual_inspection_date',
+        InsuranceDueWithinListFilter, AnnualInspectionDueWithinListFilter]
     search_fields = ['car_number', 'car_brand', 'car_model', 'customer__name', 'customer__mobile']
     autocomplete_fields = ['customer']
     fieldsets = (
@@ -254,8 +403,9 @@ class CarInfoAdmin(AutoUpdateUserModelAdmin):
         (_('状态'), {'fields': ('is_confirmed', 'is_active')})
     )
 
+    @replica_action
     def save_execl(self, request, queryset):
-        filename = 'media/{0}_{1}.xls'.format('car_info', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        filename = '{0}_{1}.xlsx'.format('car_info', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
         headers = [
             'ID', '车牌', '购买日期', '车辆年检日期', '交强险到期日', '保险公司']
         columns = [
@@ -292,6 +442,7 @@ class InsuranceRecordAdmin(AutoUpdateUserModelAdmin):
         'is_payed', 'notes'
     ]
     list_display_links = ['pk', 'car']
+    list_only_fields = []
     list_filter = ['has_payback', 'belong_to', 'insurance_company', 'record_date']
     # date_hierarchy = 'record_date'
     search_fields = ['car__car_number', 'car__customer__name', 'car__customer__mobile']
@@ -357,11 +508,12 @@ class ServiceFeedbackInline(admin.TabularInline):
 
 
 @admin.register(ServiceItem)
-class ServiceItemAdmin(AutoUpdateUserModelAdmin):
+class ServiceItemAdmin(LargeTableMixin, AutoUpdateUserModelAdmin):
     readonly_fields = ('created_by', 'confirmed_by', 'datetime_created', 'datetime_updated', 'related_service_record')
     list_display = ['pk', 'related_service_record', 'name', 'price', 'cost', 'notes']
     search_fields = ['name']
     list_display_links = ['pk', 'related_service_record', 'name']
+    list_only_fields = []
     fieldsets = (
         (_('基础信息'), {'fields': ('related_service_record', 'name', 'price', 'cost', 'notes')}),
         (_('操作记录'), {'fields': ('created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')}),
@@ -390,6 +542,7 @@ class ServiceRecordAdmin(AutoUpdateUserModelAdmin):
         'checked_by', 'is_checked', 'is_served', 'notes'
     ]
     list_display_links = ['pk', 'car']
+    list_only_fields = []
     list_filter = [
         'is_reversed', 'checked_by', 'is_checked', 'is_served', 'is_payed', 'related_store', 'service_package', 'reserve_time']
     date_hierarchy = None
@@ -416,8 +569,9 @@ class ServiceRecordAdmin(AutoUpdateUserModelAdmin):
 
     inlines = [ServiceItemInline, ServiceFeedbackInline]
 
+    @replica_action
     def save_execl(self, request, queryset):
-        filename = 'media/{0}_{1}.xls'.format('service', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        filename = '{0}_{1}.xlsx'.format('service', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
         headers = [
             'ID', '姓名', '手机号', '车牌号', '进厂时间', '服务地点', '维修门店', '应收金额', '实收金额', '总成本']
         columns = [
@@ -511,23 +665,40 @@ class PartnerApplyAdmin(AutoUpdateUserModelAdmin):
 class InsuranceRecordUploadAdmin(AutoUpdateUserModelAdmin):
     readonly_fields = (
         'total_count', 'created_count', 'updated_count', 'failed_count', 'file_name',
-        'is_processed', 'created_by', 'confirmed_by',  'datetime_created', 'datetime_updated')
+        'is_processed', 'status', 'progress', 'error_message',
+        'created_by', 'confirmed_by',  'datetime_created', 'datetime_updated')
     list_display = [
-        'pk', 'file_name', 'is_confirmed', 'is_processed',
+        'pk', 'file_name', 'is_confirmed', 'is_processed', 'status', 'progress',
         'total_count', 'created_count', 'updated_count', 'failed_count',
         'created_by', 'confirmed_by',
         'datetime_created', 'datetime_updated'
     ]
     list_display_links = ['pk', 'file_name']
-    list_filter = ['is_confirmed', 'is_processed']
+    list_filter = ['is_confirmed', 'is_processed', 'status']
     date_hierarchy = 'datetime_created'
     search_fields = ['file']
     fieldsets = (
         (_('基本信息'), {'fields': ('file', 'is_confirmed', 'notes')}),
-        (_('导入信息'), {'fields': ('total_count', 'created_count', 'updated_count', 'failed_count', )}),
+        (_('导入信息'), {'fields': (
+            'status', 'progress', 'total_count', 'created_count', 'updated_count', 'failed_count', 'error_message')}),
         (_('备注'), {'fields': ('created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')})
     )
 
+    def progress(self, obj):
+        if obj.total_count:
+            return '{0}/{1} ({2:.0%})'.format(obj.processed_count, obj.total_count, obj.processed_count / obj.total_count)
+        return '-'
+
+    progress.short_description = '导入进度'
+
+    def requeue(self, request, queryset):
+        count = requeue_import_jobs(queryset)
+        self.message_user(request, '{0} 个任务已重新加入队列'.format(count))
+
+    requeue.short_description = "重新执行"
+
+    actions = [requeue]
+
 
 @admin.register(ReportMake)
 class ReportMakeAdmin(AutoUpdateUserModelAdmin):
@@ -537,10 +708,70 @@ class ReportMakeAdmin(AutoUpdateUserModelAdmin):
 
 
 @admin.register(MsgSendRecord)
-class MsgSendRecordAdmin(AutoUpdateUserModelAdmin):
+class MsgSendRecordAdmin(LargeTableMixin, AutoUpdateUserModelAdmin):
     readonly_fields = (
-        'mobile', 'code', 'paras', 'msg_type', 'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')
-    list_display = ['pk', 'mobile', 'code', 'paras', 'msg_type', 'notes']
+        'mobile', 'code', 'paras', 'msg_type', 'template_code', 'campaign', 'retry_count', 'datetime_sent',
+        'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')
+    list_display = ['pk', 'mobile', 'code', 'paras', 'msg_type', 'status', 'retry_count', 'datetime_sent', 'notes']
     search_fields = ['mobile', 'code', 'paras']
     list_display_links = ['pk', 'mobile', 'paras']
-    list_filter = ['msg_type']
+    list_filter = ['msg_type', 'status', 'campaign']
+
+
+@admin.register(CarDueEvent)
+class CarDueEventAdmin(SimpleModelAdmin):
+    list_display = ['pk', 'due_date', 'due_type', 'car', 'customer', 'related_superior', 'related_store']
+    list_display_links = ['pk', 'car']
+    list_only_fields = []
+    list_filter = ['due_type', DueWithinListFilter, 'due_date', 'related_store', 'related_superior']
+    search_fields = ['car__car_number', 'customer__name', 'customer__mobile']
+    readonly_fields = [
+        'car', 'due_type', 'due_date', 'customer', 'related_superior', 'related_store', 'datetime_updated']
+
+    def has_add_permission(self, request):
+        # 到期提醒由车辆信息、投保记录和维修服务自动生成
+        return False
+
+
+@admin.register(SmsCampaign)
+class SmsCampaignAdmin(AutoUpdateUserModelAdmin):
+    readonly_fields = (
+        'status', 'progress', 'total_count', 'sent_count', 'failed_count', 'throughput',
+        'datetime_started', 'datetime_finished', 'error_message',
+        'created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')
+    list_display = [
+        'pk', 'name', 'date_type', 'date_start', 'date_end', 'template_code', 'is_confirmed', 'status',
+        'total_count', 'sent_count', 'failed_count', 'throughput', 'datetime_started', 'datetime_finished'
+    ]
+    list_display_links = ['pk', 'name']
+    list_filter = ['date_type', 'is_confirmed', 'status']
+    search_fields = ['name']
+    fieldsets = (
+        (_('基本信息'), {'fields': (
+            'name', 'date_type', 'date_start', 'date_end', 'template_code', 'template_param', 'is_confirmed', 'notes')}),
+        (_('发送信息'), {'fields': (
+            'status', 'progress', 'total_count', 'sent_count', 'failed_count', 'throughput',
+            'datetime_started', 'datetime_finished', 'error_message')}),
+        (_('备注'), {'fields': ('created_by', 'confirmed_by', 'datetime_created', 'datetime_updated')})
+    )
+
+    def progress(self, obj):
+        if obj.total_count:
+            done = obj.sent_count + obj.failed_count
+            return '{0}/{1} ({2:.0%})'.format(done, obj.total_count, done / obj.total_count)
+        return '-'
+
+    progress.short_description = '发送进度'
+
+    def throughput(self, obj):
+        return obj.throughput
+
+    throughput.short_description = '发送速度（条/秒）'
+
+    def requeue(self, request, queryset):
+        count = requeue_sms_campaigns(queryset)
+        self.message_user(request, '{0} 个任务已重新加入队列'.format(count))
+
+    requeue.short_description = "重新执行"
+
+    actions = [requeue]
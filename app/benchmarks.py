@@ -0,0 +1,598 @@
+import datetime
+import io
+import json
+import random
+import re
+import statistics
+import subprocess
+import time
+from decimal import Decimal
+
+import pandas as pd
+
+from django.core.files.base import ContentFile
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, Max
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from car.middlewares import QueryProfile
+from car.sms_aliyun import MsgUrlBuild, SmsSigner, get_common_params
+from car.utils import NormalResultsSetPagination, approximate_count
+
+from .campaigns import SmsCampaignRunner
+from .data_import import InsuranceRecordImporter
+from .models import WxUser, Customer, CarInfo, StoreInfo, Superior, InsuranceCompany, BelongTo, \
+    ServicePackageType, ServicePackage, OilPackage, ServiceRecord, ServiceItem, InsuranceRecord, \
+    InsuranceRecordUpload, AmountChangeRecord, CreditChangeRecord, PayedRecord, MsgSendRecord, SmsCampaign, \
+    CarDueEvent, refresh_service_daily_static, refresh_insurance_daily_static, refresh_car_due_events
+from .services import PaymentService
+
+
+BENCHMARK_ADMIN = 'bench_admin'
+
+
+class BenchmarkDataGenerator:
+    """
+    生成性能测试数据，数据量按 scale 缩放，相同的 seed 生成相同的数据
+    数据通过 bulk_create 直接写入，不触发信号，余额、积分和维修服务金额在生成时计算，结果与信号处理一致
+    """
+    volumes = {
+        'customers': 200000,
+        'users': 20000,
+        'cars': 500000,
+        'amount_records': 1000000,
+        'credit_records': 1000000,
+        'service_records': 250000,
+        'service_items': 1000000,
+        'insurance_records': 200000,
+    }
+
+    def __init__(self, scale=1.0, seed=0, batch_size=5000, stdout=None):
+        """
+        :param scale: 数据量的缩放比例，1 为 volumes 中的数据量
+        :param seed: 随机数种子
+        :param batch_size: 每次批量写入的条数
+        :param stdout: 进度输出
+        """
+        self.scale = scale
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.stdout = stdout
+        self.now = timezone.now()
+
+    def count(self, name):
+        return max(int(self.volumes[name] * self.scale), 1)
+
+    def log(self, msg):
+        if self.stdout:
+            self.stdout.write(msg)
+
+    @staticmethod
+    def next_pk(model):
+        return (model.objects.aggregate(pk_max=Max('pk'))['pk_max'] or 0) + 1
+
+    def bulk_create(self, model, objs):
+        """
+        分批写入，返回写入的条数
+        """
+        count = 0
+        batch = list()
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= self.batch_size:
+                model.objects.bulk_create(batch)
+                count += len(batch)
+                batch = list()
+        if batch:
+            model.objects.bulk_create(batch)
+            count += len(batch)
+        self.log('{0}：{1}'.format(getattr(model, '_meta').verbose_name, count))
+        return count
+
+    def pick_customer(self, customer_ids):
+        """
+        30% 的数据集中在 1% 的客户上，模拟长期客户的大量历史记录
+        """
+        if self.rng.random() < 0.3:
+            return customer_ids[self.rng.randrange(max(len(customer_ids) // 100, 1))]
+        return self.rng.choice(customer_ids)
+
+    def random_datetime(self, days=730):
+        return self.now - datetime.timedelta(seconds=self.rng.randrange(days * 24 * 3600))
+
+    def run(self):
+        """
+        生成全部数据，主键直接指定，写入以后重置数据库的自增序列
+        """
+        started = time.time()
+        rng = self.rng
+        # 基础数据
+        pk = self.next_pk(StoreInfo)
+        stores = [StoreInfo(pk=pk + i, name='bench_store_{0}'.format(pk + i)) for i in range(20)]
+        self.bulk_create(StoreInfo, stores)
+        pk = self.next_pk(Superior)
+        superiors = [Superior(pk=pk + i, name='bench_superior_{0}'.format(pk + i)) for i in range(50)]
+        self.bulk_create(Superior, superiors)
+        pk = self.next_pk(InsuranceCompany)
+        companies = [
+            InsuranceCompany(pk=pk + i, name='bench_ic_{0}'.format(pk + i), display=True, is_active=True)
+            for i in range(10)]
+        self.bulk_create(InsuranceCompany, companies)
+        pk = self.next_pk(BelongTo)
+        belong_tos = [BelongTo(pk=pk + i, name='bench_belong_to_{0}'.format(pk + i)) for i in range(20)]
+        self.bulk_create(BelongTo, belong_tos)
+        pk = self.next_pk(ServicePackageType)
+        package_types = [
+            ServicePackageType(pk=pk + i, name='bench_type_{0}'.format(pk + i)) for i in range(5)]
+        self.bulk_create(ServicePackageType, package_types)
+        pk = self.next_pk(ServicePackage)
+        self.bulk_create(ServicePackage, (
+            ServicePackage(
+                pk=pk + i, name='bench_package_{0}'.format(pk + i), price=Decimal(rng.randrange(100, 2000)),
+                service_type=package_types[i % len(package_types)])
+            for i in range(30)))
+        pk = self.next_pk(OilPackage)
+        self.bulk_create(OilPackage, (
+            OilPackage(pk=pk + i, name='bench_oil_{0}'.format(pk + i), price=Decimal(rng.randrange(200, 800)))
+            for i in range(10)))
+        # 客户和用户
+        pk = self.next_pk(Customer)
+        customer_ids = list(range(pk, pk + self.count('customers')))
+        self.bulk_create(Customer, (
+            Customer(pk=i, name='客户{0}'.format(i), mobile='19{0:09d}'.format(i)) for i in customer_ids))
+        pk = self.next_pk(WxUser)
+        user_customers = rng.sample(customer_ids[:max(len(customer_ids) // 100, 1)], 1) + rng.sample(
+            customer_ids, min(self.count('users'), len(customer_ids)) - 1)
+        self.bulk_create(WxUser, (
+            WxUser(pk=pk + i, username='bench_{0}'.format(pk + i), nick_name='bench_{0}'.format(pk + i),
+                   password='!', mobile='19{0:09d}'.format(c))
+            for i, c in enumerate(user_customers)))
+        self.bulk_create(Customer.related_user.through, (
+            Customer.related_user.through(customer_id=c, wxuser_id=pk + i) for i, c in enumerate(user_customers)))
+        # 车辆
+        pk = self.next_pk(CarInfo)
+        car_ids = list(range(pk, pk + self.count('cars')))
+        car_customers = dict()
+        for i in car_ids:
+            car_customers[i] = self.pick_customer(customer_ids)
+        today = datetime.date.today()
+        self.bulk_create(CarInfo, (
+            CarInfo(pk=i, car_number='测{0:07d}'.format(i), customer_id=car_customers[i],
+                    insurance_date=today + datetime.timedelta(days=rng.randrange(-180, 365)),
+                    annual_inspection_date=today + datetime.timedelta(days=rng.randrange(-180, 730)))
+            for i in car_ids))
+        # 余额和积分变更记录
+        current_amounts = dict()
+        current_credits = dict()
+        total_credits = dict()
+
+        def amount_records():
+            for i in range(self.count('amount_records')):
+                c = self.pick_customer(customer_ids)
+                amounts = Decimal(rng.randrange(-5000, 20000)) / 100
+                current_amounts[c] = current_amounts.get(c, Decimal('0')) + amounts
+                yield AmountChangeRecord(
+                    customer_id=c, amounts=amounts, current_amounts=current_amounts[c],
+                    change_type=rng.choice([1, 2, 3]), notes='bench')
+
+        def credit_records():
+            for i in range(self.count('credit_records')):
+                c = self.pick_customer(customer_ids)
+                credits = rng.randrange(-50, 200)
+                current_credits[c] = current_credits.get(c, 0) + credits
+                total_credits[c] = total_credits.get(c, 0) + max(credits, 0)
+                yield CreditChangeRecord(
+                    customer_id=c, credits=credits, current_credits=current_credits[c],
+                    change_type=rng.choice([1, 3]), notes='bench')
+
+        self.bulk_create(AmountChangeRecord, amount_records())
+        self.bulk_create(CreditChangeRecord, credit_records())
+        customers = list()
+        for c in set(current_amounts) | set(current_credits):
+            customers.append(Customer(
+                pk=c, current_amounts=current_amounts.get(c, Decimal('0')),
+                current_credits=current_credits.get(c, 0), total_credits=total_credits.get(c, 0)))
+        Customer.objects.bulk_update(
+            customers, ['current_amounts', 'current_credits', 'total_credits'], batch_size=self.batch_size)
+        # 维修服务和维修项目
+        pk = self.next_pk(ServiceRecord)
+        service_record_ids = list(range(pk, pk + self.count('service_records')))
+        items_per_record = self.count('service_items') / len(service_record_ids)
+        service_items = list()
+        record_totals = dict()
+        for r in service_record_ids:
+            for i in range(max(int(rng.expovariate(1 / items_per_record)), 1)):
+                price = Decimal(rng.randrange(1000, 100000)) / 100
+                cost = (price * Decimal(rng.randrange(30, 90)) / 100).quantize(Decimal('0.01'))
+                service_items.append(ServiceItem(
+                    related_service_record_id=r, served_by=rng.choice(superiors), name='项目{0}'.format(i),
+                    item_price=price, item_count=1, price=price, cost=cost))
+                totals = record_totals.setdefault(r, [Decimal('0'), Decimal('0')])
+                totals[0] += price
+                totals[1] += cost
+        self.bulk_create(ServiceRecord, (
+            ServiceRecord(
+                pk=r, record_number='bench{0}'.format(r), car_id=rng.choice(car_ids),
+                related_store=rng.choice(stores), reserve_time=self.random_datetime(),
+                total_price=record_totals.get(r, [0, 0])[0], total_cost=record_totals.get(r, [0, 0])[1],
+                is_served=True)
+            for r in service_record_ids))
+        self.bulk_create(ServiceItem, service_items)
+        # 投保记录
+        self.bulk_create(InsuranceRecord, (
+            InsuranceRecord(
+                car_id=rng.choice(car_ids), record_date=self.random_datetime().date(),
+                total_price=Decimal(rng.randrange(100000, 1000000)) / 100,
+                profits=Decimal(rng.randrange(1000, 100000)) / 100,
+                belong_to=rng.choice(belong_tos), insurance_company=rng.choice(companies), notes='bench')
+            for i in range(self.count('insurance_records'))))
+        # 自增序列和统计数据
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [
+                StoreInfo, Superior, InsuranceCompany, BelongTo, ServicePackageType, ServicePackage,
+                OilPackage, Customer, WxUser, CarInfo, ServiceRecord
+            ]):
+                cursor.execute(sql)
+        refresh_service_daily_static(set(
+            ServiceRecord.objects.filter(pk__gte=service_record_ids[0]).values_list(
+                'reserve_time__date', flat=True).order_by().distinct()))
+        refresh_insurance_daily_static(set(
+            InsuranceRecord.objects.values_list('record_date', flat=True).order_by().distinct()))
+        refresh_car_due_events(car_ids)
+        if not WxUser.objects.filter(username=BENCHMARK_ADMIN).exists():
+            WxUser.objects.create_superuser(BENCHMARK_ADMIN, None, None)
+        self.log('完成，耗时 {0:.1f} 秒'.format(time.time() - started))
+
+
+class BenchmarkRunner:
+    """
+    执行性能测试，每个测试先执行一次统计查询数，再执行 repeat 次统计耗时
+    写数据的测试在事务中执行并回滚，不改变测试数据
+    """
+
+    def __init__(self, repeat=5, import_rows=2000, payment_rows=500, sign_count=1000, stdout=None):
+        """
+        :param repeat: 每个测试的执行次数
+        :param import_rows: 保险业绩导入测试的行数
+        :param payment_rows: 批量收银测试的条数
+        :param sign_count: 短信签名测试的签名次数
+        :param stdout: 进度输出
+        """
+        self.repeat = repeat
+        self.import_rows = import_rows
+        self.payment_rows = payment_rows
+        self.sign_count = sign_count
+        self.stdout = stdout
+        self.user = None
+        self.customer_id = None
+        self.admin = None
+        self.deep_page = 1
+
+    def log(self, msg):
+        if self.stdout:
+            self.stdout.write(msg)
+
+    def setup(self):
+        """
+        选择历史记录最多的客户的用户作为接口测试的用户
+        """
+        top = AmountChangeRecord.objects.filter(
+            customer__related_user__isnull=False
+        ).values('customer_id').annotate(c=Count('pk')).order_by('-c').first()
+        if top:
+            self.customer_id = top['customer_id']
+            self.user = WxUser.objects.filter(customer_related_user=self.customer_id).first()
+            # 翻页测试使用中间的一页
+            self.deep_page = top['c'] // NormalResultsSetPagination.page_size // 2 + 1
+        else:
+            self.user = WxUser.objects.exclude(username=BENCHMARK_ADMIN).first()
+        self.admin = WxUser.objects.filter(username=BENCHMARK_ADMIN).first()
+        if not self.admin:
+            self.admin = WxUser.objects.create_superuser(BENCHMARK_ADMIN, None, None)
+
+    def api_client(self):
+        client = Client()
+        if self.user:
+            client.defaults['HTTP_AUTHORIZATION'] = '{0} {1}'.format(
+                jwt_settings.AUTH_HEADER_TYPES[0], AccessToken.for_user(self.user))
+        return client
+
+    def admin_client(self):
+        client = Client()
+        client.force_login(self.admin)
+        return client
+
+    def get_cases(self):
+        """
+        :return: 返回 [(测试名称, 测试函数)]，测试函数返回 HTTP 状态码或 None
+        """
+        api = self.api_client()
+        admin = self.admin_client()
+
+        def get(client, url):
+            return lambda: client.get(url).status_code
+
+        cases = [
+            ('api.user_info', get(api, reverse('api:user_info'))),
+            ('api.user_info.summary', get(api, reverse('api:user_info') + '?summary=1')),
+            ('api.amount_change_records', get(api, reverse('api:amount_change_records'))),
+            ('api.amount_change_records.deep_page', get(
+                api, '{0}?page={1}'.format(reverse('api:amount_change_records'), self.deep_page))),
+            ('api.amount_change_records.cursor', get(api, reverse('api:amount_change_records') + '?cursor=')),
+            ('api.credit_change_records', get(api, reverse('api:credit_change_records'))),
+            ('api.service_package_types', get(api, reverse('api:service_package_types'))),
+            ('api.service_packages', get(api, reverse('api:service_packages'))),
+            ('api.store_infos', get(api, reverse('api:store_infos'))),
+            ('api.insurance_companies', get(api, reverse('api:insurance_companies'))),
+            ('page.service_records', get(admin, reverse('page:service_records'))),
+            ('page.service_static', get(admin, reverse('page:service_static'))),
+            ('page.insurance_static', get(admin, reverse('page:insurance_static'))),
+            ('page.car_due_events', get(admin, reverse('page:car_due_events'))),
+        ]
+        for model in (Customer, CarInfo, ServiceRecord, ServiceItem, InsuranceRecord,
+                      AmountChangeRecord, CreditChangeRecord, PayedRecord, CarDueEvent):
+            opts = getattr(model, '_meta')
+            cases.append((
+                'admin.{0}'.format(opts.model_name),
+                get(admin, reverse('admin:{0}_{1}_changelist'.format(opts.app_label, opts.model_name)))))
+        cases += [
+            ('signal.amount_change_record', self.rollback(self.amount_change_record)),
+            ('service.record_payments', self.rollback(self.record_payments)),
+            ('import.insurance_record_upload', self.rollback(self.insurance_record_upload)),
+            ('sms.sign', self.sms_sign),
+            ('sms.sign.full', self.sms_sign_full),
+        ]
+        return cases
+
+    @staticmethod
+    def rollback(func):
+        """
+        在事务中执行并回滚
+        """
+        def wrapper():
+            with transaction.atomic():
+                func()
+                transaction.set_rollback(True)
+        return wrapper
+
+    def amount_change_record(self):
+        """
+        修改一条较早的余额变更记录并新增一条记录，测试余额的增量更新
+        """
+        if not self.customer_id:
+            return
+        record = AmountChangeRecord.objects.filter(customer_id=self.customer_id).order_by('pk').first()
+        record.amounts = (record.amounts or 0) + 1
+        record.save()
+        AmountChangeRecord.objects.create(customer_id=self.customer_id, amounts=1, notes='bench')
+
+    def record_payments(self):
+        customer_ids = list(Customer.objects.order_by('pk').values_list('pk', flat=True)[:self.payment_rows])
+        PaymentService().record_payments([
+            PayedRecord(customer_id=c, total_price=100, total_payed=100, amount_payed=10, credit_payed=0)
+            for c in customer_ids])
+
+    def insurance_record_upload(self):
+        rows = list()
+        for i in range(self.import_rows):
+            rows.append({
+                '车牌号': '导{0:07d}'.format(i),
+                '被保险人名称': '导入客户{0}'.format(i % (self.import_rows // 2 or 1)),
+                '手机号': '' if i % 3 else '18{0:09d}'.format(i),
+                '签单日期': '2020-01-{0:02d}'.format(i % 28 + 1),
+                '含税总保费': 1000 + i,
+                '利润': 100,
+                '保险出单公司': 'bench_import_ic',
+                '归属渠道': 'bench_import_{0}'.format(i % 5),
+            })
+        buffer = io.BytesIO()
+        pd.DataFrame(rows).to_excel(buffer, index=False)
+        upload = InsuranceRecordUpload(is_confirmed=False)
+        upload.file.save('bench_import.xlsx', ContentFile(buffer.getvalue()), save=False)
+        try:
+            upload.save()
+            InsuranceRecordImporter(upload).run()
+        finally:
+            upload.file.delete(save=False)
+
+    @staticmethod
+    def sms_params(i):
+        params = get_common_params('SendSms')
+        params['SignName'] = '24h车服务'
+        params['PhoneNumbers'] = '19{0:09d}'.format(i)
+        params['TemplateCode'] = 'SMS_186953342'
+        params['TemplateParam'] = json.dumps({'code': str(i % 10000)})
+        return params
+
+    def sms_sign(self):
+        """
+        使用同一个 SmsSigner 签名 sign_count 次，sign_count 为 1000 时毫秒数即每次签名的微秒数
+        """
+        signer = SmsSigner('bench', {
+            'SignatureMethod': 'HMAC-SHA1', 'AccessKeyId': 'bench', 'SignatureVersion': '1.0',
+            'Version': '2017-05-25', 'RegionId': 'cn-hangzhou'})
+        for i in range(self.sign_count):
+            signer.url_build(self.sms_params(i))
+
+    def sms_sign_full(self):
+        """
+        每次使用完整的参数签名，与 sms.sign 比较
+        """
+        for i in range(self.sign_count):
+            params = self.sms_params(i)
+            params.update({
+                'SignatureMethod': 'HMAC-SHA1', 'AccessKeyId': 'bench', 'SignatureVersion': '1.0',
+                'Version': '2017-05-25', 'RegionId': 'cn-hangzhou'})
+            MsgUrlBuild(params, 'bench').url_build()
+
+    def run(self):
+        """
+        :return: 返回 {测试名称: 结果}
+        """
+        results = dict()
+        with override_settings(ALLOWED_HOSTS=['*'], DEBUG=False):
+            self.setup()
+            for name, func in self.get_cases():
+                profile = QueryProfile()
+                with connection.execute_wrapper(profile):
+                    status = func()
+                durations = list()
+                for i in range(self.repeat):
+                    started = time.perf_counter()
+                    func()
+                    durations.append((time.perf_counter() - started) * 1000)
+                results[name] = {
+                    'status': status,
+                    'queries': profile.query_count,
+                    'median_ms': round(statistics.median(durations), 2),
+                    'min_ms': round(min(durations), 2),
+                    'max_ms': round(max(durations), 2),
+                }
+                self.log('{0}: {1} ms, {2} queries'.format(name, results[name]['median_ms'], results[name]['queries']))
+        return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_report(results):
+    """
+    测试结果，包含提交版本、数据库和数据量，用于不同版本之间的比较
+    """
+    return {
+        'commit': get_git_commit(),
+        'datetime': timezone.now().isoformat(),
+        'database': connection.vendor,
+        'counts': {
+            getattr(model, '_meta').model_name: model.objects.count()
+            for model in (Customer, WxUser, CarInfo, AmountChangeRecord, CreditChangeRecord,
+                          ServiceRecord, ServiceItem, InsuranceRecord, PayedRecord)
+        },
+        'results': results,
+    }
+
+
+def compare_reports(baseline, report, threshold=1.2):
+    """
+    比较两次测试结果
+    :param baseline: 基准结果
+    :param report: 当前结果
+    :param threshold: 耗时或查询数超过基准的倍数视为性能下降
+    :return: 返回 [(测试名称, 基准耗时, 当前耗时, 基准查询数, 当前查询数, 是否下降)]
+    """
+    rows = list()
+    for name, r in report['results'].items():
+        b = baseline.get('results', dict()).get(name)
+        if not b:
+            continue
+        regressed = r['median_ms'] > b['median_ms'] * threshold or r['queries'] > b['queries']
+        rows.append((name, b['median_ms'], r['median_ms'], b['queries'], r['queries'], regressed))
+    return rows
+
+
+def load_report(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def get_index_check_queries():
+    """
+    性能测试和常用功能中按条件查询的语句，条件值取自现有数据，用于检查是否使用了索引
+    :return: 返回 [(名称, 数据查询)]，没有数据的查询不返回
+    """
+    queries = list()
+    msg = MsgSendRecord.objects.filter(msg_type=1).order_by('-pk').first()
+    if msg:
+        queries.append(('msg_send_record.code', MsgSendRecord.objects.filter(
+            mobile=msg.mobile, msg_type=1, code=msg.code).order_by('-pk')[:1]))
+        queries.append(('msg_send_record.latest', MsgSendRecord.objects.filter(
+            mobile=msg.mobile).order_by('-pk')[:1]))
+    sr = ServiceRecord.objects.filter(reserve_time__isnull=False).order_by('-pk').first()
+    if sr:
+        queries.append(('service_record.reserve_time', ServiceRecord.objects.filter(
+            reserve_time__gte=sr.reserve_time - datetime.timedelta(days=1), reserve_time__lte=sr.reserve_time)))
+    ir = InsuranceRecord.objects.filter(record_date__isnull=False).order_by('-pk').first()
+    if ir:
+        queries.append(('insurance_record.record_date', InsuranceRecord.objects.filter(
+            record_date__gte=ir.record_date, record_date__lte=ir.record_date)))
+    pr = PayedRecord.objects.filter(payed_date__isnull=False).order_by('-pk').first()
+    if pr:
+        queries.append(('payed_record.payed_date', PayedRecord.objects.filter(
+            payed_date__gte=pr.payed_date, payed_date__lte=pr.payed_date)))
+    customer = Customer.objects.filter(name__isnull=False).order_by('-pk').first()
+    if customer:
+        queries.append(('customer.name', Customer.objects.filter(name__in=[customer.name])))
+    user = WxUser.objects.filter(mobile__isnull=False).order_by('-pk').first()
+    if user:
+        queries.append(('wxuser.mobile', WxUser.objects.filter(mobile=user.mobile)))
+    for date_type in (1, 2):
+        campaign = SmsCampaign(date_type=date_type)
+        car = CarInfo.objects.filter(**{'{0}__isnull'.format(campaign.date_field): False}).order_by('-pk').first()
+        if car:
+            campaign.date_start = campaign.date_end = getattr(car, campaign.date_field)
+            queries.append(('car_info.{0}'.format(campaign.date_field), SmsCampaignRunner(campaign).get_queryset().order_by(
+                campaign.date_field, 'pk')[:1000]))
+    event = CarDueEvent.objects.filter(related_store__isnull=False).order_by('-pk').first()
+    if event:
+        due_dates = {'due_date__gte': event.due_date, 'due_date__lte': event.due_date + datetime.timedelta(days=30)}
+        queries.append(('car_due_event.due_date', CarDueEvent.objects.filter(**due_dates).order_by('due_date', 'pk')[:20]))
+        queries.append(('car_due_event.related_store', CarDueEvent.objects.filter(
+            related_store_id=event.related_store_id, **due_dates).order_by('due_date', 'pk')[:20]))
+    for model in (AmountChangeRecord, CreditChangeRecord):
+        record = model.objects.order_by('-pk').first()
+        if record:
+            queries.append(('{0}.customer'.format(getattr(model, '_meta').model_name), model.objects.filter(
+                customer_id=record.customer_id).order_by('-pk')[:NormalResultsSetPagination.page_size]))
+    return queries
+
+
+def find_full_scans(plan, vendor):
+    """
+    从查询计划中找出全表扫描的数据表
+    :param plan: QuerySet.explain() 的结果
+    :param vendor: 数据库类型
+    :return: 返回数据表名称列表
+    """
+    if vendor == 'postgresql':
+        return re.findall(r'Seq Scan on (\w+)', plan)
+    if vendor == 'sqlite':
+        return [t for t, index in re.findall(r'\bSCAN (?:TABLE )?(\w+)( USING (?:COVERING )?INDEX)?', plan) if not index]
+    return list()
+
+
+def check_indexes(min_rows=10000):
+    """
+    执行 EXPLAIN，检查常用查询是否对数据量较大的表做了全表扫描
+    :param min_rows: 数据条数少于该值的表不检查，数据库对小表可能直接选择全表扫描
+    :return: 返回 [(名称, 全表扫描的数据表, 查询计划)]
+    """
+    table_rows = dict()
+
+    def get_rows(table):
+        if table not in table_rows:
+            table_rows[table] = None
+            for model in (MsgSendRecord, ServiceRecord, InsuranceRecord, PayedRecord, Customer, WxUser,
+                          AmountChangeRecord, CreditChangeRecord):
+                if getattr(model, '_meta').db_table == table:
+                    queryset = model.objects.all()
+                    count = approximate_count(queryset)
+                    table_rows[table] = count if count is not None else queryset.count()
+        return table_rows[table]
+
+    results = list()
+    for name, queryset in get_index_check_queries():
+        plan = queryset.explain()
+        tables = [t for t in find_full_scans(plan, connection.vendor) if (get_rows(t) or 0) >= min_rows]
+        results.append((name, tables, plan))
+    return results
@@ -0,0 +1,165 @@
+import json
+import logging
+import traceback
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from car.utils import bulk_create
+
+from .models import CarInfo, MsgSendRecord, SmsCampaign
+
+
+logger = logging.getLogger('django')
+
+
+def render_template_param(template_param, context):
+    """
+    生成短信的模板参数
+    :param template_param: JSON 格式的模板参数，值中的 {car_number}、{name}、{date} 替换为车辆的数据
+    :param context: 替换的数据
+    :return: 返回 JSON 字符串
+    """
+    params = json.loads(template_param or '{}')
+    if not isinstance(params, dict):
+        raise ValueError('模板参数必须是 JSON 对象')
+    return json.dumps(
+        {k: str(v).format(**context) for k, v in params.items()}, ensure_ascii=False, sort_keys=True)
+
+
+class SmsCampaignRunner:
+    """
+    按到期日期范围生成到期提醒短信
+    车辆按 (到期日期, ID) 的顺序分块读取，使用到期日期的索引，每一块的短信发送记录和生成进度在同一个事务中保存，
+    不需要把所有车辆读入内存，中断以后从 last_date、last_car_id 继续
+    """
+
+    def __init__(self, campaign, chunk_size=1000):
+        """
+        :param campaign: 到期提醒短信
+        :param chunk_size: 每次生成的条数
+        """
+        self.campaign = campaign
+        self.chunk_size = chunk_size
+
+    def get_queryset(self):
+        """
+        到期日期在范围内、客户有手机号的有效车辆
+        """
+        date_field = self.campaign.date_field
+        return CarInfo.objects.filter(**{
+            '{0}__gte'.format(date_field): self.campaign.date_start,
+            '{0}__lte'.format(date_field): self.campaign.date_end,
+        }).filter(is_active=True, customer__mobile__isnull=False).exclude(customer__mobile='')
+
+    def next_chunk(self):
+        """
+        :return: 返回 last_date、last_car_id 以后的一块车辆数据
+        """
+        campaign = self.campaign
+        date_field = campaign.date_field
+        queryset = self.get_queryset()
+        if campaign.last_date:
+            queryset = queryset.filter(
+                Q(**{'{0}__gt'.format(date_field): campaign.last_date}) |
+                Q(**{date_field: campaign.last_date, 'pk__gt': campaign.last_car_id}))
+        return list(queryset.order_by(date_field, 'pk').values(
+            'pk', 'car_number', 'customer__name', 'customer__mobile', date_field)[:self.chunk_size])
+
+    def run_chunk(self):
+        """
+        生成一块短信发送记录，全部生成以后状态改为发送中
+        :return: 返回本次生成的条数
+        """
+        campaign = self.campaign
+        date_field = campaign.date_field
+        if campaign.status == 1:
+            campaign.status = 2
+            campaign.datetime_started = timezone.now()
+            SmsCampaign.objects.filter(pk=campaign.pk).update(
+                status=2, datetime_started=campaign.datetime_started, error_message=None)
+        cars = self.next_chunk()
+        if not cars:
+            campaign.status = 3
+            SmsCampaign.objects.filter(pk=campaign.pk).update(status=3, datetime_updated=timezone.now())
+            return 0
+        records = list()
+        for car in cars:
+            paras = render_template_param(campaign.template_param, {
+                'car_number': car['car_number'] or '',
+                'name': car['customer__name'] or '',
+                'date': car[date_field].strftime('%Y-%m-%d'),
+            })
+            records.append(MsgSendRecord(
+                mobile=car['customer__mobile'], paras=paras, msg_type=3, template_code=campaign.template_code,
+                status=1, campaign=campaign, created_by_id=campaign.confirmed_by_id))
+        with transaction.atomic():
+            bulk_create(MsgSendRecord, records, self.chunk_size)
+            campaign.last_date = cars[-1][date_field]
+            campaign.last_car_id = cars[-1]['pk']
+            campaign.total_count += len(records)
+            SmsCampaign.objects.filter(pk=campaign.pk).update(
+                last_date=campaign.last_date,
+                last_car_id=campaign.last_car_id,
+                total_count=F('total_count') + len(records),
+                datetime_updated=timezone.now()
+            )
+        return len(records)
+
+
+def run_sms_campaign_chunk(chunk_size=1000):
+    """
+    从队列中领取一个排队中或生成中的到期提醒短信，生成一块短信发送记录
+    每次只生成一块，验证码短信不需要等待全部生成
+    :param chunk_size: 每次生成的条数
+    :return: 返回 (到期提醒短信, 生成的条数)，队列为空时返回 (None, 0)
+    """
+    with transaction.atomic():
+        campaign = SmsCampaign.objects.select_for_update(skip_locked=True).filter(
+            status__in=[1, 2], is_confirmed=True).order_by('pk').first()
+        if not campaign:
+            return None, 0
+        try:
+            with transaction.atomic():
+                return campaign, SmsCampaignRunner(campaign, chunk_size).run_chunk()
+        except Exception:
+            logger.exception('SMS campaign {0} failed'.format(campaign.pk))
+            SmsCampaign.objects.filter(pk=campaign.pk).update(
+                status=5, error_message=traceback.format_exc(), datetime_updated=timezone.now())
+            return campaign, 0
+
+
+def update_campaign_stats(sent, failed):
+    """
+    累加到期提醒短信的发送结果
+    :param sent: {到期提醒短信 ID: 发送成功条数}
+    :param failed: {到期提醒短信 ID: 发送失败条数}
+    """
+    for campaign_id in set(sent) | set(failed):
+        SmsCampaign.objects.filter(pk=campaign_id).update(
+            sent_count=F('sent_count') + sent.get(campaign_id, 0),
+            failed_count=F('failed_count') + failed.get(campaign_id, 0)
+        )
+
+
+def finish_sms_campaigns():
+    """
+    发送中的到期提醒短信没有排队中和发送中的记录时，状态改为已完成
+    :return: 返回完成的个数
+    """
+    finished_count = 0
+    for campaign in SmsCampaign.objects.filter(status=3).only('pk'):
+        if not MsgSendRecord.objects.filter(campaign=campaign, status__in=[1, 2]).exists():
+            finished_count += SmsCampaign.objects.filter(pk=campaign.pk, status=3).update(
+                status=4, datetime_finished=timezone.now())
+    return finished_count
+
+
+def requeue_sms_campaigns(queryset):
+    """
+    将执行失败的到期提醒短信重新加入队列，已生成的短信不会重复生成
+    :param queryset: 到期提醒短信列表
+    :return: 返回加入队列的个数
+    """
+    return queryset.filter(is_confirmed=True, status=5).update(status=2, error_message=None)
@@ -0,0 +1,279 @@
+import pandas as pd
+
+from django.db import transaction
+from django.utils import timezone
+
+from car.utils import str_series, num_series, date_series, decimal_value, defer_on_commit, bulk_create
+
+from .models import Customer, CarInfo, BelongTo, InsuranceCompany, InsuranceRecord, InsuranceRecordUpload, \
+    refresh_insurance_daily_static, refresh_car_due_events
+from .services import PaymentService
+
+
+def get_objects_by_field(model, field, values):
+    """
+    按字段值批量获取数据，一次 IN 查询完成，字段值相同的数据保留 ID 最大的一条
+    :param model: 数据模型
+    :param field: 字段名称
+    :param values: 字段值列表，可以包含 None
+    :return: 返回 {字段值: 数据对象}
+    """
+    values = set(values)
+    queryset = model.objects.filter(**{'{0}__in'.format(field): [v for v in values if v is not None]})
+    if None in values:
+        queryset = queryset | model.objects.filter(**{'{0}__isnull'.format(field): True})
+    objs = dict()
+    for obj in queryset.order_by('pk'):
+        objs[getattr(obj, field)] = obj
+    return objs
+
+
+def get_or_create_objects_by_field(model, field, values, defaults=None):
+    """
+    按字段值批量获取或创建数据，不存在的数据通过 bulk_create 一次创建
+    :param model: 数据模型
+    :param field: 字段名称
+    :param values: 字段值列表，可以包含 None
+    :param defaults: 创建数据时的默认值，格式为 {字段值: {字段: 值}}
+    :return: 返回 {字段值: 数据对象}
+    """
+    if defaults is None:
+        defaults = dict()
+    objs = get_objects_by_field(model, field, values)
+    missing = [v for v in set(values) if v not in objs]
+    if missing:
+        model.objects.bulk_create([model(**{field: v}, **defaults.get(v, {})) for v in missing])
+        objs.update(get_objects_by_field(model, field, missing))
+    return objs
+
+
+class InsuranceRecordImporter:
+    """
+    保险业绩数据批量导入
+    Excel 数据整列格式化以后分块处理，每一块的客户、车辆、归属渠道和保险公司通过少量 IN 查询获取，
+    缺失的数据和新的投保记录通过 bulk_create 批量写入
+    """
+    fields = {
+        'car_number': '车牌号',
+        'name': '被保险人名称',
+        'mobile': '手机号',
+        'record_date': '签单日期',
+        'total_price': '含税总保费',
+        'tax': '车船税',
+        'payback_percent': '已返费率',
+        'payback_amount': '已返金额',
+        'ic_payback_percent': '保险公司返点',
+        'ic_payback_amount': '返费金额',
+        'profits': '利润',
+        'insurance_company__name': '保险出单公司',
+        'belong_to__name': '归属渠道',
+    }
+    str_fields = [
+        'car_number', 'name', 'mobile', 'insurance_company__name', 'belong_to__name'
+    ]
+    num_fields_2 = [
+        'total_price', 'tax', 'payback_amount', 'ic_payback_amount', 'profits'
+    ]
+    num_fields_4 = [
+        'payback_percent', 'ic_payback_percent'
+    ]
+    date_fields = [
+        'record_date'
+    ]
+    # 判断投保记录是否已经导入过的字段
+    record_fields = [
+        'car_id', 'belong_to_id', 'insurance_company_id', 'notes', 'record_date',
+        'total_price', 'tax', 'payback_percent', 'payback_amount', 'ic_payback_percent', 'ic_payback_amount', 'profits'
+    ]
+
+    def __init__(self, upload, chunk_size=1000):
+        """
+        :param upload: 保险业绩数据导入对象
+        :param chunk_size: 每次批量处理的行数
+        """
+        self.upload = upload
+        self.file_name = getattr(upload, 'file').name
+        self.chunk_size = chunk_size
+
+    def read_data(self):
+        """
+        读取 Excel 文件，并对每一列进行格式化
+        :return: 返回格式化以后的 DataFrame，列名为字段名称
+        """
+        df = pd.read_excel(getattr(self.upload, 'file').path, keep_default_na=False)
+        data = pd.DataFrame(index=df.index)
+        for k, v in self.fields.items():
+            if v not in df.columns:
+                data[k] = None
+            elif k in self.str_fields:
+                data[k] = str_series(df[v])
+            elif k in self.num_fields_2:
+                data[k] = num_series(df[v], 2)
+            elif k in self.num_fields_4:
+                data[k] = num_series(df[v], 4)
+            elif k in self.date_fields:
+                data[k] = date_series(df[v])
+            else:
+                data[k] = df[v]
+        return data
+
+    def run(self):
+        """
+        执行导入，导入结果更新到导入对象的 total_count、created_count、updated_count 和 failed_count
+        每一块数据和导入进度在同一个事务中保存，中断以后再次执行会从 processed_count 继续
+        """
+        data = self.read_data()
+        upload = self.upload
+        upload.total_count = len(data)
+        upload.processed_count = upload.processed_count or 0
+        if not upload.processed_count:
+            upload.created_count = 0
+            upload.updated_count = 0
+        self.save_progress()
+        for start in range(upload.processed_count, len(data), self.chunk_size):
+            with transaction.atomic():
+                created_count, updated_count = self.import_chunk(data.iloc[start:start + self.chunk_size])
+                upload.created_count = (upload.created_count or 0) + created_count
+                upload.updated_count = (upload.updated_count or 0) + updated_count
+                upload.processed_count = min(start + self.chunk_size, len(data))
+                self.save_progress()
+        upload.failed_count = upload.total_count - upload.created_count - upload.updated_count
+
+    def save_progress(self):
+        """
+        保存导入进度，同时更新 datetime_updated，作为后台任务的心跳
+        """
+        if self.upload.pk:
+            InsuranceRecordUpload.objects.filter(pk=self.upload.pk).update(
+                total_count=self.upload.total_count,
+                processed_count=self.upload.processed_count,
+                created_count=self.upload.created_count,
+                updated_count=self.upload.updated_count,
+                datetime_updated=timezone.now()
+            )
+
+    def get_customers(self, rows):
+        """
+        获取每一行对应的客户，有手机号的按手机号获取，没有手机号的按名字获取最新的一条，不存在的批量创建
+        :param rows: {行号: 数据}
+        :return: 返回 {行号: 客户}
+        """
+        mobile_defaults = dict()
+        names = set()
+        for r in rows.values():
+            if r['mobile']:
+                mobile_defaults.setdefault(r['mobile'], {'name': r['name']})
+            else:
+                names.add(r['name'])
+        customers_by_name = get_or_create_objects_by_field(Customer, 'name', names)
+        customers_by_mobile = get_or_create_objects_by_field(
+            Customer, 'mobile', mobile_defaults.keys(), defaults=mobile_defaults)
+        customers = dict()
+        for index, r in rows.items():
+            if r['mobile']:
+                customers[index] = customers_by_mobile[r['mobile']]
+            else:
+                customers[index] = customers_by_name[r['name']]
+        return customers
+
+    @staticmethod
+    def get_cars(rows, customers):
+        """
+        获取每一行对应的车辆，并将车辆关联到该行的客户，不存在的批量创建，客户变更的批量更新
+        :param rows: {行号: 数据}
+        :param customers: {行号: 客户}
+        :return: 返回 {车牌: 车辆}
+        """
+        cars = get_objects_by_field(CarInfo, 'car_number', [r['car_number'] for r in rows.values()])
+        created_cars = dict()
+        updated_cars = dict()
+        now = timezone.now()
+        for index, r in rows.items():
+            customer = customers[index]
+            car = cars.get(r['car_number'])
+            if car is None:
+                car = CarInfo(car_number=r['car_number'])
+                cars[r['car_number']] = car
+                created_cars[r['car_number']] = car
+            elif car.pk and car.customer_id != customer.pk:
+                car.datetime_updated = now
+                updated_cars[r['car_number']] = car
+            car.customer = customer
+        if created_cars:
+            CarInfo.objects.bulk_create(created_cars.values())
+            cars.update(get_objects_by_field(CarInfo, 'car_number', created_cars.keys()))
+        if updated_cars:
+            CarInfo.objects.bulk_update(updated_cars.values(), ['customer', 'datetime_updated'])
+        return cars
+
+    def import_chunk(self, chunk):
+        """
+        导入一块数据
+        :param chunk: 格式化以后的 DataFrame 片段
+        :return: 返回 (添加条数, 更新条数)
+        """
+        rows = chunk.to_dict('index')
+        created_count = 0
+        updated_count = 0
+        with transaction.atomic():
+            # 客户信息获取
+            customers = self.get_customers(rows)
+            # 车辆信息获取
+            cars = self.get_cars(rows, customers)
+            # bulk_create 和 bulk_update 不会触发信号，车辆的到期提醒在事务提交以后统一更新
+            defer_on_commit(refresh_car_due_events, set(car.pk for car in cars.values()))
+            # 归属渠道
+            belong_tos = get_or_create_objects_by_field(
+                BelongTo, 'name', [r['belong_to__name'] for r in rows.values()])
+            # 保险出单公司
+            company_names = set(r['insurance_company__name'] for r in rows.values() if r['insurance_company__name'])
+            insurance_companies = get_or_create_objects_by_field(
+                InsuranceCompany, 'name', company_names,
+                defaults={n: {'desc': n, 'display': False, 'is_active': True} for n in company_names})
+            # 已经导入过的投保记录
+            notes = {index: '自动导入数据-{0}-{1}'.format(self.file_name, index) for index in rows}
+            existing_records = InsuranceRecord.objects.filter(
+                notes__in=notes.values(), has_payback=True, is_payed=True
+            ).values('pk', *self.record_fields)
+            existing_pks = set()
+            existing_keys = set()
+            for er in existing_records:
+                existing_pks.add(er['pk'])
+                existing_keys.add(tuple(er[f] for f in self.record_fields))
+            records = list()
+            for index, r in rows.items():
+                data = {
+                    'car': cars[r['car_number']],
+                    'belong_to': belong_tos[r['belong_to__name']],
+                    'insurance_company': insurance_companies.get(r['insurance_company__name']),
+                    'notes': notes[index],
+                    'record_date': r['record_date'],
+                }
+                for k in self.num_fields_2:
+                    data[k] = decimal_value(r[k], 2) if r[k] is not None else None
+                for k in self.num_fields_4:
+                    data[k] = decimal_value(r[k], 4) if r[k] is not None else None
+                key = tuple(
+                    getattr(data[f[:-3]], 'pk', None) if f.endswith('_id') else data[f] for f in self.record_fields)
+                if key in existing_keys:
+                    updated_count += 1
+                else:
+                    records.append(InsuranceRecord(has_payback=True, is_payed=True, **data))
+            if records:
+                bulk_create(InsuranceRecord, records, self.chunk_size)
+                created_count = len(records)
+                self.post_create_records(
+                    InsuranceRecord.objects.filter(
+                        notes__in=[ir.notes for ir in records]
+                    ).exclude(pk__in=existing_pks).select_related('car__customer', 'related_partner__related_customer'))
+        return created_count, updated_count
+
+    @staticmethod
+    def post_create_records(records):
+        """
+        bulk_create 不会触发信号，新的投保记录的收款记录、合伙人收益等关联数据通过 PaymentService 批量创建
+        :param records: 新创建的投保记录
+        """
+        records = list(records)
+        PaymentService().record_insurance_payments(records)
+        defer_on_commit(refresh_insurance_daily_static, set(ir.record_date for ir in records))
@@ -0,0 +1,218 @@
+import json
+import logging
+import traceback
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from car.sms_aliyun import SEND_BATCH_SMS_MAX_SIZE, SEND_SMS_MAX_SIZE, SmsResultUnknown, get_sms_client
+
+from .campaigns import update_campaign_stats
+from .models import InsuranceRecordUpload, MsgSendRecord
+
+
+logger = logging.getLogger('django')
+
+
+def claim_import_job(stale_seconds=600):
+    """
+    从导入队列中领取一个任务，排队中的任务，以及超过 stale_seconds 没有更新进度的执行中任务（进程中断）都可以被领取
+    :param stale_seconds: 执行中任务的超时时间，单位秒
+    :return: 返回领取的导入任务，队列为空时返回 None
+    """
+    stale_time = timezone.now() - timedelta(seconds=stale_seconds)
+    with transaction.atomic():
+        upload = InsuranceRecordUpload.objects.select_for_update(skip_locked=True).filter(
+            Q(status=1) | Q(status=2, datetime_updated__lt=stale_time),
+            is_confirmed=True,
+            is_processed=False
+        ).order_by('pk').first()
+        if upload:
+            upload.status = 2
+            InsuranceRecordUpload.objects.filter(pk=upload.pk).update(status=2, datetime_updated=timezone.now())
+    return upload
+
+
+def run_import_job(upload):
+    """
+    执行导入任务，并记录执行结果
+    :param upload: 保险业绩数据导入对象
+    :return: 执行成功返回 True
+    """
+    logger.info('Import job {0} started: {1}'.format(upload.pk, upload.file_name))
+    try:
+        upload.import_insurance_data_from_excel()
+    except Exception:
+        logger.exception('Import job {0} failed'.format(upload.pk))
+        InsuranceRecordUpload.objects.filter(pk=upload.pk).update(
+            status=4, error_message=traceback.format_exc(), datetime_updated=timezone.now())
+        return False
+    InsuranceRecordUpload.objects.filter(pk=upload.pk).update(
+        status=3,
+        is_processed=True,
+        failed_count=upload.failed_count,
+        error_message=None,
+        datetime_updated=timezone.now()
+    )
+    logger.info('Import job {0} finished: {1}/{2}'.format(upload.pk, upload.processed_count, upload.total_count))
+    return True
+
+
+def requeue_import_jobs(queryset):
+    """
+    将未完成的导入任务重新加入队列，已导入的数据块不会重复执行
+    :param queryset: 保险业绩数据导入列表
+    :return: 返回加入队列的任务数
+    """
+    return queryset.filter(
+        is_confirmed=True, is_processed=False
+    ).exclude(status=2).update(status=1, error_message=None)
+
+
+def claim_sms_records(batch_size=100, stale_seconds=300):
+    """
+    从短信队列中领取一批排队中且到了发送时间的记录；
+    超过 stale_seconds 没有更新的发送中记录（进程中断）可能已经发出，SendSms 不是幂等的，改为结果未知，不重新发送
+    :param batch_size: 每次领取的条数
+    :param stale_seconds: 发送中记录的超时时间，单位秒
+    :return: 返回领取的短信发送记录列表
+    """
+    now = timezone.now()
+    stale_time = now - timedelta(seconds=stale_seconds)
+    queue = MsgSendRecord.objects.select_for_update(skip_locked=True).filter(
+        Q(status=1, next_retry_time__isnull=True) | Q(status=1, next_retry_time__lte=now)
+    ).order_by('pk')
+    with transaction.atomic():
+        stale = list(MsgSendRecord.objects.select_for_update(skip_locked=True).filter(
+            status=2, datetime_updated__lt=stale_time).values_list('pk', 'campaign_id'))
+        if stale:
+            MsgSendRecord.objects.filter(pk__in=[pk for pk, campaign_id in stale]).update(
+                status=5, notes='发送中断，结果未知', datetime_updated=now)
+            # 与请求结果未知的记录一样计入到期提醒短信的失败条数
+            update_campaign_stats(Counter(), Counter(campaign_id for pk, campaign_id in stale if campaign_id))
+            logger.warning('SMS records {0} interrupted while sending, result unknown'.format(
+                [pk for pk, campaign_id in stale]))
+        # 验证码等单条短信优先，到期提醒短信在剩余的条数内领取
+        records = list(queue.filter(campaign__isnull=True)[:batch_size])
+        if len(records) < batch_size:
+            records += list(queue.filter(campaign__isnull=False)[:batch_size - len(records)])
+        if records:
+            MsgSendRecord.objects.filter(pk__in=[r.pk for r in records]).update(status=2, datetime_updated=now)
+            for r in records:
+                r.status = 2
+    return records
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def sms_request_groups(records):
+    """
+    将短信记录合并为尽量少的接口请求：模板和参数相同的记录通过 SendSms 一次发送（最多 1000 个号码），
+    其余的按模板通过 SendBatchSms 发送（最多 100 个号码）
+    :param records: 短信发送记录列表
+    :return: 返回 [(接口名称, 模板, 记录列表)]
+    """
+    same_params = OrderedDict()
+    for r in records:
+        same_params.setdefault((r.template_code, r.paras), []).append(r)
+    batch = OrderedDict()
+    groups = list()
+    for (template_code, paras), items in same_params.items():
+        if len(items) > 1:
+            for chunk in chunks(items, SEND_SMS_MAX_SIZE):
+                groups.append(('SendSms', template_code, chunk))
+        else:
+            batch.setdefault(template_code, []).extend(items)
+    for template_code, items in batch.items():
+        for chunk in chunks(items, SEND_BATCH_SMS_MAX_SIZE):
+            if len(chunk) == 1:
+                groups.append(('SendSms', template_code, chunk))
+            else:
+                groups.append(('SendBatchSms', template_code, chunk))
+    return groups
+
+
+def send_sms_group(client, action, template_code, items):
+    """
+    发送一组短信，在线程池中执行，不访问数据库
+    :return: 返回 (是否发送成功, 接口返回结果或错误信息)，请求发出以后读取超时等不知道是否发送成功时返回 (None, 错误信息)
+    """
+    mobiles = [r.mobile for r in items]
+    try:
+        if action == 'SendSms':
+            result = client.send_sms(mobiles, template_code, items[0].paras)
+        else:
+            result = client.send_batch_sms(mobiles, template_code, [r.paras for r in items])
+    except SmsResultUnknown as e:
+        logger.warning('SMS {0} result unknown: {1}'.format(action, e))
+        return None, repr(e)
+    except (requests.RequestException, ValueError) as e:
+        logger.warning('SMS {0} failed: {1}'.format(action, e))
+        return False, repr(e)
+    return result.get('Code') == 'OK', json.dumps(result, ensure_ascii=False)
+
+
+def send_sms_records(records, client=None, concurrency=None):
+    """
+    发送领取的短信记录，并保存发送结果，合并以后的请求通过线程池并发发送，请求次数由客户端限流
+    发送失败的记录在 SMS_MAX_RETRIES 次以内按 SMS_RETRY_SECONDS * 2 ^ 重试次数 秒以后重新发送，超过次数的记录为发送失败；
+    读取超时或连接中断的请求可能已经发送成功，SendSms 不是幂等的，记录为结果未知，不再重新发送
+    :param records: 短信发送记录列表
+    :param client: 短信客户端，默认为进程内共享的客户端
+    :param concurrency: 并发请求数，默认为 SMS_CONCURRENCY 或 4
+    :return: 返回 (发送成功条数, 发送失败条数)
+    """
+    client = client or get_sms_client()
+    concurrency = concurrency or getattr(settings, 'SMS_CONCURRENCY', 4)
+    max_retries = getattr(settings, 'SMS_MAX_RETRIES', 3)
+    retry_seconds = getattr(settings, 'SMS_RETRY_SECONDS', 30)
+    campaign_sent = Counter()
+    campaign_failed = Counter()
+    sent_count = 0
+    failed_count = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            (items, executor.submit(send_sms_group, client, action, template_code, items))
+            for action, template_code, items in sms_request_groups(records)]
+        for items, future in futures:
+            success, notes = future.result()
+            now = timezone.now()
+            for r in items:
+                r.notes = notes
+                r.datetime_updated = now
+                if success:
+                    r.status = 3
+                    r.datetime_sent = now
+                    sent_count += 1
+                    if r.campaign_id:
+                        campaign_sent[r.campaign_id] += 1
+                    continue
+                if success is None:
+                    # 结果未知的记录计入到期提醒短信的失败条数
+                    r.status = 5
+                    failed_count += 1
+                    if r.campaign_id:
+                        campaign_failed[r.campaign_id] += 1
+                    continue
+                r.retry_count += 1
+                if r.retry_count <= max_retries:
+                    r.status = 1
+                    r.next_retry_time = now + timedelta(seconds=retry_seconds * 2 ** (r.retry_count - 1))
+                else:
+                    r.status = 4
+                    failed_count += 1
+                    if r.campaign_id:
+                        campaign_failed[r.campaign_id] += 1
+            MsgSendRecord.objects.bulk_update(
+                items, ['status', 'notes', 'retry_count', 'next_retry_time', 'datetime_sent', 'datetime_updated'])
+    update_campaign_stats(campaign_sent, campaign_failed)
+    return sent_count, failed_count
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from app.benchmarks import check_indexes
+
+
+class Command(BaseCommand):
+    help = '对常用的按条件查询执行 EXPLAIN，报告对数据量较大的表做全表扫描（缺少索引）的查询'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-rows', type=int, default=10000, help='数据条数少于该值的表不检查')
+        parser.add_argument('--verbose-plan', action='store_true', help='输出全部查询计划')
+
+    def handle(self, *args, **options):
+        missing_count = 0
+        for name, tables, plan in check_indexes(options['min_rows']):
+            if tables:
+                missing_count += 1
+                self.stdout.write('[缺少索引] {0}: {1}'.format(name, ', '.join(tables)))
+            else:
+                self.stdout.write('{0}: OK'.format(name))
+            if tables or options['verbose_plan']:
+                self.stdout.write(plan)
+        self.stdout.write('缺少索引：{0}'.format(missing_count))
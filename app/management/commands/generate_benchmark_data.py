@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from app.benchmarks import BenchmarkDataGenerator
+
+
+class Command(BaseCommand):
+    help = '生成性能测试数据，--scale 1 时约为 20 万客户、50 万车辆、200 万余额和积分变更记录、100 万维修项目'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0, help='数据量的缩放比例')
+        parser.add_argument('--seed', type=int, default=0, help='随机数种子，相同的种子生成相同的数据')
+        parser.add_argument('--batch-size', type=int, default=5000, help='每次批量写入的条数')
+
+    def handle(self, *args, **options):
+        BenchmarkDataGenerator(
+            scale=options['scale'], seed=options['seed'], batch_size=options['batch_size'], stdout=self.stdout
+        ).run()
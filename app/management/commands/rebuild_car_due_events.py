@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from app.models import CarInfo, CarDueEvent, refresh_car_due_events
+
+
+class Command(BaseCommand):
+    help = '重新生成车辆的到期提醒，首次上线或直接修改过数据库以后执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='每次处理的车辆数')
+
+    def handle(self, *args, **options):
+        car_ids = set(CarInfo.objects.values_list('pk', flat=True).order_by())
+        car_ids.update(CarDueEvent.objects.values_list('car_id', flat=True).order_by().distinct())
+        refresh_car_due_events(car_ids, chunk_size=options['chunk_size'])
+        self.stdout.write('车辆：{0}，到期提醒：{1}'.format(len(car_ids), CarDueEvent.objects.count()))
@@ -0,0 +1,80 @@
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Min, Max
+
+from app.models import Customer, rebuild_amount_ledgers, rebuild_credit_ledgers, rebuild_customer_totals
+
+
+DRIFT_FIELDS = [
+    ('amount_records', '余额变更记录'),
+    ('amount_customers', '客户余额'),
+    ('credit_records', '积分变更记录'),
+    ('credit_customers', '客户积分'),
+    ('total_customers', '客户累计消费'),
+]
+
+
+def rebuild_shard(shard):
+    """
+    重建一个客户 ID 区间内的全部客户，按 ID 顺序分批处理
+    :param shard: (起始 ID, 结束 ID, 每批客户数, 只统计差异)
+    :return: 返回 {差异类型: 数量}
+    """
+    pk_start, pk_end, batch_size, dry_run = shard
+    drift = {f: 0 for f, name in DRIFT_FIELDS}
+    drift['customers'] = 0
+    last_pk = pk_start - 1
+    while True:
+        customer_ids = list(Customer.objects.filter(
+            pk__gt=last_pk, pk__lte=pk_end
+        ).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not customer_ids:
+            break
+        last_pk = customer_ids[-1]
+        drift['customers'] += len(customer_ids)
+        record_count, customer_count = rebuild_amount_ledgers(customer_ids, dry_run=dry_run)
+        drift['amount_records'] += record_count
+        drift['amount_customers'] += customer_count
+        record_count, customer_count = rebuild_credit_ledgers(customer_ids, dry_run=dry_run)
+        drift['credit_records'] += record_count
+        drift['credit_customers'] += customer_count
+        drift['total_customers'] += rebuild_customer_totals(customer_ids, dry_run=dry_run)
+    return drift
+
+
+class Command(BaseCommand):
+    help = '批量重新计算全部客户的余额、积分、累计消费以及变更记录的变更后余额和积分，并报告与已保存数据的差异'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='并行的进程数，按客户 ID 区间分片')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批处理的客户数')
+        parser.add_argument('--dry-run', action='store_true', help='只报告差异，不更新数据')
+
+    def handle(self, *args, **options):
+        started = time.time()
+        workers = max(options['workers'], 1)
+        pk_range = Customer.objects.aggregate(pk_min=Min('pk'), pk_max=Max('pk'))
+        if pk_range['pk_min'] is None:
+            self.stdout.write('没有客户数据')
+            return
+        step = (pk_range['pk_max'] - pk_range['pk_min']) // workers + 1
+        shards = list()
+        for i in range(workers):
+            pk_start = pk_range['pk_min'] + step * i
+            shards.append((pk_start, pk_start + step - 1, options['batch_size'], options['dry_run']))
+        if workers == 1:
+            results = [rebuild_shard(shards[0])]
+        else:
+            # 子进程需要使用各自的数据库连接
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                results = pool.map(rebuild_shard, shards)
+        drift = {f: sum(r[f] for r in results) for f in results[0]}
+        self.stdout.write('客户：{0}，耗时 {1:.1f} 秒'.format(drift['customers'], time.time() - started))
+        for f, name in DRIFT_FIELDS:
+            self.stdout.write('{0}差异：{1}'.format(name, drift[f]))
+        if options['dry_run']:
+            self.stdout.write('未更新数据')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from app.models import rebuild_customer_totals
+
+
+class Command(BaseCommand):
+    help = '根据收银记录重新计算全部客户的累计消费、总应付款和总已付款，用于数据核对'
+
+    def add_arguments(self, parser):
+        parser.add_argument('customer_ids', nargs='*', type=int, help='客户 ID，不填写时重新计算全部客户')
+
+    def handle(self, *args, **options):
+        changed_count = rebuild_customer_totals(options['customer_ids'] or None)
+        self.stdout.write('更新客户：{0}'.format(changed_count))
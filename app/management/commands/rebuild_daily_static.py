@@ -0,0 +1,37 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db.models.functions import TruncDate
+
+from app.models import ServiceItem, InsuranceRecord, ServiceDailyStatic, InsuranceDailyStatic, \
+    refresh_service_daily_static, refresh_insurance_daily_static
+
+
+class Command(BaseCommand):
+    help = '重新生成维修日汇总和保险日汇总，首次上线或数据修复以后执行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=100, help='每个事务汇总的天数')
+
+    def refresh(self, title, refresh_func, dates, chunk_size):
+        """
+        按日期顺序分块汇总，每一块在单独的事务中加锁和写入，不会长时间锁住汇总表
+        :param title: 显示的名称
+        :param refresh_func: 汇总函数
+        :param dates: 需要汇总的日期，可以包含 None
+        :param chunk_size: 每一块的天数
+        """
+        dates = sorted(dates, key=lambda d: d or date.min)
+        for start in range(0, len(dates), chunk_size):
+            refresh_func(dates[start:start + chunk_size])
+            self.stdout.write('{0}：{1}/{2} 天'.format(title, min(start + chunk_size, len(dates)), len(dates)))
+
+    def handle(self, *args, **options):
+        service_dates = set(ServiceItem.objects.annotate(
+            date=TruncDate('related_service_record__reserve_time')
+        ).values_list('date', flat=True).order_by().distinct())
+        service_dates.update(ServiceDailyStatic.objects.values_list('date', flat=True).order_by().distinct())
+        self.refresh('维修日汇总', refresh_service_daily_static, service_dates, options['chunk_size'])
+        insurance_dates = set(InsuranceRecord.objects.values_list('record_date', flat=True).order_by().distinct())
+        insurance_dates.update(InsuranceDailyStatic.objects.values_list('date', flat=True).order_by().distinct())
+        self.refresh('保险日汇总', refresh_insurance_daily_static, insurance_dates, options['chunk_size'])
@@ -0,0 +1,32 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from app.benchmarks import BenchmarkRunner, benchmark_report, compare_reports, load_report
+
+
+class Command(BaseCommand):
+    help = '执行接口、统计页面、后台列表、数据导入和余额变更的性能测试，结果可以保存为 JSON 并与其他版本比较'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='每个测试的执行次数')
+        parser.add_argument('--output', help='测试结果保存的 JSON 文件')
+        parser.add_argument('--compare', help='作为基准的测试结果 JSON 文件')
+        parser.add_argument('--threshold', type=float, default=1.2, help='耗时超过基准的倍数视为性能下降')
+
+    def handle(self, *args, **options):
+        report = benchmark_report(BenchmarkRunner(repeat=options['repeat'], stdout=self.stdout).run())
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write('测试结果已保存：{0}'.format(options['output']))
+        if options['compare']:
+            baseline = load_report(options['compare'])
+            self.stdout.write('基准版本：{0}'.format(baseline.get('commit')))
+            regressed_count = 0
+            for name, b_ms, r_ms, b_queries, r_queries, regressed in compare_reports(
+                    baseline, report, options['threshold']):
+                regressed_count += regressed
+                self.stdout.write('{0}{1}: {2} -> {3} ms ({4:.2f}x), {5} -> {6} queries'.format(
+                    '[下降] ' if regressed else '', name, b_ms, r_ms, r_ms / b_ms if b_ms else 0, b_queries, r_queries))
+            self.stdout.write('性能下降：{0}'.format(regressed_count))
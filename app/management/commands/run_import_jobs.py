@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from app.jobs import claim_import_job, run_import_job
+
+
+class Command(BaseCommand):
+    help = '执行保险业绩数据导入队列中的任务，可以通过 uWSGI attach-daemon 与服务一起启动'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='队列为空时退出')
+        parser.add_argument('--sleep', type=int, default=5, help='队列为空时的等待时间，单位秒')
+        parser.add_argument(
+            '--stale-seconds', type=int, default=600, help='执行中的任务超过该时间没有更新进度，视为中断并重新执行')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            upload = claim_import_job(stale_seconds=options['stale_seconds'])
+            if upload:
+                if run_import_job(upload):
+                    self.stdout.write('{0} 导入完成'.format(upload))
+                else:
+                    self.stderr.write('{0} 导入失败'.format(upload))
+                continue
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from app.campaigns import run_sms_campaign_chunk, finish_sms_campaigns
+from app.jobs import claim_sms_records, send_sms_records
+
+
+class Command(BaseCommand):
+    help = '发送短信队列中的短信并生成到期提醒短信，可以通过 uWSGI attach-daemon 与服务一起启动'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='队列为空时退出')
+        parser.add_argument('--sleep', type=float, default=1, help='队列为空时的等待时间，单位秒')
+        parser.add_argument('--batch-size', type=int, default=500, help='每次领取的短信条数')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='到期提醒短信每次生成的条数')
+        parser.add_argument(
+            '--stale-seconds', type=int, default=300, help='发送中的短信超过该时间没有更新，视为中断，改为结果未知')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            campaign, created_count = run_sms_campaign_chunk(chunk_size=options['chunk_size'])
+            if created_count:
+                self.stdout.write('{0} 生成 {1} 条'.format(campaign, created_count))
+            records = claim_sms_records(batch_size=options['batch_size'], stale_seconds=options['stale_seconds'])
+            if records:
+                sent_count, failed_count = send_sms_records(records)
+                self.stdout.write('发送 {0} 条，成功 {1} 条，失败 {2} 条'.format(len(records), sent_count, failed_count))
+            finish_sms_campaigns()
+            if campaign or records:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0034_auto_20200615_0956'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='servicerecord',
+            name='record_number',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='订单号'),
+        ),
+        migrations.AlterField(
+            model_name='servicerecord',
+            name='service_info',
+            field=models.TextField(blank=True, max_length=2000, null=True, verbose_name='服务详情'),
+        ),
+        migrations.AlterField(
+            model_name='servicerecord',
+            name='vehicle_mileage',
+            field=models.IntegerField(help_text='未知可填写为0', null=True, verbose_name='进厂公里数'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:12
+
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+
+
+def mark_processed_uploads(apps, schema_editor):
+    InsuranceRecordUpload = apps.get_model('app', 'InsuranceRecordUpload')
+    InsuranceRecordUpload.objects.filter(is_processed=True).update(
+        status=3, processed_count=Coalesce(F('total_count'), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0035_servicerecord_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='insurancerecordupload',
+            name='error_message',
+            field=models.TextField(blank=True, null=True, verbose_name='错误信息'),
+        ),
+        migrations.AddField(
+            model_name='insurancerecordupload',
+            name='processed_count',
+            field=models.IntegerField(default=0, verbose_name='已处理条数'),
+        ),
+        migrations.AddField(
+            model_name='insurancerecordupload',
+            name='status',
+            field=models.SmallIntegerField(choices=[(0, '未执行'), (1, '排队中'), (2, '执行中'), (3, '已完成'), (4, '执行失败')], default=0, help_text='0-->未执行, 1-->排队中, 2-->执行中, 3-->已完成, 4-->执行失败', verbose_name='执行状态'),
+        ),
+        migrations.RunPython(mark_processed_uploads, migrations.RunPython.noop),
+    ]
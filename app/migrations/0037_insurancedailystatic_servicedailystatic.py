@@ -0,0 +1,48 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0036_auto_20261018_1512'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceDailyStatic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(blank=True, db_index=True, null=True, verbose_name='进厂日期')),
+                ('item_count', models.IntegerField(default=0, verbose_name='项目数')),
+                ('price', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='销售额（元）')),
+                ('cost', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='成本（元）')),
+                ('related_store', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.StoreInfo', verbose_name='维修门店')),
+                ('served_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.Superior', verbose_name='维修人员')),
+            ],
+            options={
+                'verbose_name': '维修日汇总',
+                'verbose_name_plural': '维修日汇总',
+                'ordering': ['-date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='InsuranceDailyStatic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(blank=True, db_index=True, null=True, verbose_name='签单日期')),
+                ('record_count', models.IntegerField(default=0, verbose_name='保单数')),
+                ('total_price', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='含税总保费（元）')),
+                ('profits', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='利润')),
+                ('belong_to', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.BelongTo', verbose_name='归属渠道')),
+                ('insurance_company', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.InsuranceCompany', verbose_name='保险公司')),
+            ],
+            options={
+                'verbose_name': '保险日汇总',
+                'verbose_name_plural': '保险日汇总',
+                'ordering': ['-date'],
+            },
+        ),
+    ]
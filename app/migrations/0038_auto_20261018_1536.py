@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0037_insurancedailystatic_servicedailystatic'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='amountchangerecord',
+            index=models.Index(fields=['customer', '-id'], name='app_amount_customer_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='creditchangerecord',
+            index=models.Index(fields=['customer', '-id'], name='app_credit_customer_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['name'], name='app_customer_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='insurancerecord',
+            index=models.Index(fields=['record_date'], name='app_insurance_record_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='msgsendrecord',
+            index=models.Index(fields=['mobile', '-id'], name='app_msg_mobile_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='msgsendrecord',
+            index=models.Index(condition=models.Q(msg_type=1), fields=['mobile', 'code', '-id'], name='app_msg_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payedrecord',
+            index=models.Index(fields=['payed_date'], name='app_payed_record_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='servicerecord',
+            index=models.Index(fields=['reserve_time'], name='app_service_reserve_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='wxuser',
+            index=models.Index(fields=['mobile'], name='app_wxuser_mobile_idx'),
+        ),
+    ]
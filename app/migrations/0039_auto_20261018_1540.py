@@ -0,0 +1,48 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+def mark_sent_records(apps, schema_editor):
+    MsgSendRecord = apps.get_model('app', 'MsgSendRecord')
+    MsgSendRecord.objects.update(status=3)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0038_auto_20261018_1536'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='msgsendrecord',
+            name='datetime_sent',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='发送时间'),
+        ),
+        migrations.AddField(
+            model_name='msgsendrecord',
+            name='next_retry_time',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='下次发送时间'),
+        ),
+        migrations.AddField(
+            model_name='msgsendrecord',
+            name='retry_count',
+            field=models.IntegerField(default=0, verbose_name='重试次数'),
+        ),
+        migrations.AddField(
+            model_name='msgsendrecord',
+            name='status',
+            field=models.SmallIntegerField(choices=[(0, '未发送'), (1, '排队中'), (2, '发送中'), (3, '已发送'), (4, '发送失败')], default=0, help_text='0-->未发送, 1-->排队中, 2-->发送中, 3-->已发送, 4-->发送失败', verbose_name='发送状态'),
+        ),
+        migrations.AddField(
+            model_name='msgsendrecord',
+            name='template_code',
+            field=models.CharField(blank=True, max_length=50, null=True, verbose_name='短信模板'),
+        ),
+        migrations.AddIndex(
+            model_name='msgsendrecord',
+            index=models.Index(condition=models.Q(status__in=[1, 2]), fields=['status', 'id'], name='app_msg_queue_idx'),
+        ),
+        migrations.RunPython(mark_sent_records, migrations.RunPython.noop),
+    ]
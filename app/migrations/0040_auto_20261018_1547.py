@@ -0,0 +1,73 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:47
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0039_auto_20261018_1540'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SmsCampaign',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, null=True, verbose_name='名称')),
+                ('date_type', models.SmallIntegerField(choices=[(1, '交强险到期'), (2, '年检到期')], default=1, help_text='1-->交强险到期, 2-->年检到期', verbose_name='提醒类型')),
+                ('date_start', models.DateField(null=True, verbose_name='开始日期')),
+                ('date_end', models.DateField(null=True, verbose_name='结束日期')),
+                ('template_code', models.CharField(max_length=50, null=True, verbose_name='短信模板')),
+                ('template_param', models.CharField(blank=True, help_text='JSON 格式，可以使用 {car_number}、{name}、{date}，例如 {"car": "{car_number}", "date": "{date}"}', max_length=500, null=True, verbose_name='模板参数')),
+                ('is_confirmed', models.BooleanField(default=False, verbose_name='已确认')),
+                ('status', models.SmallIntegerField(choices=[(0, '未执行'), (1, '排队中'), (2, '生成中'), (3, '发送中'), (4, '已完成'), (5, '执行失败')], default=0, help_text='0-->未执行, 1-->排队中, 2-->生成中, 3-->发送中, 4-->已完成, 5-->执行失败', verbose_name='执行状态')),
+                ('last_date', models.DateField(blank=True, null=True, verbose_name='已生成的到期日期')),
+                ('last_car_id', models.IntegerField(default=0, verbose_name='已生成的车辆 ID')),
+                ('total_count', models.IntegerField(default=0, verbose_name='总条数')),
+                ('sent_count', models.IntegerField(default=0, verbose_name='发送成功条数')),
+                ('failed_count', models.IntegerField(default=0, verbose_name='发送失败条数')),
+                ('datetime_started', models.DateTimeField(blank=True, null=True, verbose_name='开始时间')),
+                ('datetime_finished', models.DateTimeField(blank=True, null=True, verbose_name='完成时间')),
+                ('error_message', models.TextField(blank=True, null=True, verbose_name='错误信息')),
+                ('notes', models.TextField(blank=True, max_length=1000, null=True, verbose_name='备注')),
+                ('datetime_created', models.DateTimeField(auto_now_add=True, verbose_name='记录时间')),
+                ('datetime_updated', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '到期提醒短信',
+                'verbose_name_plural': '到期提醒短信',
+                'ordering': ['-id'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='msgsendrecord',
+            name='msg_type',
+            field=models.IntegerField(choices=[(1, '验证码'), (2, '支付记录'), (3, '到期提醒')], null=True, verbose_name='短信类型'),
+        ),
+        migrations.AddIndex(
+            model_name='carinfo',
+            index=models.Index(fields=['insurance_date', 'id'], name='app_car_insurance_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='carinfo',
+            index=models.Index(fields=['annual_inspection_date', 'id'], name='app_car_inspection_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='smscampaign',
+            name='confirmed_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sms_campaign_confirmed_by', to=settings.AUTH_USER_MODEL, verbose_name='审核人员'),
+        ),
+        migrations.AddField(
+            model_name='smscampaign',
+            name='created_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sms_campaign_created_by', to=settings.AUTH_USER_MODEL, verbose_name='创建人员'),
+        ),
+        migrations.AddField(
+            model_name='msgsendrecord',
+            name='campaign',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='msg_send_records', to='app.SmsCampaign', verbose_name='到期提醒短信'),
+        ),
+    ]
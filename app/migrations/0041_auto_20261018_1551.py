@@ -0,0 +1,48 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0040_auto_20261018_1547'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CarDueEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('due_type', models.SmallIntegerField(choices=[(1, '交强险到期'), (2, '年检到期')], default=1, help_text='1-->交强险到期, 2-->年检到期', verbose_name='提醒类型')),
+                ('due_date', models.DateField(verbose_name='到期日期')),
+                ('datetime_updated', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('car', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='due_events', to='app.CarInfo', verbose_name='车辆信息')),
+                ('customer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.Customer', verbose_name='客户')),
+                ('related_store', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.StoreInfo', verbose_name='最近服务门店')),
+                ('related_superior', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.Superior', verbose_name='客户归属')),
+            ],
+            options={
+                'verbose_name': '到期提醒',
+                'verbose_name_plural': '到期提醒',
+                'ordering': ['due_date', 'id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='cardueevent',
+            index=models.Index(fields=['due_date', 'due_type'], name='app_due_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cardueevent',
+            index=models.Index(fields=['related_store', 'due_date'], name='app_due_store_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cardueevent',
+            index=models.Index(fields=['related_superior', 'due_date'], name='app_due_superior_date_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cardueevent',
+            unique_together={('car', 'due_type')},
+        ),
+    ]
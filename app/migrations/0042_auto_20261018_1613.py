@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:13
+
+from django.db import migrations
+
+
+def delete_duplicate_statics(apps, schema_editor):
+    # 并发更新可能写入了重复的汇总数据，每组只保留最新的一条
+    for model_name, fields in (('ServiceDailyStatic', ('date', 'related_store_id', 'served_by_id')),
+                               ('InsuranceDailyStatic', ('date', 'belong_to_id', 'insurance_company_id'))):
+        model = apps.get_model('app', model_name)
+        seen = set()
+        duplicates = list()
+        for row in model.objects.order_by('-pk').values_list('pk', *fields).iterator():
+            if row[1:] in seen:
+                duplicates.append(row[0])
+            else:
+                seen.add(row[1:])
+        for start in range(0, len(duplicates), 1000):
+            model.objects.filter(pk__in=duplicates[start:start + 1000]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0041_auto_20261018_1551'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_statics, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='insurancedailystatic',
+            unique_together={('date', 'belong_to', 'insurance_company')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='servicedailystatic',
+            unique_together={('date', 'related_store', 'served_by')},
+        ),
+    ]
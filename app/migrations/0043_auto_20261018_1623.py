@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0042_auto_20261018_1613'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='msgsendrecord',
+            name='status',
+            field=models.SmallIntegerField(choices=[(0, '未发送'), (1, '排队中'), (2, '发送中'), (3, '已发送'), (4, '发送失败'), (5, '结果未知')], default=0, help_text='0-->未发送, 1-->排队中, 2-->发送中, 3-->已发送, 4-->发送失败, 5-->结果未知', verbose_name='发送状态'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0043_auto_20261018_1623'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='msgsendrecord',
+            name='paras',
+            field=models.CharField(blank=True, max_length=1000, null=True, verbose_name='数据'),
+        ),
+    ]
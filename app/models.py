@@ -1,19 +1,23 @@
 import hashlib
 import random
-
-import pandas as pd
+import time
+from decimal import Decimal
 
 from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.db.models.signals import post_save, post_delete, pre_save, pre_delete
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F, Sum, Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce, TruncDate
+from django.db.models.signals import post_save, post_delete, pre_save, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.forms import model_to_dict
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from car.utils import str_value, num_value, date_value
+from car.utils import str_value, decimal_value, defer_on_commit, bulk_create, advisory_lock
 
 
 def get_car_info(obj):
@@ -116,6 +120,11 @@ class WxUser(AbstractUser):
     class Meta(AbstractUser.Meta):
         swappable = 'AUTH_USER_MODEL'
         ordering = ['-id']
+        indexes = [
+            models.Index(fields=['mobile'], name='app_wxuser_mobile_idx'),
+        ]
+
+    str_fields = ['username', 'nick_name', 'mobile']
 
     def __str__(self):
         if self.nick_name:
@@ -157,6 +166,8 @@ class Department(models.Model):
         verbose_name = _('部门')
         verbose_name_plural = _('部门')
 
+    str_fields = ['name']
+
     def __str__(self):
         return "{0}".format(
             self.name,
@@ -210,6 +221,8 @@ class Superior(models.Model):
         verbose_name = _('工作人员')
         verbose_name_plural = _('工作人员')
 
+    str_fields = ['name', 'mobile']
+
     def __str__(self):
         return "{0} {1}".format(
             self.name,
@@ -324,6 +337,11 @@ class Customer(models.Model):
         ordering = ['-id']
         verbose_name = _('客户列表')
         verbose_name_plural = _('客户列表')
+        indexes = [
+            models.Index(fields=['name'], name='app_customer_name_idx'),
+        ]
+
+    str_fields = ['name', 'mobile', 'current_amounts', 'current_credits']
 
     def __str__(self):
         return "{0} {1} (余额:￥{2}; 积分:{3})".format(
@@ -354,6 +372,8 @@ class Partner(models.Model):
         verbose_name = _('城市合伙人')
         verbose_name_plural = _('城市合伙人')
 
+    str_fields = ['name', 'mobile']
+
     def __str__(self):
         return "{0} {1}".format(
             self.name,
@@ -379,6 +399,8 @@ class StoreInfo(models.Model):
         verbose_name = _('门店信息')
         verbose_name_plural = _('门店信息')
 
+    str_fields = ['name']
+
     def __str__(self):
         return "{}".format(
             self.name,
@@ -431,6 +453,13 @@ class CarInfo(models.Model):
         ordering = ['-id']
         verbose_name = _('车辆信息')
         verbose_name_plural = _('车辆信息')
+        indexes = [
+            # 到期提醒按到期日期范围分块查询
+            models.Index(fields=['insurance_date', 'id'], name='app_car_insurance_date_idx'),
+            models.Index(fields=['annual_inspection_date', 'id'], name='app_car_inspection_date_idx'),
+        ]
+
+    str_fields = ['car_number', 'customer']
 
     def __str__(self):
         return "{} {}".format(
@@ -455,6 +484,8 @@ class InsuranceCompany(models.Model):
         verbose_name = _('保险出单公司')
         verbose_name_plural = _('保险出单公司')
 
+    str_fields = ['name']
+
     def __str__(self):
         return "{}".format(
             self.name,
@@ -501,6 +532,8 @@ class BelongTo(models.Model):
         verbose_name = _('归属渠道')
         verbose_name_plural = _('归属渠道')
 
+    str_fields = ['name']
+
     def __str__(self):
         return "{}".format(
             self.name,
@@ -663,10 +696,61 @@ class InsuranceRecord(models.Model):
 
     objects = models.Manager()
 
+    def get_payed_record_defaults(self):
+        """
+        已支付的投保记录对应的收款记录，不管有没有关联客户，都要创建收款记录
+        :return: 返回收款记录的字段值
+        """
+        total_payed = 0
+        total_price = 0
+        customer = None
+        if self.total_price is not None:
+            total_price = float(self.total_price)
+            if self.payback_amount is not None:
+                total_payed = float(self.total_price) - float(self.payback_amount)
+            else:
+                total_payed = float(self.total_price)
+        if self.car:
+            customer = self.car.customer
+        return {
+            'customer': customer,
+            'total_price': total_price,
+            'total_payed': total_payed,
+            'created_by_id': self.created_by_id,
+            'confirmed_by_id': self.confirmed_by_id,
+            'payed_date': self.record_date,
+            'notes': '投保支付'
+        }
+
+    def get_partner_amount_defaults(self, customer):
+        """
+        如果有关联合伙人，合伙人获得投保金额 2% 的收益
+        :param customer: 投保的客户
+        :return: 返回合伙人余额变更记录的字段值，没有收益时返回 None
+        """
+        if not self.related_partner:
+            return None
+        partner_customer = self.related_partner.related_customer
+        if not partner_customer:
+            return None
+        total_price = float(self.total_price) if self.total_price is not None else 0
+        return {
+            'customer': partner_customer,
+            'amounts': total_price * 0.02,
+            'notes': '{0}投保{1:.2f}元收益'.format(
+                customer.name if customer else '某人',
+                total_price)
+        }
+
     class Meta:
         ordering = ['-id']
         verbose_name = _('投保记录')
         verbose_name_plural = _('投保记录')
+        indexes = [
+            models.Index(fields=['record_date'], name='app_insurance_record_date_idx'),
+        ]
+
+    str_fields = ['record_date', 'car']
 
     def __str__(self):
         return "{} {}".format(
@@ -689,7 +773,10 @@ class ServicePackageType(models.Model):
     @property
     def service_packages(self):
         res = list()
-        sps = ServicePackage.objects.filter(service_type_id=self.pk).order_by('name')
+        # 列表查询时通过 Prefetch(to_attr='prefetched_service_packages') 一次获取全部套餐
+        sps = getattr(self, 'prefetched_service_packages', None)
+        if sps is None:
+            sps = ServicePackage.objects.filter(service_type_id=self.pk).order_by('name')
         for sp in sps:
             res.append(model_to_dict(sp))
         return res
@@ -728,6 +815,8 @@ class ServicePackage(models.Model):
         verbose_name = _('服务套餐')
         verbose_name_plural = _('服务套餐')
 
+    str_fields = ['name', 'price']
+
     def __str__(self):
         return "{} (￥{})".format(
             self.name,
@@ -751,6 +840,8 @@ class OilPackage(models.Model):
         verbose_name = _('机油套餐')
         verbose_name_plural = _('机油套餐')
 
+    str_fields = ['name', 'price']
+
     def __str__(self):
         return "{} （￥ {}）".format(
             self.name,
@@ -843,6 +934,41 @@ class ServiceRecord(models.Model):
 
     objects = models.Manager()
 
+    def get_payed_record_defaults(self):
+        """
+        已支付的维修服务对应的收款记录，不管有没有客户，都要创建收款记录
+        :return: 返回收款记录的字段值
+        """
+        return {
+            'customer': self.car.customer if self.car else None,
+            'related_store_id': self.related_store_id,
+            'total_price': self.total_price,
+            'total_payed': self.total_payed,
+            'created_by_id': self.created_by_id,
+            'confirmed_by_id': self.confirmed_by_id,
+            'payed_date': self.datetime_updated,
+            'notes': '服务支付'
+        }
+
+    def get_partner_amount_defaults(self, customer):
+        """
+        如果有关联合伙人，合伙人收益为实收金额的 5%
+        :param customer: 消费的客户
+        :return: 返回合伙人余额变更记录的字段值，没有收益时返回 None
+        """
+        if not self.related_partner or not self.total_payed:
+            return None
+        partner_customer = self.related_partner.related_customer
+        if not partner_customer:
+            return None
+        return {
+            'customer': partner_customer,
+            'amounts': float(self.total_payed) * 0.05,
+            'notes': '{0}消费{1:.2f}元收益'.format(
+                customer.name if customer else '某人',
+                float(self.total_payed))
+        }
+
     def make_record_number(self):
         if self.datetime_created:
             self.record_number = '{}{}'.format(
@@ -853,6 +979,11 @@ class ServiceRecord(models.Model):
         ordering = ['-id']
         verbose_name = _('服务记录')
         verbose_name_plural = _('服务记录')
+        indexes = [
+            models.Index(fields=['reserve_time'], name='app_service_reserve_time_idx'),
+        ]
+
+    str_fields = ['car', 'reserve_time']
 
     def __str__(self):
         return "{} {}".format(
@@ -913,6 +1044,8 @@ class ServiceItem(models.Model):
         verbose_name = _('维修项目')
         verbose_name_plural = _('维修项目')
 
+    str_fields = ['name', 'price']
+
     def __str__(self):
         return "{} {}".format(
             self.name,
@@ -1356,6 +1489,12 @@ class InsuranceRecordUpload(models.Model):
     failed_count = models.IntegerField(_('失败条数'), null=True, blank=True)
     is_confirmed = models.BooleanField(_('已确认'), default=True)
     is_processed = models.BooleanField(_('已执行'), default=False)
+    status = models.SmallIntegerField(
+        _('执行状态'), default=0,
+        choices=[(0, '未执行'), (1, '排队中'), (2, '执行中'), (3, '已完成'), (4, '执行失败')],
+        help_text=_('0-->未执行, 1-->排队中, 2-->执行中, 3-->已完成, 4-->执行失败'))
+    processed_count = models.IntegerField(_('已处理条数'), default=0)
+    error_message = models.TextField(_('错误信息'), null=True, blank=True)
     notes = models.TextField(_('备注'), max_length=1000, null=True, blank=True)
     created_by = models.ForeignKey(
         WxUser,
@@ -1390,112 +1529,21 @@ class InsuranceRecordUpload(models.Model):
 
     def import_insurance_data_from_excel(self):
         """
-        数据导入模块
+        数据导入模块，批量导入的实现见 app.data_import.InsuranceRecordImporter
+        每导入一块数据都会保存进度，中断以后再次执行会从已处理的位置继续
         """
         if self.file:
-            file_name = getattr(self, 'file').name
+            from app.data_import import InsuranceRecordImporter
+            InsuranceRecordImporter(self).run()
             self.is_processed = True
-            df = pd.read_excel(getattr(self, 'file').path, keep_default_na=False)
-            fields = {
-                'car_number': '车牌号',
-                'name': '被保险人名称',
-                'mobile': '手机号',
-                'record_date': '签单日期',
-                'total_price': '含税总保费',
-                'tax': '车船税',
-                'payback_percent': '已返费率',
-                'payback_amount': '已返金额',
-                'ic_payback_percent': '保险公司返点',
-                'ic_payback_amount': '返费金额',
-                'profits': '利润',
-                'insurance_company__name': '保险出单公司',
-                'belong_to__name': '归属渠道',
-            }
-            foreign_keys = ['car_number', 'name', 'mobile', 'insurance_company__name', 'belong_to__name']
-            str_fields = [
-                'car_number', 'name', 'mobile', 'insurance_company__name', 'belong_to__name'
-            ]
-            num_fields_2 = [
-                'total_price', 'tax', 'payback_amount', 'ic_payback_amount', 'profits'
-            ]
-            num_fields_4 = [
-                'payback_percent', 'ic_payback_percent'
-            ]
-            date_fields = [
-                'record_date'
-            ]
-            self.total_count = 0
-            self.created_count = 0
-            self.updated_count = 0
-            self.failed_count = 0
-            for r in df.itertuples():
-                self.total_count += 1
-                data = {}
-                for k, v in fields.items():
-                    try:
-                        vl = getattr(r, v)
-                        if k in str_fields:
-                            data[k] = str_value(vl)
-                        elif k in num_fields_2:
-                            data[k] = num_value(vl, 2)
-                        elif k in num_fields_4:
-                            data[k] = num_value(vl, 4)
-                        elif k in date_fields:
-                            data[k] = date_value(vl)
-                        else:
-                            data[k] = vl
-                    except AttributeError:
-                        pass
-                # 客户信息获取
-                if data.get('mobile'):
-                    customer, created = Customer.objects.get_or_create(
-                        mobile=data['mobile'], defaults={'name': data['name']})
-                else:
-                    customer = Customer.objects.filter(name=data['name']).order_by('pk').last()
-                    if not customer:
-                        customer = Customer.objects.create(name=data['name'])
-                # 车辆信息获取
-                car, car_created = CarInfo.objects.update_or_create(
-                    car_number=data['car_number'], defaults={'customer': customer})
-                # 归属渠道
-                belong_to, belong_to_created = BelongTo.objects.get_or_create(
-                    name=data['belong_to__name']
-                )
-                # 保险出单公司
-                if data.get('insurance_company__name'):
-                    insurance_company, insurance_company_created = InsuranceCompany.objects.get_or_create(
-                        name=data['insurance_company__name'],
-                        defaults={'desc': data['insurance_company__name'], 'display': False, 'is_active': True}
-                    )
-                else:
-                    insurance_company = None
-                for p in foreign_keys:
-                    if p in data:
-                        data.pop(p)
-                ir, ir_created = InsuranceRecord.objects.update_or_create(
-                    car=car,
-                    belong_to=belong_to,
-                    insurance_company=insurance_company,
-                    has_payback=True,
-                    is_payed=True,
-                    notes='自动导入数据-{0}-{1}'.format(file_name, r.Index),
-                    **data
-                )
-                if ir_created:
-                    self.created_count += 1
-                else:
-                    self.updated_count += 1
-            self.failed_count = self.total_count - self.created_count - self.updated_count
 
     def save(self, *args, **kwargs):
         super(InsuranceRecordUpload, self).save(*args, **kwargs)
-        if self.is_confirmed is True and self.file and self.is_processed is False:
-            # 更新文件名称
+        if self.is_confirmed is True and self.file and self.is_processed is False and self.status == 0:
+            # 更新文件名称，并加入导入队列，由 run_import_jobs 后台执行
             self.file_name = getattr(self, 'file').name
-            self.import_insurance_data_from_excel()
-            super(InsuranceRecordUpload, self).save(
-                update_fields=[
-                    'file_name', 'is_processed', 'total_count', 'created_count', 'updated_count', 'failed_count'])
+            self.status = 1
+            super(InsuranceRecordUpload, self).save(update_fields=['file_name', 'status'])
 
 
 class PayedRecord(models.Model):
@@ -1560,10 +1608,67 @@ class PayedRecord(models.Model):
 
     objects = models.Manager()
 
+    def compute_cash_payed(self):
+        """
+        自动计算现金支付金额和积分获得
+        """
+        if self.total_payed is not None:
+            total_payed = float(getattr(self, 'total_payed'))
+            amount_payed = 0
+            credit_payed = 0
+            if self.amount_payed is not None:
+                amount_payed = float(getattr(self, 'amount_payed'))
+            if self.credit_payed is not None:
+                credit_payed = float(getattr(self, 'credit_payed'))
+            # 现金支付
+            cash_payed = total_payed - amount_payed - credit_payed
+            self.cash_payed = cash_payed
+            # 积分获得
+            self.credit_change = cash_payed // 20
+
+    def get_ledger_records(self):
+        """
+        收银记录对应的余额变更和积分变更
+        :return: 返回 [(变更记录模型, 查询条件, 字段值)]
+        """
+        res = list()
+        if not self.customer_id:
+            return res
+        # 如果有余额支付的情况，自动创建余额变更记录
+        if self.amount_payed is not None:
+            res.append((AmountChangeRecord, {'related_payed_record_id': self.pk, 'change_type': 2}, {
+                'amounts': - float(getattr(self, 'amount_payed')),
+                'customer_id': self.customer_id,
+                'created_by_id': self.created_by_id,
+                'notes': '余额支付',
+            }))
+        # 积分消耗
+        if self.credit_payed is not None:
+            res.append((CreditChangeRecord, {'related_payed_record_id': self.pk, 'change_type': 3}, {
+                'credits': int(- float(getattr(self, 'credit_payed'))),
+                'customer_id': self.customer_id,
+                'created_by_id': self.created_by_id,
+                'notes': '积分抵扣'
+            }))
+        # 积分获得
+        if self.credit_change is not None:
+            res.append((CreditChangeRecord, {'related_payed_record_id': self.pk, 'change_type': 1}, {
+                'credits': int(float(getattr(self, 'credit_change'))),
+                'customer_id': self.customer_id,
+                'created_by_id': self.created_by_id,
+                'notes': '现金支付获得积分'
+            }))
+        return res
+
     class Meta:
         ordering = ['-id']
         verbose_name = _('收银记录')
         verbose_name_plural = _('收银记录')
+        indexes = [
+            models.Index(fields=['payed_date'], name='app_payed_record_date_idx'),
+        ]
+
+    str_fields = ['customer', 'total_payed']
 
     def __str__(self):
         return "{} {}".format(
@@ -1623,6 +1728,9 @@ class AmountChangeRecord(models.Model):
         ordering = ['-id']
         verbose_name = _('余额变更记录')
         verbose_name_plural = _('余额变更记录')
+        indexes = [
+            models.Index(fields=['customer', '-id'], name='app_amount_customer_id_idx'),
+        ]
 
     def __str__(self):
         return "{0} {1} {2}".format(
@@ -1631,6 +1739,12 @@ class AmountChangeRecord(models.Model):
             self.notes,
         )
 
+    def save(self, *args, **kwargs):
+        # pre_save 中锁定客户并增量更新余额，与记录的保存在同一个事务中，保存失败时一起回滚
+        # 删除时 Django 已经在事务中发送 post_delete
+        with transaction.atomic():
+            super(AmountChangeRecord, self).save(*args, **kwargs)
+
 
 class CreditChangeRecord(models.Model):
     """
@@ -1681,6 +1795,9 @@ class CreditChangeRecord(models.Model):
         ordering = ['-id']
         verbose_name = _('积分变更记录')
         verbose_name_plural = _('积分变更记录')
+        indexes = [
+            models.Index(fields=['customer', '-id'], name='app_credit_customer_id_idx'),
+        ]
 
     def __str__(self):
         return "{0} {1} {2}".format(
@@ -1689,6 +1806,12 @@ class CreditChangeRecord(models.Model):
             self.notes,
         )
 
+    def save(self, *args, **kwargs):
+        # pre_save 中锁定客户并增量更新积分，与记录的保存在同一个事务中，保存失败时一起回滚
+        # 删除时 Django 已经在事务中发送 post_delete
+        with transaction.atomic():
+            super(CreditChangeRecord, self).save(*args, **kwargs)
+
 
 class ReportMake(models.Model):
     report_type = models.CharField(
@@ -1732,11 +1855,126 @@ class ReportMake(models.Model):
         )
 
 
+class SmsCampaign(models.Model):
+    """
+    到期提醒短信，向交强险或年检在指定日期范围内到期的车辆的客户发送
+    确认以后加入队列，由 run_sms_jobs 分块生成短信发送记录并发送
+    """
+    name = models.CharField(_('名称'), max_length=100, null=True)
+    date_type = models.SmallIntegerField(
+        _('提醒类型'), default=1, choices=[(1, '交强险到期'), (2, '年检到期')],
+        help_text=_('1-->交强险到期, 2-->年检到期'))
+    date_start = models.DateField(_('开始日期'), null=True)
+    date_end = models.DateField(_('结束日期'), null=True)
+    template_code = models.CharField(_('短信模板'), max_length=50, null=True)
+    template_param = models.CharField(
+        _('模板参数'), max_length=500, null=True, blank=True,
+        help_text=_('JSON 格式，可以使用 {car_number}、{name}、{date}，例如 {"car": "{car_number}", "date": "{date}"}'))
+    is_confirmed = models.BooleanField(_('已确认'), default=False)
+    status = models.SmallIntegerField(
+        _('执行状态'), default=0,
+        choices=[(0, '未执行'), (1, '排队中'), (2, '生成中'), (3, '发送中'), (4, '已完成'), (5, '执行失败')],
+        help_text=_('0-->未执行, 1-->排队中, 2-->生成中, 3-->发送中, 4-->已完成, 5-->执行失败'))
+    last_date = models.DateField(_('已生成的到期日期'), null=True, blank=True)
+    last_car_id = models.IntegerField(_('已生成的车辆 ID'), default=0)
+    total_count = models.IntegerField(_('总条数'), default=0)
+    sent_count = models.IntegerField(_('发送成功条数'), default=0)
+    failed_count = models.IntegerField(_('发送失败条数'), default=0)
+    datetime_started = models.DateTimeField(_('开始时间'), null=True, blank=True)
+    datetime_finished = models.DateTimeField(_('完成时间'), null=True, blank=True)
+    error_message = models.TextField(_('错误信息'), null=True, blank=True)
+    notes = models.TextField(_('备注'), max_length=1000, null=True, blank=True)
+    created_by = models.ForeignKey(
+        WxUser,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='sms_campaign_created_by',
+        verbose_name=_('创建人员')
+    )
+    confirmed_by = models.ForeignKey(
+        WxUser,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='sms_campaign_confirmed_by',
+        verbose_name=_('审核人员')
+    )
+    datetime_created = models.DateTimeField(_('记录时间'), auto_now_add=True)
+    datetime_updated = models.DateTimeField(_('更新时间'), auto_now=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['-id']
+        verbose_name = _('到期提醒短信')
+        verbose_name_plural = _('到期提醒短信')
+
+    def __str__(self):
+        return "{}".format(
+            self.name
+        )
+
+    @property
+    def date_field(self):
+        return 'insurance_date' if self.date_type == 1 else 'annual_inspection_date'
+
+    @property
+    def throughput(self):
+        """
+        发送速度，条/秒
+        """
+        if not self.datetime_started:
+            return None
+        seconds = ((self.datetime_finished or timezone.now()) - self.datetime_started).total_seconds()
+        return round((self.sent_count + self.failed_count) / seconds, 1) if seconds > 0 else None
+
+    def clean(self):
+        from app.campaigns import render_template_param
+        try:
+            render_template_param(self.template_param, {'car_number': '', 'name': '', 'date': ''})
+            # 按车牌和客户名字的最大长度替换，生成的参数需要能保存到短信发送记录中
+            paras = render_template_param(self.template_param, {
+                'car_number': 'X' * getattr(CarInfo, '_meta').get_field('car_number').max_length,
+                'name': 'X' * getattr(Customer, '_meta').get_field('name').max_length,
+                'date': '0000-00-00',
+            })
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise ValidationError({'template_param': '模板参数格式错误：{0}'.format(e)})
+        max_length = getattr(MsgSendRecord, '_meta').get_field('paras').max_length
+        if len(paras) > max_length:
+            raise ValidationError({'template_param': '模板参数替换以后最长为 {0} 个字符，超过短信数据的长度 {1}'.format(
+                len(paras), max_length)})
+
+    def save(self, *args, **kwargs):
+        super(SmsCampaign, self).save(*args, **kwargs)
+        if self.is_confirmed is True and self.status == 0:
+            # 加入队列，由 run_sms_jobs 后台生成短信并发送
+            self.status = 1
+            super(SmsCampaign, self).save(update_fields=['status'])
+
+
 class MsgSendRecord(models.Model):
     mobile = models.CharField(_('手机'), max_length=20, null=True)
     code = models.CharField(_('验证码'), max_length=20, null=True, blank=True)
-    paras = models.CharField(_('数据'), max_length=200, null=True, blank=True)
-    msg_type = models.IntegerField(_('短信类型'), null=True, choices=[(1, '验证码'), (2, '支付记录')])
+    paras = models.CharField(_('数据'), max_length=1000, null=True, blank=True)
+    msg_type = models.IntegerField(_('短信类型'), null=True, choices=[(1, '验证码'), (2, '支付记录'), (3, '到期提醒')])
+    template_code = models.CharField(_('短信模板'), max_length=50, null=True, blank=True)
+    campaign = models.ForeignKey(
+        SmsCampaign,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name='msg_send_records',
+        verbose_name=_('到期提醒短信')
+    )
+    status = models.SmallIntegerField(
+        _('发送状态'), default=0,
+        choices=[(0, '未发送'), (1, '排队中'), (2, '发送中'), (3, '已发送'), (4, '发送失败'), (5, '结果未知')],
+        help_text=_('0-->未发送, 1-->排队中, 2-->发送中, 3-->已发送, 4-->发送失败, 5-->结果未知'))
+    retry_count = models.IntegerField(_('重试次数'), default=0)
+    next_retry_time = models.DateTimeField(_('下次发送时间'), null=True, blank=True)
+    datetime_sent = models.DateTimeField(_('发送时间'), null=True, blank=True)
     notes = models.TextField(_('备注'), max_length=1000, null=True, blank=True)
     created_by = models.ForeignKey(
         WxUser,
@@ -1763,6 +2001,13 @@ class MsgSendRecord(models.Model):
         ordering = ['-id']
         verbose_name = _('短信发送记录')
         verbose_name_plural = _('短信发送记录')
+        indexes = [
+            models.Index(fields=['mobile', '-id'], name='app_msg_mobile_id_idx'),
+            # 验证码校验：mobile、code 和 msg_type=1
+            models.Index(fields=['mobile', 'code', '-id'], name='app_msg_code_idx', condition=models.Q(msg_type=1)),
+            # 发送队列：排队中和发送中的记录
+            models.Index(fields=['status', 'id'], name='app_msg_queue_idx', condition=models.Q(status__in=[1, 2])),
+        ]
 
     def __str__(self):
         return "{} {}".format(
@@ -1771,6 +2016,355 @@ class MsgSendRecord(models.Model):
         )
 
 
+class ServiceDailyStatic(models.Model):
+    """
+    维修项目日汇总，按进厂日期、门店和维修人员统计，由维修项目和维修服务的保存自动更新
+    """
+    date = models.DateField(_('进厂日期'), null=True, blank=True, db_index=True)
+    related_store = models.ForeignKey(
+        StoreInfo,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('维修门店')
+    )
+    served_by = models.ForeignKey(
+        Superior,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('维修人员')
+    )
+    item_count = models.IntegerField(_('项目数'), default=0)
+    price = models.DecimalField(_('销售额（元）'), default=0, decimal_places=2, max_digits=12)
+    cost = models.DecimalField(_('成本（元）'), default=0, decimal_places=2, max_digits=12)
+
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['-date']
+        # 汇总字段可以为空，PostgreSQL 的唯一约束不比较空值，并发更新由 refresh_service_daily_static 加锁保证
+        unique_together = [('date', 'related_store', 'served_by')]
+        verbose_name = _('维修日汇总')
+        verbose_name_plural = _('维修日汇总')
+
+    def __str__(self):
+        return "{} {} {}".format(
+            self.date,
+            self.related_store_id,
+            self.served_by_id,
+        )
+
+
+class InsuranceDailyStatic(models.Model):
+    """
+    投保记录日汇总，按签单日期、归属渠道和保险公司统计，由投保记录的保存自动更新
+    """
+    date = models.DateField(_('签单日期'), null=True, blank=True, db_index=True)
+    belong_to = models.ForeignKey(
+        BelongTo,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('归属渠道')
+    )
+    insurance_company = models.ForeignKey(
+        InsuranceCompany,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('保险公司')
+    )
+    record_count = models.IntegerField(_('保单数'), default=0)
+    total_price = models.DecimalField(_('含税总保费（元）'), default=0, decimal_places=2, max_digits=12)
+    profits = models.DecimalField(_('利润'), default=0, decimal_places=2, max_digits=12)
+
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['-date']
+        unique_together = [('date', 'belong_to', 'insurance_company')]
+        verbose_name = _('保险日汇总')
+        verbose_name_plural = _('保险日汇总')
+
+    def __str__(self):
+        return "{} {} {}".format(
+            self.date,
+            self.belong_to_id,
+            self.insurance_company_id,
+        )
+
+
+class CarDueEvent(models.Model):
+    """
+    车辆到期提醒，每辆车的交强险和年检各一条，由车辆信息、投保记录和维修服务的保存自动更新
+    """
+    car = models.ForeignKey(
+        CarInfo,
+        on_delete=models.CASCADE,
+        related_name='due_events',
+        verbose_name=_('车辆信息')
+    )
+    due_type = models.SmallIntegerField(
+        _('提醒类型'), default=1, choices=[(1, '交强险到期'), (2, '年检到期')],
+        help_text=_('1-->交强险到期, 2-->年检到期'))
+    due_date = models.DateField(_('到期日期'))
+    customer = models.ForeignKey(
+        Customer,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('客户')
+    )
+    related_superior = models.ForeignKey(
+        Superior,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('客户归属')
+    )
+    related_store = models.ForeignKey(
+        StoreInfo,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        verbose_name=_('最近服务门店')
+    )
+    datetime_updated = models.DateTimeField(_('更新时间'), auto_now=True)
+
+    objects = models.Manager()
+
+    class Meta:
+        ordering = ['due_date', 'id']
+        verbose_name = _('到期提醒')
+        verbose_name_plural = _('到期提醒')
+        unique_together = [('car', 'due_type')]
+        indexes = [
+            models.Index(fields=['due_date', 'due_type'], name='app_due_date_idx'),
+            models.Index(fields=['related_store', 'due_date'], name='app_due_store_date_idx'),
+            models.Index(fields=['related_superior', 'due_date'], name='app_due_superior_date_idx'),
+        ]
+
+    str_fields = ['car', 'due_date']
+
+    def __str__(self):
+        return "{} {}".format(
+            self.car_id,
+            self.due_date,
+        )
+
+
+def filter_by_dates(queryset, field, dates):
+    """
+    按日期列表筛选，日期可以包含 None
+    """
+    dates = set(dates)
+    condition = models.Q(**{'{0}__in'.format(field): [d for d in dates if d is not None]})
+    if None in dates:
+        condition |= models.Q(**{'{0}__isnull'.format(field): True})
+    return queryset.filter(condition)
+
+
+def date_lock_key(date):
+    """
+    日期对应的 advisory lock 的 key，没有日期时为 0
+    """
+    return date.toordinal() if date else 0
+
+
+def refresh_service_daily_static(dates):
+    """
+    按日期重新汇总维修项目，每个日期只需要一次 GROUP BY 查询
+    :param dates: 需要更新的进厂日期
+    """
+    dates = set(dates)
+    if not dates:
+        return
+    with transaction.atomic():
+        # 同一个日期的汇总依次执行，加锁以后再查询，否则并发的两个事务都会删除旧数据再写入，汇总数据重复
+        advisory_lock(ServiceDailyStatic._meta.db_table, [date_lock_key(d) for d in dates])
+        items = filter_by_dates(
+            ServiceItem.objects.all(), 'related_service_record__reserve_time__date', dates
+        ).values(
+            'related_service_record__related_store_id', 'served_by_id',
+            date=TruncDate('related_service_record__reserve_time')
+        ).annotate(
+            item_sum=Sum('price'), cost_sum=Sum('cost'), count=Count('pk')
+        ).order_by()
+        statics = list()
+        for it in items:
+            statics.append(ServiceDailyStatic(
+                date=it['date'],
+                related_store_id=it['related_service_record__related_store_id'],
+                served_by_id=it['served_by_id'],
+                item_count=it['count'],
+                price=it['item_sum'] or 0,
+                cost=it['cost_sum'] or 0,
+            ))
+        filter_by_dates(ServiceDailyStatic.objects.all(), 'date', dates).delete()
+        bulk_create(ServiceDailyStatic, statics)
+
+
+def refresh_insurance_daily_static(dates):
+    """
+    按日期重新汇总投保记录，每个日期只需要一次 GROUP BY 查询
+    :param dates: 需要更新的签单日期
+    """
+    dates = set(dates)
+    if not dates:
+        return
+    with transaction.atomic():
+        advisory_lock(InsuranceDailyStatic._meta.db_table, [date_lock_key(d) for d in dates])
+        records = filter_by_dates(
+            InsuranceRecord.objects.all(), 'record_date', dates
+        ).values(
+            'record_date', 'belong_to_id', 'insurance_company_id'
+        ).annotate(
+            price_sum=Sum('total_price'), profits_sum=Sum('profits'), count=Count('pk')
+        ).order_by()
+        statics = list()
+        for r in records:
+            statics.append(InsuranceDailyStatic(
+                date=r['record_date'],
+                belong_to_id=r['belong_to_id'],
+                insurance_company_id=r['insurance_company_id'],
+                record_count=r['count'],
+                total_price=r['price_sum'] or 0,
+                profits=r['profits_sum'] or 0,
+            ))
+        filter_by_dates(InsuranceDailyStatic.objects.all(), 'date', dates).delete()
+        bulk_create(InsuranceDailyStatic, statics)
+
+
+def next_year(date):
+    """
+    一年以后的同一天，2 月 29 日为 2 月 28 日
+    """
+    try:
+        return date.replace(year=date.year + 1)
+    except ValueError:
+        return date.replace(year=date.year + 1, day=28)
+
+
+def refresh_car_due_events(car_ids, chunk_size=1000):
+    """
+    重新生成车辆的到期提醒，每一块车辆只需要几次 IN 查询，在锁定车辆的事务中读取和写入
+    交强险到期日取车辆信息的交强险到期日和最近一张交强险保单的开始日期（没有时为签单日期）加一年中较晚的一个，
+    年检到期日为车辆信息的年检日期，门店为车辆最近一次维修服务的门店，停用的车辆不提醒
+    :param car_ids: 需要更新的车辆 ID
+    :param chunk_size: 每次处理的车辆数
+    """
+    car_ids = sorted(pk for pk in set(car_ids) if pk is not None)
+    for start in range(0, len(car_ids), chunk_size):
+        chunk = car_ids[start:start + chunk_size]
+        with transaction.atomic():
+            # 先锁定车辆，同一辆车的并发更新依次执行，避免删除以后重复写入违反 (car, due_type) 唯一约束
+            list(CarInfo.objects.select_for_update().filter(pk__in=chunk).order_by('pk').values_list('pk', flat=True))
+            policy_dates = dict(InsuranceRecord.objects.filter(
+                car_id__in=chunk, insurance_jqx=True
+            ).values('car_id').annotate(
+                date=Max(Coalesce('insurance_date', 'record_date'))
+            ).values_list('car_id', 'date').order_by())
+            stores = dict(ServiceRecord.objects.filter(
+                pk__in=ServiceRecord.objects.filter(car_id__in=chunk).values('car_id').annotate(
+                    last_pk=Max('pk')).values('last_pk').order_by()
+            ).values_list('car_id', 'related_store_id'))
+            events = list()
+            for car in CarInfo.objects.filter(pk__in=chunk, is_active=True).values(
+                    'pk', 'insurance_date', 'annual_inspection_date', 'customer_id', 'customer__related_superior_id'):
+                insurance_dates = [car['insurance_date']]
+                if policy_dates.get(car['pk']):
+                    insurance_dates.append(next_year(policy_dates[car['pk']]))
+                insurance_dates = [d for d in insurance_dates if d]
+                for due_type, due_date in ((1, max(insurance_dates) if insurance_dates else None),
+                                           (2, car['annual_inspection_date'])):
+                    if due_date:
+                        events.append(CarDueEvent(
+                            car_id=car['pk'], due_type=due_type, due_date=due_date, customer_id=car['customer_id'],
+                            related_superior_id=car['customer__related_superior_id'],
+                            related_store_id=stores.get(car['pk'])))
+            CarDueEvent.objects.filter(car_id__in=chunk).delete()
+            bulk_create(CarDueEvent, events)
+
+
+def get_service_record_date(service_record_id):
+    """
+    获取维修服务的进厂日期
+    """
+    reserve_time = ServiceRecord.objects.filter(
+        pk=service_record_id
+    ).values_list('reserve_time', flat=True).first()
+    if reserve_time:
+        return timezone.localtime(reserve_time).date() if timezone.is_aware(reserve_time) else reserve_time.date()
+    return None
+
+
+# 用户信息摘要的缓存时间，单位秒，0 表示不缓存；多进程部署时需要配置共享的缓存（如 Redis），否则其它进程的缓存无法清除
+USER_DETAIL_CACHE_TIMEOUT = getattr(settings, 'USER_DETAIL_CACHE_TIMEOUT', 0)
+
+
+def user_detail_cache_key(user_id):
+    return 'user_detail_{0}'.format(user_id)
+
+
+def clear_user_detail_cache(user_ids):
+    """
+    清除用户信息摘要的缓存
+    :param user_ids: 用户 ID
+    """
+    if USER_DETAIL_CACHE_TIMEOUT:
+        cache.delete_many([user_detail_cache_key(user_id) for user_id in user_ids if user_id])
+
+
+def clear_customer_user_detail_cache(customer_ids):
+    """
+    清除客户关联用户的信息摘要缓存
+    :param customer_ids: 客户 ID
+    """
+    if USER_DETAIL_CACHE_TIMEOUT:
+        clear_user_detail_cache(Customer.related_user.through.objects.filter(
+            customer_id__in=[customer_id for customer_id in customer_ids if customer_id]
+        ).values_list('wxuser_id', flat=True))
+
+
+CATALOGUE_VERSION_KEY = 'catalogue_version'
+# 目录数据的缓存时间，单位秒
+CATALOGUE_CACHE_TIMEOUT = getattr(settings, 'CATALOGUE_CACHE_TIMEOUT', 24 * 60 * 60)
+# 只保存在当前进程中的缓存，数据更新时无法清除其他进程的缓存
+LOCAL_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def catalogue_cache_enabled():
+    """
+    目录数据的缓存和版本保存在默认缓存中，需要配置多个进程共享的缓存（如 Redis、Memcached、文件缓存），
+    使用默认的本地内存缓存时不缓存目录数据，也不返回 Last-Modified，否则其他进程在数据更新以后仍然返回过期的数据
+    """
+    backend = settings.CACHES.get('default', dict()).get('BACKEND')
+    return bool(CATALOGUE_CACHE_TIMEOUT) and backend not in LOCAL_CACHE_BACKENDS
+
+
+def get_catalogue_version():
+    """
+    获取目录数据（套餐、机油套餐、门店、保险公司）的版本，版本为最后一次更新的时间戳，同时作为 Last-Modified
+    """
+    version = cache.get(CATALOGUE_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOGUE_VERSION_KEY, int(time.time()), None)
+        version = cache.get(CATALOGUE_VERSION_KEY, int(time.time()))
+    return version
+
+
+def clear_catalogue_cache():
+    """
+    更新目录数据的版本，之前版本的缓存不再使用
+    """
+    version = cache.get(CATALOGUE_VERSION_KEY) or 0
+    cache.set(CATALOGUE_VERSION_KEY, max(int(time.time()), version + 1), None)
+
+
 @receiver(pre_save, sender=WxUser)
 def create_username_password(sender, instance, **kwargs):
     key = settings.SECRET_KEY
@@ -1828,6 +2422,43 @@ def update_related_customers(sender, instance, **kwargs):
         customer.save()
 
 
+@receiver(post_save, sender=ServicePackageType)
+@receiver(post_delete, sender=ServicePackageType)
+@receiver(post_save, sender=ServicePackage)
+@receiver(post_delete, sender=ServicePackage)
+@receiver(post_save, sender=OilPackage)
+@receiver(post_delete, sender=OilPackage)
+@receiver(post_save, sender=StoreInfo)
+@receiver(post_delete, sender=StoreInfo)
+@receiver(post_save, sender=InsuranceCompany)
+@receiver(post_delete, sender=InsuranceCompany)
+def catalogue_changed(sender, **kwargs):
+    transaction.on_commit(clear_catalogue_cache)
+
+
+@receiver(post_save, sender=WxUser)
+def post_save_user_detail_cache(sender, instance, **kwargs):
+    defer_on_commit(clear_user_detail_cache, {instance.pk})
+
+
+@receiver(post_save, sender=Customer)
+def post_save_customer_user_detail_cache(sender, instance, **kwargs):
+    defer_on_commit(clear_customer_user_detail_cache, {instance.pk})
+
+
+@receiver(m2m_changed, sender=Customer.related_user.through)
+def related_user_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # 客户和用户的关联关系变更以后，清除相关用户的信息摘要缓存
+    if reverse:
+        user_ids = {instance.pk}
+    elif action == 'pre_clear':
+        user_ids = set(instance.related_user.values_list('pk', flat=True))
+    else:
+        user_ids = set(pk_set or [])
+    if action in ('post_add', 'post_remove', 'pre_clear'):
+        defer_on_commit(clear_user_detail_cache, user_ids)
+
+
 @receiver(post_save, sender=Customer)
 def post_save_customer(sender, instance, **kwargs):
     # 客户更新以后更新合伙人列表
@@ -1842,269 +2473,434 @@ def post_save_customer(sender, instance, **kwargs):
         Partner.objects.filter(related_customer_id=instance.pk).delete()
 
 
+def refresh_service_record_totals(service_record_ids):
+    """
+    根据维修项目重新计算维修服务的应收金额和总成本，所有维修服务通过一条 UPDATE 语句完成
+    :param service_record_ids: 维修服务 ID
+    """
+    service_record_ids = [pk for pk in service_record_ids if pk]
+    if not service_record_ids:
+        return
+    items = ServiceItem.objects.filter(
+        related_service_record_id=OuterRef('pk')
+    ).order_by().values('related_service_record_id')
+    ServiceRecord.objects.filter(pk__in=service_record_ids).update(
+        total_price=Coalesce(Subquery(items.annotate(price_sum=Sum('price')).values('price_sum')), 0),
+        total_cost=Coalesce(Subquery(items.annotate(cost_sum=Sum('cost')).values('cost_sum')), 0),
+    )
+
+
 @receiver(pre_save, sender=ServiceItem)
 def pre_save_service_item(sender, instance, **kwargs):
     if instance.item_price is not None and instance.item_count is not None:
-        instance.price = float(getattr(instance, 'item_price')) * int(getattr(instance, 'item_count'))
+        instance.price = decimal_value(
+            Decimal(str(getattr(instance, 'item_price'))) * int(getattr(instance, 'item_count')))
+    # 维修项目改挂到其他维修服务时，原来的维修服务也需要重新计算
+    instance._pre_service_record_id = instance.related_service_record_id
+    if instance.pk:
+        instance._pre_service_record_id = ServiceItem.objects.filter(
+            pk=instance.pk).values_list('related_service_record_id', flat=True).first()
 
 
 @receiver(post_save, sender=ServiceItem)
 def update_related_service_record(sender, instance, **kwargs):
-    total_price = 0
-    total_cost = 0
-    if instance.related_service_record:
-        items = ServiceItem.objects.filter(
-            related_service_record_id=getattr(instance, 'related_service_record_id')
-        ).values('price', 'cost')
-        for it in items:
-            # price 计算
-            price = it.get('price', 0)
-            if price:
-                price = float(price)
-            else:
-                price = 0
-            total_price = total_price + price
-            # cost 计算
-            cost = it.get('cost', 0)
-            if cost:
-                cost = float(cost)
-            else:
-                cost = 0
-            total_cost = total_cost + cost
-        ServiceRecord.objects.filter(
-            pk=getattr(instance, 'related_service_record_id')
-        ).update(total_price=total_price, total_cost=total_cost)
+    # 同一个事务中保存多个维修项目时，每个维修服务只在提交以后计算一次
+    defer_on_commit(
+        refresh_service_record_totals,
+        {instance.related_service_record_id, getattr(instance, '_pre_service_record_id', None)})
+
+
+@receiver(post_delete, sender=ServiceItem)
+def post_delete_service_item(sender, instance, **kwargs):
+    defer_on_commit(refresh_service_record_totals, {instance.related_service_record_id})
 
 
 @receiver(pre_save, sender=PayedRecord)
 def update_cash_payed(sender, instance, **kwargs):
-    # 自动计算现金支付金额和积分获得
-    if instance.total_payed is not None:
-        total_payed = float(getattr(instance, 'total_payed'))
-        amount_payed = 0
-        credit_payed = 0
-        if instance.amount_payed is not None:
-            amount_payed = float(getattr(instance, 'amount_payed'))
-        if instance.credit_payed is not None:
-            credit_payed = float(getattr(instance, 'credit_payed'))
-        # 现金支付
-        cash_payed = total_payed - amount_payed - credit_payed
-        instance.cash_payed = cash_payed
-        # 积分获得
-        instance.credit_change = cash_payed // 20
+    # 自动计算现金支付金额和积分获得，批量处理见 PaymentService
+    instance.compute_cash_payed()
 
 
 @receiver(post_save, sender=PayedRecord)
 def post_save_payed_record(sender, instance, **kwargs):
-    # 如果有余额支付的情况，自动创建余额变更记录
-    if instance.amount_payed is not None and instance.customer:
-        amounts_change = - float(getattr(instance, 'amount_payed'))
-        AmountChangeRecord.objects.update_or_create(
-            related_payed_record_id=instance.pk,
-            change_type=2,
-            defaults={
-                'amounts': amounts_change,
-                'customer': instance.customer,
-                'created_by': instance.created_by,
-                'notes': '余额支付',
-            })
-    if instance.customer:
-        # 积分消耗
-        if instance.credit_payed is not None:
-            credits_used = - float(getattr(instance, 'credit_payed'))
-            CreditChangeRecord.objects.update_or_create(
-                related_payed_record_id=instance.pk,
-                change_type=3,
-                defaults={
-                    'credits': credits_used,
-                    'customer': instance.customer,
-                    'created_by': instance.created_by,
-                    'notes': '积分抵扣'
-                }
-            )
-        # 积分获得
-        if instance.credit_change is not None:
-            credits_get = float(getattr(instance, 'credit_change'))
-            CreditChangeRecord.objects.update_or_create(
-                related_payed_record_id=instance.pk,
-                change_type=1,
-                defaults={
-                    'credits': credits_get,
-                    'customer': instance.customer,
-                    'created_by': instance.created_by,
-                    'notes': '现金支付获得积分'
-                }
-            )
-        # 计算客户的累计支付
-        # todo 联动计算
-        prs = PayedRecord.objects.filter(
-            customer=instance.customer
-        ).values(
-            'total_price', 'total_payed',
-            'related_service_record_id',
-            'related_service_record__total_price', 'related_service_record__total_payed',
-            'related_insurance_record_id',
-            'related_insurance_record__total_price', 'related_insurance_record__payback_amount',
-        )
-        total_consumption_1 = 0  # 保险
-        total_consumption_2 = 0  # 维修
-        total_price = 0
-        total_payed = 0
-        for pr in prs:
-            total_price += float(pr['total_price'])
-            total_payed += float(pr['total_payed'])
-            if pr['related_insurance_record_id']:
-                if pr['related_insurance_record__total_price']:
-                    total_consumption_1 += float(pr['related_insurance_record__total_price'])
-            if pr['related_service_record_id']:
-                if pr['related_service_record__total_price']:
-                    total_consumption_2 += float(pr['related_service_record__total_price'])
-        total_consumption = total_consumption_1 + total_consumption_2
+    # 自动创建余额变更和积分变更记录，批量处理见 PaymentService
+    for model, lookup, defaults in instance.get_ledger_records():
+        model.objects.update_or_create(defaults=defaults, **lookup)
+
+
+CUSTOMER_TOTAL_FIELDS = ['total_consumption', 'total_consumption_1', 'total_consumption_2', 'total_price', 'total_payed']
+
+
+def get_payed_record_totals(related_insurance_record_id, related_service_record_id, total_price, total_payed):
+    """
+    计算一条收银记录对客户累计消费的贡献，保险和维修消费按收银记录的应收金额统计
+    :return: 返回 {客户字段: 金额}
+    """
+    total_price = decimal_value(total_price) or Decimal('0')
+    total_payed = decimal_value(total_payed) or Decimal('0')
+    total_consumption_1 = total_price if related_insurance_record_id else Decimal('0')  # 保险
+    total_consumption_2 = total_price if related_service_record_id else Decimal('0')  # 维修
+    return {
+        'total_consumption': total_consumption_1 + total_consumption_2,
+        'total_consumption_1': total_consumption_1,
+        'total_consumption_2': total_consumption_2,
+        'total_price': total_price,
+        'total_payed': total_payed,
+    }
+
+
+def shift_customer_totals(customer_id, totals, sign=1):
+    """
+    客户累计消费的增量更新，通过 F 表达式在数据库中累加
+    :param customer_id: 客户 ID
+    :param totals: {客户字段: 变化量}
+    :param sign: 1 为增加，-1 为减少
+    """
+    if not customer_id:
+        return
+    data = {f: Coalesce(F(f), 0) + v * sign for f, v in totals.items() if v}
+    if data:
+        Customer.objects.filter(pk=customer_id).update(**data)
+
+
+def rebuild_customer_totals(customer_ids=None, dry_run=False):
+    """
+    根据全部收银记录重建客户的累计消费，一次 GROUP BY 查询，仅批量更新有差异的客户
+    :param customer_ids: 客户 ID，为空时重建全部客户
+    :param dry_run: 只统计差异，不更新数据
+    :return: 返回有差异的客户数
+    """
+    payed_records = PayedRecord.objects.filter(customer__isnull=False)
+    customers = Customer.objects.all()
+    if customer_ids is not None:
+        payed_records = payed_records.filter(customer_id__in=customer_ids)
+        customers = customers.filter(pk__in=customer_ids)
+    rows = payed_records.values('customer_id').annotate(
+        price_sum=Sum('total_price'),
+        payed_sum=Sum('total_payed'),
+        consumption_1_sum=Sum('total_price', filter=models.Q(related_insurance_record__isnull=False)),
+        consumption_2_sum=Sum('total_price', filter=models.Q(related_service_record__isnull=False)),
+    ).order_by()
+    totals = dict()
+    for r in rows:
+        total_consumption_1 = r['consumption_1_sum'] or Decimal('0')
+        total_consumption_2 = r['consumption_2_sum'] or Decimal('0')
+        totals[r['customer_id']] = {
+            'total_consumption': total_consumption_1 + total_consumption_2,
+            'total_consumption_1': total_consumption_1,
+            'total_consumption_2': total_consumption_2,
+            'total_price': r['price_sum'] or Decimal('0'),
+            'total_payed': r['payed_sum'] or Decimal('0'),
+        }
+    empty_totals = {f: Decimal('0') for f in CUSTOMER_TOTAL_FIELDS}
+    changed_customers = list()
+    for c in customers.only('pk', *CUSTOMER_TOTAL_FIELDS).iterator():
+        changed = False
+        for f, v in totals.get(c.pk, empty_totals).items():
+            if getattr(c, f) != v:
+                setattr(c, f, v)
+                changed = True
+        if changed:
+            changed_customers.append(c)
+    if not dry_run:
+        Customer.objects.bulk_update(changed_customers, CUSTOMER_TOTAL_FIELDS, batch_size=1000)
+    return len(changed_customers)
+
+
+@receiver(pre_save, sender=PayedRecord)
+def pre_save_payed_record_totals(sender, instance, **kwargs):
+    # 记录保存之前的贡献，保存以后只更新差额
+    instance._pre_totals = None
+    if instance.pk:
+        pre_record = PayedRecord.objects.filter(pk=instance.pk).values(
+            'customer_id', 'related_insurance_record_id', 'related_service_record_id', 'total_price', 'total_payed'
+        ).first()
+        if pre_record:
+            instance._pre_totals = (pre_record['customer_id'], get_payed_record_totals(
+                pre_record['related_insurance_record_id'], pre_record['related_service_record_id'],
+                pre_record['total_price'], pre_record['total_payed']))
+
+
+@receiver(post_save, sender=PayedRecord)
+def post_save_payed_record_totals(sender, instance, **kwargs):
+    totals = get_payed_record_totals(
+        instance.related_insurance_record_id, instance.related_service_record_id,
+        instance.total_price, instance.total_payed)
+    pre_totals = getattr(instance, '_pre_totals', None)
+    instance._pre_totals = None
+    with transaction.atomic():
+        if pre_totals and pre_totals[0] == instance.customer_id:
+            shift_customer_totals(instance.customer_id, {f: v - pre_totals[1][f] for f, v in totals.items()})
+        else:
+            if pre_totals:
+                shift_customer_totals(pre_totals[0], pre_totals[1], -1)
+            shift_customer_totals(instance.customer_id, totals)
+
+
+@receiver(post_delete, sender=PayedRecord)
+def post_delete_payed_record_totals(sender, instance, **kwargs):
+    shift_customer_totals(instance.customer_id, get_payed_record_totals(
+        instance.related_insurance_record_id, instance.related_service_record_id,
+        instance.total_price, instance.total_payed), -1)
+
+
+def lock_customers(customer_ids):
+    """
+    按 ID 的顺序锁定客户，同一个客户的余额、积分变更依次执行，需要在事务中调用
+    :param customer_ids: 客户 ID
+    """
+    customer_ids = sorted(pk for pk in set(customer_ids) if pk)
+    if customer_ids:
+        list(Customer.objects.select_for_update().filter(
+            pk__in=customer_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def get_amounts_before(customer_id, pk=None):
+    """
+    获取客户在某条记录之前的余额，即上一条记录的变更后余额
+    :param customer_id: 客户 ID
+    :param pk: 当前记录 ID，为空时表示新增记录
+    :return: 返回之前的余额
+    """
+    records = AmountChangeRecord.objects.filter(customer_id=customer_id)
+    if pk:
+        records = records.filter(pk__lt=pk)
+    amounts_before = records.order_by('-pk').values_list('current_amounts', flat=True).first()
+    return amounts_before or Decimal('0')
+
+
+def shift_amount_ledger(customer_id, pk, delta):
+    """
+    余额变更的增量更新：客户余额以及该记录之后的所有变更后余额统一加上 delta，
+    不再逐条重新保存之后的记录
+    :param customer_id: 客户 ID
+    :param pk: 发生变更的记录 ID，为空时表示新增记录，之后没有其它记录
+    :param delta: 余额变化量
+    """
+    if not customer_id or not delta:
+        return
+    with transaction.atomic():
+        if pk:
+            AmountChangeRecord.objects.filter(
+                customer_id=customer_id, pk__gt=pk
+            ).update(current_amounts=F('current_amounts') + delta)
         Customer.objects.filter(
-            pk=getattr(instance, 'customer').pk
-        ).update(
-            total_consumption=round(total_consumption, 2),
-            total_consumption_1=round(total_consumption_1, 2),
-            total_consumption_2=round(total_consumption_2, 2),
-            total_price=round(total_price, 2),
-            total_payed=round(total_payed, 2)
-        )
+            pk=customer_id
+        ).update(current_amounts=Coalesce(F('current_amounts'), 0) + delta)
 
 
-@receiver([pre_save, post_delete], sender=AmountChangeRecord)
+def rebuild_amount_ledger(customer_id):
+    """
+    根据全部余额变更记录重建客户的余额，按顺序扫描一次累加，仅批量更新有差异的记录
+    :param customer_id: 客户 ID
+    :return: 返回更新的记录条数
+    """
+    return rebuild_amount_ledgers([customer_id])[0]
+
+
+def rebuild_amount_ledgers(customer_ids, dry_run=False):
+    """
+    批量重建多个客户的余额，全部记录按 (客户, ID) 顺序一次查询、流式累加，仅批量更新有差异的记录和客户
+    :param customer_ids: 客户 ID
+    :param dry_run: 只统计差异，不更新数据
+    :return: 返回 (有差异的记录条数, 有差异的客户数)
+    """
+    current_amounts = {customer_id: Decimal('0') for customer_id in customer_ids}
+    records = AmountChangeRecord.objects.filter(
+        customer_id__in=current_amounts.keys()
+    ).order_by('customer_id', 'pk').only('pk', 'customer_id', 'amounts', 'current_amounts')
+    changed_records = list()
+    for r in records.iterator(chunk_size=2000):
+        current_amounts[r.customer_id] += r.amounts or 0
+        if r.current_amounts != current_amounts[r.customer_id]:
+            r.current_amounts = current_amounts[r.customer_id]
+            changed_records.append(r)
+    changed_customers = list()
+    for c in Customer.objects.filter(pk__in=current_amounts.keys()).only('pk', 'current_amounts'):
+        if c.current_amounts != current_amounts[c.pk]:
+            c.current_amounts = current_amounts[c.pk]
+            changed_customers.append(c)
+    if not dry_run:
+        with transaction.atomic():
+            AmountChangeRecord.objects.bulk_update(changed_records, ['current_amounts'], batch_size=1000)
+            Customer.objects.bulk_update(changed_customers, ['current_amounts'], batch_size=1000)
+    return len(changed_records), len(changed_customers)
+
+
+@receiver(pre_save, sender=AmountChangeRecord)
 def pre_save_amount_change_record(sender, instance, **kwargs):
-    # todo delete 测试
-    current_amounts = 0
-    current_amounts_all = 0
-    # todo 可进行优化
-    all_records = AmountChangeRecord.objects.filter(customer=instance.customer)
+    amounts = decimal_value(instance.amounts) or Decimal('0')
+    pre_record = None
     if instance.pk:
-        # 排除当前记录
-        all_records = all_records.exclude(pk=instance.pk)
-    for r in all_records.values('amounts'):
-        current_amounts_all += float(r['amounts'])
-    current_amounts_all += float(instance.amounts)  # 计算总余额
-    # 更新客户的余额
-    Customer.objects.filter(
-        pk=getattr(instance, 'customer').id
-    ).update(current_amounts=round(current_amounts_all, 2))
+        pre_record = AmountChangeRecord.objects.select_for_update().filter(
+            pk=instance.pk).values('customer_id', 'amounts').first()
+    customer_ids = {instance.customer_id}
+    if pre_record:
+        customer_ids.add(pre_record['customer_id'])
+    # 先锁定客户再读取上一条记录的余额，并发新增的记录不会得到相同的变更后余额
+    lock_customers(customer_ids)
+    defer_on_commit(clear_customer_user_detail_cache, customer_ids)
+    if pre_record and pre_record['customer_id'] != instance.customer_id:
+        # 更换了客户，从原客户的余额中扣除
+        shift_amount_ledger(pre_record['customer_id'], instance.pk, -(pre_record['amounts'] or 0))
+        pre_record = None
+    if pre_record:
+        delta = amounts - (pre_record['amounts'] or 0)
+    else:
+        delta = amounts
+    # 更新客户的余额以及之后记录的余额
+    shift_amount_ledger(instance.customer_id, instance.pk, delta)
     # 计算当前记录的余额
-    if instance.pk:
-        pre_records = all_records.filter(pk__lt=instance.pk)
-        for r in pre_records.values('amounts'):
-            current_amounts += float(r['amounts'])
-        current_amounts += float(instance.amounts)
+    if instance.customer_id:
+        instance.current_amounts = get_amounts_before(instance.customer_id, instance.pk) + amounts
     else:
-        current_amounts = current_amounts_all
-    instance.current_amounts = round(current_amounts, 2)
+        instance.current_amounts = amounts
+
 
+@receiver(post_delete, sender=AmountChangeRecord)
+def post_delete_amount_change_record(sender, instance, **kwargs):
+    amounts = decimal_value(instance.amounts) or Decimal('0')
+    lock_customers({instance.customer_id})
+    shift_amount_ledger(instance.customer_id, instance.pk, -amounts)
+    defer_on_commit(clear_customer_user_detail_cache, {instance.customer_id})
 
-@receiver(post_save, sender=AmountChangeRecord)
-def post_save_amount_change_record(sender, instance, **kwargs):
-    after_record = AmountChangeRecord.objects.filter(
-        customer=instance.customer, pk__gt=instance.pk).order_by('pk').first()
-    if after_record:
-        after_record.save()
+
+def get_credits_before(customer_id, pk=None):
+    """
+    获取客户在某条记录之前的积分，即上一条记录的变更后积分
+    :param customer_id: 客户 ID
+    :param pk: 当前记录 ID，为空时表示新增记录
+    :return: 返回之前的积分
+    """
+    records = CreditChangeRecord.objects.filter(customer_id=customer_id)
+    if pk:
+        records = records.filter(pk__lt=pk)
+    credits_before = records.order_by('-pk').values_list('current_credits', flat=True).first()
+    return credits_before or 0
+
+
+def shift_credit_ledger(customer_id, pk, delta, total_delta):
+    """
+    积分变更的增量更新：客户积分以及该记录之后的所有变更后积分统一加上 delta，累计积分加上 total_delta
+    :param customer_id: 客户 ID
+    :param pk: 发生变更的记录 ID，为空时表示新增记录，之后没有其它记录
+    :param delta: 当前积分的变化量
+    :param total_delta: 累计积分（只统计获得的积分）的变化量
+    """
+    if not customer_id or (not delta and not total_delta):
+        return
+    with transaction.atomic():
+        if pk and delta:
+            CreditChangeRecord.objects.filter(
+                customer_id=customer_id, pk__gt=pk
+            ).update(current_credits=F('current_credits') + delta)
+        Customer.objects.filter(
+            pk=customer_id
+        ).update(
+            current_credits=Coalesce(F('current_credits'), 0) + delta,
+            total_credits=Coalesce(F('total_credits'), 0) + total_delta
+        )
+
+
+def rebuild_credit_ledger(customer_id):
+    """
+    根据全部积分变更记录重建客户的积分，按顺序扫描一次累加，仅批量更新有差异的记录
+    :param customer_id: 客户 ID
+    :return: 返回更新的记录条数
+    """
+    return rebuild_credit_ledgers([customer_id])[0]
 
 
-@receiver([pre_save, post_delete], sender=CreditChangeRecord)
+def rebuild_credit_ledgers(customer_ids, dry_run=False):
+    """
+    批量重建多个客户的积分，全部记录按 (客户, ID) 顺序一次查询、流式累加，仅批量更新有差异的记录和客户
+    :param customer_ids: 客户 ID
+    :param dry_run: 只统计差异，不更新数据
+    :return: 返回 (有差异的记录条数, 有差异的客户数)
+    """
+    current_credits = {customer_id: 0 for customer_id in customer_ids}
+    total_credits = {customer_id: 0 for customer_id in customer_ids}
+    records = CreditChangeRecord.objects.filter(
+        customer_id__in=current_credits.keys()
+    ).order_by('customer_id', 'pk').only('pk', 'customer_id', 'credits', 'current_credits')
+    changed_records = list()
+    for r in records.iterator(chunk_size=2000):
+        c = r.credits or 0
+        current_credits[r.customer_id] += c
+        if c > 0:
+            total_credits[r.customer_id] += c
+        if r.current_credits != current_credits[r.customer_id]:
+            r.current_credits = current_credits[r.customer_id]
+            changed_records.append(r)
+    changed_customers = list()
+    for c in Customer.objects.filter(pk__in=current_credits.keys()).only('pk', 'current_credits', 'total_credits'):
+        if c.current_credits != current_credits[c.pk] or c.total_credits != total_credits[c.pk]:
+            c.current_credits = current_credits[c.pk]
+            c.total_credits = total_credits[c.pk]
+            changed_customers.append(c)
+    if not dry_run:
+        with transaction.atomic():
+            CreditChangeRecord.objects.bulk_update(changed_records, ['current_credits'], batch_size=1000)
+            Customer.objects.bulk_update(changed_customers, ['current_credits', 'total_credits'], batch_size=1000)
+    return len(changed_records), len(changed_customers)
+
+
+@receiver(pre_save, sender=CreditChangeRecord)
 def pre_save_credit_change_record(sender, instance, **kwargs):
-    current_credits = 0
-    current_credits_pos = 0
-    current_credits_neg = 0
-    # todo 可进行优化
-    all_records = CreditChangeRecord.objects.filter(customer=instance.customer)
+    credits = int(instance.credits or 0)
+    pre_record = None
     if instance.pk:
-        all_records = all_records.exclude(pk=instance.pk)
-    for r in all_records.values('credits'):
-        c = int(r['credits'])
-        if c >= 0:
-            current_credits_pos += c
-        else:
-            current_credits_neg += c
-    c_n = int(instance.credits)
-    if c_n >= 0:
-        current_credits_pos += c_n
-    else:
-        current_credits_neg += c_n
-    current_credits_all = current_credits_pos + current_credits_neg
-    # 更新客户的积分
-    Customer.objects.filter(
-        pk=getattr(instance, 'customer').id
-    ).update(
-        current_credits=current_credits_all,
-        total_credits=current_credits_pos
-    )
+        pre_record = CreditChangeRecord.objects.select_for_update().filter(
+            pk=instance.pk).values('customer_id', 'credits').first()
+    customer_ids = {instance.customer_id}
+    if pre_record:
+        customer_ids.add(pre_record['customer_id'])
+    # 先锁定客户再读取上一条记录的积分，并发新增的记录不会得到相同的变更后积分
+    lock_customers(customer_ids)
+    defer_on_commit(clear_customer_user_detail_cache, customer_ids)
+    if pre_record and pre_record['customer_id'] != instance.customer_id:
+        # 更换了客户，从原客户的积分中扣除
+        pre_credits = pre_record['credits'] or 0
+        shift_credit_ledger(pre_record['customer_id'], instance.pk, -pre_credits, -max(pre_credits, 0))
+        pre_record = None
+    pre_credits = 0
+    if pre_record:
+        pre_credits = pre_record['credits'] or 0
+    # 更新客户的积分以及之后记录的积分
+    shift_credit_ledger(
+        instance.customer_id, instance.pk, credits - pre_credits, max(credits, 0) - max(pre_credits, 0))
     # 计算当前记录的剩余积分
-    if instance.pk:
-        pre_records = all_records.filter(pk__lte=instance.pk)
-        for r in pre_records.values('credits'):
-            if r['credits']:
-                current_credits += int(r['credits'])
-        if instance.credits:
-            current_credits += int(instance.credits)
+    if instance.customer_id:
+        instance.current_credits = get_credits_before(instance.customer_id, instance.pk) + credits
     else:
-        current_credits = current_credits_all
-    instance.current_credits = current_credits
+        instance.current_credits = credits
 
 
-@receiver(post_save, sender=CreditChangeRecord)
-def post_save_credit_change_record(sender, instance, **kwargs):
-    after_record = CreditChangeRecord.objects.filter(
-        customer=instance.customer, pk__gt=instance.pk).order_by('pk').first()
-    if after_record:
-        after_record.save()
+@receiver(post_delete, sender=CreditChangeRecord)
+def post_delete_credit_change_record(sender, instance, **kwargs):
+    credits = int(instance.credits or 0)
+    lock_customers({instance.customer_id})
+    shift_credit_ledger(instance.customer_id, instance.pk, -credits, -max(credits, 0))
+    defer_on_commit(clear_customer_user_detail_cache, {instance.customer_id})
 
 
 @receiver(post_save, sender=InsuranceRecord)
 def post_save_insurance_record(sender, instance, **kwargs):
-    # 自动创建收款记录
+    # 自动创建收款记录，批量处理见 PaymentService
     if instance.is_payed:
-        total_payed = 0
-        total_price = 0
-        customer = None
-        if instance.total_price is not None:
-            total_price = float(instance.total_price)
-            if instance.payback_amount is not None:
-                total_payed = float(instance.total_price) - float(instance.payback_amount)
-            else:
-                total_payed = float(instance.total_price)
-        if instance.car:
-            customer = instance.car.customer
-        # 不管有没有关联客户，都要创建收款记录 todo 测试
+        defaults = instance.get_payed_record_defaults()
         related_payed_record, created = PayedRecord.objects.update_or_create(
             related_insurance_record=instance,
-            defaults={
-                'customer': customer,
-                'total_price': total_price,
-                'total_payed': total_payed,
-                'created_by': instance.created_by,
-                'confirmed_by': instance.confirmed_by,
-                'payed_date': instance.record_date,
-                'notes': '投保支付'
-            },
+            defaults=defaults,
         )
         # 如果有关联合伙人
-        if instance.related_partner:
-            partner_customer = instance.related_partner.related_customer
-            if partner_customer:
-                # 合伙人收益 2%
-                partner_amount_get = total_price * 0.02
-                if customer:
-                    customer_name = customer.name
-                else:
-                    customer_name = '某人'
-                AmountChangeRecord.objects.update_or_create(
-                    related_payed_record=related_payed_record,
-                    change_type=3,
-                    defaults={
-                        'customer': partner_customer,
-                        'amounts': partner_amount_get,
-                        'notes': '{0}投保{1:.2f}元收益'.format(
-                            customer_name,
-                            float(total_price))
-                    },
-                )
+        partner_amount_defaults = instance.get_partner_amount_defaults(defaults['customer'])
+        if partner_amount_defaults:
+            AmountChangeRecord.objects.update_or_create(
+                related_payed_record=related_payed_record,
+                change_type=3,
+                defaults=partner_amount_defaults,
+            )
     else:
         PayedRecord.objects.filter(related_insurance_record_id=instance.pk).delete()
 
@@ -2112,46 +2908,124 @@ def post_save_insurance_record(sender, instance, **kwargs):
 @receiver(post_save, sender=ServiceRecord)
 def post_save_service_record(sender, instance, **kwargs):
     if instance.is_payed:
-        # 自动创建收支记录
-        customer = None
-        if instance.car:
-            customer = instance.car.customer
-        # 不管有没有客户，都要创建收款记录 todo 测试
-        total_payed = instance.total_payed
+        # 自动创建收支记录，批量处理见 PaymentService
+        defaults = instance.get_payed_record_defaults()
         related_payed_record, created = PayedRecord.objects.update_or_create(
             related_service_record=instance,
-            defaults={
-                'customer': customer,
-                'related_store': instance.related_store,
-                'total_price': instance.total_price,
-                'total_payed': instance.total_payed,
-                'created_by': instance.created_by,
-                'confirmed_by': instance.confirmed_by,
-                'payed_date': instance.datetime_updated,
-                'notes': '服务支付'
-            }
+            defaults=defaults
         )
         # 如果有关联合伙人
-        if instance.related_partner:
-            if total_payed:
-                partner_customer = instance.related_partner.related_customer
-                if partner_customer:
-                    # 合伙人收益为实收金额的 5%
-                    partner_amount_get = float(total_payed) * 0.05
-                    if customer:
-                        customer_name = customer.name
-                    else:
-                        customer_name = '某人'
-                    AmountChangeRecord.objects.update_or_create(
-                        related_payed_record=related_payed_record,
-                        change_type=3,
-                        defaults={
-                            'customer': partner_customer,
-                            'amounts': partner_amount_get,
-                            'notes': '{0}消费{1:.2f}元收益'.format(
-                                customer_name,
-                                float(total_payed))
-                        },
-                    )
+        partner_amount_defaults = instance.get_partner_amount_defaults(defaults['customer'])
+        if partner_amount_defaults:
+            AmountChangeRecord.objects.update_or_create(
+                related_payed_record=related_payed_record,
+                change_type=3,
+                defaults=partner_amount_defaults,
+            )
     else:
         PayedRecord.objects.filter(related_service_record_id=instance.pk).delete()
+
+
+@receiver(pre_save, sender=ServiceRecord)
+def pre_save_service_record_static(sender, instance, **kwargs):
+    # 进厂时间或门店变更时，原来的日期也需要重新汇总；新的维修服务或门店、车辆变更时更新车辆的到期提醒
+    instance._due_car_ids = set()
+    if instance.pk:
+        old = ServiceRecord.objects.filter(pk=instance.pk).values(
+            'reserve_time', 'related_store_id', 'car_id').first()
+        if old and (old['reserve_time'] != instance.reserve_time or
+                    old['related_store_id'] != instance.related_store_id):
+            instance._static_dates = {get_service_record_date(instance.pk)}
+        if old and (old['related_store_id'] != instance.related_store_id or old['car_id'] != instance.car_id):
+            instance._due_car_ids = {old['car_id'], instance.car_id}
+    else:
+        instance._due_car_ids = {instance.car_id}
+
+
+@receiver(post_save, sender=ServiceRecord)
+def post_save_service_record_static(sender, instance, **kwargs):
+    dates = getattr(instance, '_static_dates', None)
+    if dates:
+        dates.add(get_service_record_date(instance.pk))
+        defer_on_commit(refresh_service_daily_static, dates)
+        instance._static_dates = set()
+    car_ids = getattr(instance, '_due_car_ids', None)
+    if car_ids:
+        defer_on_commit(refresh_car_due_events, car_ids)
+        instance._due_car_ids = set()
+
+
+@receiver(post_delete, sender=ServiceRecord)
+def post_delete_service_record_static(sender, instance, **kwargs):
+    reserve_time = instance.reserve_time
+    if reserve_time and timezone.is_aware(reserve_time):
+        reserve_time = timezone.localtime(reserve_time)
+    defer_on_commit(refresh_service_daily_static, {reserve_time.date() if reserve_time else None})
+
+
+@receiver(pre_save, sender=ServiceItem)
+def pre_save_service_item_static(sender, instance, **kwargs):
+    # 维修项目改挂到其他维修服务时，原来的日期也需要重新汇总
+    instance._static_dates = set()
+    old_record_id = getattr(instance, '_pre_service_record_id', None)
+    if old_record_id != instance.related_service_record_id:
+        instance._static_dates.add(get_service_record_date(old_record_id))
+
+
+@receiver(post_save, sender=ServiceItem)
+def post_save_service_item_static(sender, instance, **kwargs):
+    dates = getattr(instance, '_static_dates', set())
+    dates.add(get_service_record_date(instance.related_service_record_id))
+    defer_on_commit(refresh_service_daily_static, dates)
+    instance._static_dates = set()
+
+
+@receiver(post_delete, sender=ServiceItem)
+def post_delete_service_item_static(sender, instance, **kwargs):
+    defer_on_commit(refresh_service_daily_static, {get_service_record_date(instance.related_service_record_id)})
+
+
+@receiver(pre_save, sender=InsuranceRecord)
+def pre_save_insurance_record_static(sender, instance, **kwargs):
+    # 签单日期变更时，原来的日期也需要重新汇总；车辆变更时原来车辆的到期提醒也需要更新
+    instance._static_dates = set()
+    instance._due_car_ids = set()
+    if instance.pk:
+        old = InsuranceRecord.objects.filter(pk=instance.pk).values('record_date', 'car_id').first()
+        if old and old['record_date'] != instance.record_date:
+            instance._static_dates.add(old['record_date'])
+        if old:
+            instance._due_car_ids.add(old['car_id'])
+
+
+@receiver(post_save, sender=InsuranceRecord)
+def post_save_insurance_record_static(sender, instance, **kwargs):
+    # 批量导入时只发送 post_save，同一个事务中的日期会合并以后一起汇总
+    dates = getattr(instance, '_static_dates', set())
+    dates.add(instance.record_date)
+    defer_on_commit(refresh_insurance_daily_static, dates)
+    instance._static_dates = set()
+    car_ids = getattr(instance, '_due_car_ids', set())
+    car_ids.add(instance.car_id)
+    defer_on_commit(refresh_car_due_events, car_ids)
+    instance._due_car_ids = set()
+
+
+@receiver(post_delete, sender=InsuranceRecord)
+def post_delete_insurance_record_static(sender, instance, **kwargs):
+    defer_on_commit(refresh_insurance_daily_static, {instance.record_date})
+    defer_on_commit(refresh_car_due_events, {instance.car_id})
+
+
+@receiver(post_save, sender=CarInfo)
+def post_save_car_info_due(sender, instance, **kwargs):
+    defer_on_commit(refresh_car_due_events, {instance.pk})
+
+
+@receiver(post_save, sender=Customer)
+def post_save_customer_due(sender, instance, created, **kwargs):
+    # 客户归属变更时更新到期提醒
+    if not created:
+        CarDueEvent.objects.filter(customer_id=instance.pk).exclude(
+            related_superior_id=instance.related_superior_id
+        ).update(related_superior_id=instance.related_superior_id)
@@ -0,0 +1,153 @@
+from decimal import Decimal
+
+from django.db import connections, transaction
+from django.db.models import AutoField
+
+from car.utils import bulk_create, decimal_value, defer_on_commit
+
+from .models import Customer, PayedRecord, AmountChangeRecord, CreditChangeRecord, CUSTOMER_TOTAL_FIELDS, \
+    get_payed_record_totals, clear_customer_user_detail_cache
+
+
+def bulk_insert(model, objs, batch_size=1000):
+    """
+    批量插入数据，并保证每个对象都有 ID；数据库不支持 bulk_create 返回 ID 时逐条插入
+    :param model: 数据模型
+    :param objs: 数据对象
+    :param batch_size: 每次插入的条数
+    :return: 返回插入的数据对象
+    """
+    objs = list(objs)
+    if not objs:
+        return objs
+    connection = connections[model.objects.db]
+    if connection.features.can_return_ids_from_bulk_insert:
+        return bulk_create(model, objs, batch_size)
+    fields = [f for f in getattr(model, '_meta').concrete_fields if not isinstance(f, AutoField)]
+    with transaction.atomic(using=model.objects.db, savepoint=False):
+        for obj in objs:
+            obj.pk = getattr(model, '_base_manager')._insert([obj], fields=fields, return_id=True)
+            getattr(obj, '_state').adding = False
+            getattr(obj, '_state').db = model.objects.db
+    return objs
+
+
+class PaymentService:
+    """
+    收银记录的批量处理，与 PayedRecord、InsuranceRecord、ServiceRecord 的信号处理结果相同，但不发送信号：
+    收银记录、余额变更和积分变更记录通过 bulk_create 写入，变更后余额和积分按客户顺序累加，
+    客户的余额、积分和累计消费在锁定客户以后通过 bulk_update 一次更新
+    只用于新建的数据，已经存在的数据更新时仍然通过信号处理
+    """
+
+    def __init__(self, batch_size=1000):
+        """
+        :param batch_size: 每次批量写入的条数
+        """
+        self.batch_size = batch_size
+
+    def record_payments(self, payed_records):
+        """
+        批量创建收银记录，同时创建余额变更和积分变更记录，并更新客户的余额、积分和累计消费
+        :param payed_records: 未保存的收银记录
+        :return: 返回保存以后的收银记录
+        """
+        payed_records = list(payed_records)
+        with transaction.atomic():
+            for pr in payed_records:
+                pr.compute_cash_payed()
+            bulk_insert(PayedRecord, payed_records, self.batch_size)
+            amount_records = list()
+            credit_records = list()
+            for pr in payed_records:
+                for model, lookup, defaults in pr.get_ledger_records():
+                    if model is AmountChangeRecord:
+                        amount_records.append(model(**lookup, **defaults))
+                    else:
+                        credit_records.append(model(**lookup, **defaults))
+            self.apply(payed_records, amount_records, credit_records)
+        return payed_records
+
+    def record_insurance_payments(self, insurance_records):
+        """
+        批量创建新的已支付投保记录的收款记录和合伙人收益，与 post_save_insurance_record 相同
+        :param insurance_records: 已保存的投保记录，需要 select_related('car__customer', 'related_partner__related_customer')
+        :return: 返回创建的收款记录
+        """
+        return self.record_source_payments(insurance_records, 'related_insurance_record')
+
+    def record_service_payments(self, service_records):
+        """
+        批量创建新的已支付维修服务的收款记录和合伙人收益，与 post_save_service_record 相同
+        :param service_records: 已保存的维修服务，需要 select_related('car__customer', 'related_partner__related_customer')
+        :return: 返回创建的收款记录
+        """
+        return self.record_source_payments(service_records, 'related_service_record')
+
+    def record_source_payments(self, records, field):
+        """
+        批量创建投保记录或维修服务的收款记录和合伙人收益
+        :param records: 投保记录或维修服务
+        :param field: 收款记录关联的字段名称
+        :return: 返回创建的收款记录
+        """
+        records = [r for r in records if r.is_payed]
+        payed_records = list()
+        partner_amounts = list()
+        for r in records:
+            defaults = r.get_payed_record_defaults()
+            payed_records.append(PayedRecord(**{field: r}, **defaults))
+            partner_amounts.append(r.get_partner_amount_defaults(defaults['customer']))
+        with transaction.atomic():
+            self.record_payments(payed_records)
+            amount_records = list()
+            for pr, partner_amount in zip(payed_records, partner_amounts):
+                if partner_amount:
+                    amount_records.append(AmountChangeRecord(
+                        related_payed_record=pr, change_type=3, **partner_amount))
+            self.apply([], amount_records, [])
+        return payed_records
+
+    def apply(self, payed_records, amount_records, credit_records):
+        """
+        写入余额变更和积分变更记录，并更新相关客户的余额、积分和累计消费
+        新的变更记录 ID 大于客户已有的记录，变更后余额和积分在客户当前的余额和积分上依次累加
+        :param payed_records: 已保存的新收银记录
+        :param amount_records: 未保存的余额变更记录
+        :param credit_records: 未保存的积分变更记录
+        """
+        customer_ids = set(r.customer_id for r in payed_records + amount_records + credit_records if r.customer_id)
+        customers = {
+            c.pk: c for c in Customer.objects.select_for_update().filter(pk__in=customer_ids).only(
+                'pk', 'current_amounts', 'current_credits', 'total_credits', *CUSTOMER_TOTAL_FIELDS)
+        }
+        for r in amount_records:
+            amounts = decimal_value(r.amounts) or Decimal('0')
+            c = customers.get(r.customer_id)
+            if c:
+                c.current_amounts = (c.current_amounts or 0) + amounts
+                r.current_amounts = c.current_amounts
+            else:
+                r.current_amounts = amounts
+        for r in credit_records:
+            credits = int(r.credits or 0)
+            c = customers.get(r.customer_id)
+            if c:
+                c.current_credits = (c.current_credits or 0) + credits
+                c.total_credits = (c.total_credits or 0) + max(credits, 0)
+                r.current_credits = c.current_credits
+            else:
+                r.current_credits = credits
+        for pr in payed_records:
+            c = customers.get(pr.customer_id)
+            if c:
+                totals = get_payed_record_totals(
+                    pr.related_insurance_record_id, pr.related_service_record_id, pr.total_price, pr.total_payed)
+                for f, v in totals.items():
+                    setattr(c, f, (getattr(c, f) or 0) + v)
+        bulk_create(AmountChangeRecord, amount_records, self.batch_size)
+        bulk_create(CreditChangeRecord, credit_records, self.batch_size)
+        Customer.objects.bulk_update(
+            customers.values(), ['current_amounts', 'current_credits', 'total_credits'] + CUSTOMER_TOTAL_FIELDS,
+            batch_size=self.batch_size)
+        defer_on_commit(clear_customer_user_detail_cache, customers.keys())
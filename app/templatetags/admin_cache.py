@@ -0,0 +1,41 @@
+import hashlib
+
+from django import template
+from django.contrib.admin.templatetags.admin_list import date_hierarchy
+from django.contrib.admin.templatetags.base import InclusionAdminNode
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+
+register = template.Library()
+
+
+def cached_date_hierarchy(cl):
+    """
+    缓存后台列表的日期层级，日期层级每次都会执行 MIN/MAX 和按年、月或日的 DISTINCT 查询
+    ModelAdmin.date_hierarchy_cache_timeout 为 None 时不缓存
+    """
+    timeout = getattr(cl.model_admin, 'date_hierarchy_cache_timeout', None)
+    if not cl.date_hierarchy or timeout is None:
+        return date_hierarchy(cl)
+    try:
+        query = str(cl.queryset.query)
+    except EmptyResultSet:
+        return date_hierarchy(cl)
+    # 查询包含筛选条件，链接包含其他的列表参数
+    key = 'admin_date_hierarchy:{0}'.format(hashlib.md5('{0}|{1}|{2}'.format(
+        query, cl.date_hierarchy, sorted(cl.params.items())).encode('utf-8')).hexdigest())
+    result = cache.get(key)
+    if result is None:
+        result = date_hierarchy(cl)
+        cache.set(key, result, timeout)
+    return result
+
+
+@register.tag(name='cached_date_hierarchy')
+def cached_date_hierarchy_tag(parser, token):
+    return InclusionAdminNode(
+        parser, token,
+        func=cached_date_hierarchy,
+        template_name='date_hierarchy.html',
+        takes_context=False,
+    )
@@ -0,0 +1,84 @@
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from app.models import WxUser, Customer, PayedRecord, AmountChangeRecord, CUSTOMER_TOTAL_FIELDS, \
+    rebuild_customer_totals
+from car.utils import ApproximateCountPaginator, estimate_count
+
+
+class PayedRecordAdminTest(TestCase):
+    """
+    后台列表只读取显示的字段，批量操作读取完整的数据
+    """
+
+    def setUp(self):
+        self.admin = WxUser.objects.create_superuser('admin', None, 'password')
+        self.client.force_login(self.admin)
+        self.customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        self.payed_records = [
+            PayedRecord.objects.create(customer=self.customer, total_price=100, total_payed=80),
+            PayedRecord.objects.create(customer=self.customer, total_price=50, total_payed=50),
+        ]
+
+    def test_changelist(self):
+        response = self.client.get('/htgl/app/payedrecord/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['cl'].result_list.query.deferred_loading[0])
+
+    def test_delete_selected(self):
+        response = self.client.post('/htgl/app/payedrecord/', {
+            'action': 'delete_selected',
+            'post': 'yes',
+            '_selected_action': [pr.pk for pr in self.payed_records],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(PayedRecord.objects.exists())
+        self.assertEqual(
+            Customer.objects.filter(pk=self.customer.pk).values_list(*CUSTOMER_TOTAL_FIELDS).get(),
+            (Decimal('0'),) * len(CUSTOMER_TOTAL_FIELDS))
+        self.assertEqual(rebuild_customer_totals([self.customer.pk], dry_run=True), 0)
+
+
+class LargeTableAdminTest(TestCase):
+    """
+    大表的列表缓存日期层级，条数超过阈值时使用估计条数
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.admin = WxUser.objects.create_superuser('admin', None, 'password')
+        self.client.force_login(self.admin)
+        customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        AmountChangeRecord.objects.bulk_create([
+            AmountChangeRecord(customer=customer, amounts=1, current_amounts=i + 1) for i in range(30)])
+
+    def tearDown(self):
+        cache.clear()
+
+    def date_queries(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [q['sql'] for q in ctx.captured_queries if 'DISTINCT' in q['sql'] or 'MIN(' in q['sql']]
+
+    def test_date_hierarchy_cache(self):
+        url = '/htgl/app/amountchangerecord/'
+        self.assertTrue(self.date_queries(url))
+        self.assertFalse(self.date_queries(url))
+        self.assertFalse(self.date_queries(url + '?p=1'))
+        year = AmountChangeRecord.objects.values_list('datetime_created', flat=True).first().year
+        year_url = url + '?datetime_created__year={0}'.format(year)
+        self.assertTrue(self.date_queries(year_url))
+        self.assertFalse(self.date_queries(year_url))
+
+    def test_estimate_count(self):
+        queryset = AmountChangeRecord.objects.order_by('-pk')
+        self.assertEqual(estimate_count(queryset, 50), 30)
+        # SQLite 没有估计条数，超过阈值时执行完整的 COUNT
+        self.assertEqual(estimate_count(queryset, 10), 30)
+        self.assertEqual(ApproximateCountPaginator(queryset, 10, count_threshold=10).count, 30)
+        self.assertEqual(ApproximateCountPaginator(list(queryset), 10).count, 30)
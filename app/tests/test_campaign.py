@@ -0,0 +1,108 @@
+import io
+import json
+from datetime import date, timedelta
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from app.campaigns import run_sms_campaign_chunk
+from app.models import WxUser, Customer, CarInfo, SmsCampaign, MsgSendRecord
+import car.sms_aliyun
+from car.sms_fake import FakeSmsServer
+
+
+class SmsCampaignTest(TransactionTestCase):
+    """
+    到期提醒短信：生成发送记录并由短信队列发送
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeSmsServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.server.fail_count = 0
+        self.server.delay = 0
+        self.settings = override_settings(
+            SMS_API_URL=self.server.url, ACCESS_KEY_ID='id', ACCESS_KEY_SECRET='secret', SMS_RETRY_SECONDS=0,
+            SMS_RATE_LIMIT=0)
+        self.settings.enable()
+        # run_sms_jobs 使用进程内共享的短信客户端，重新按测试的设置创建
+        car.sms_aliyun._sms_client = None
+
+    def tearDown(self):
+        self.settings.disable()
+        car.sms_aliyun._sms_client = None
+
+    def create_campaign(self, template_param, **kwargs):
+        start = date(2026, 11, 1)
+        return SmsCampaign(
+            name='续保提醒', date_type=1, date_start=start, date_end=start + timedelta(days=30), template_code='T2',
+            template_param=template_param, **kwargs)
+
+    def test_send(self):
+        start = date(2026, 11, 1)
+        for i in range(30):
+            customer = Customer.objects.create(
+                name='客户{0}'.format(i), mobile='1380000{0:04d}'.format(i) if i % 10 else None)
+            CarInfo.objects.create(
+                car_number='浙A{0:05d}'.format(i), customer=customer, insurance_date=start + timedelta(days=i % 5))
+        # 不在日期范围内
+        CarInfo.objects.create(
+            car_number='浙B00001', customer=Customer.objects.create(name='客户', mobile='13900000001'),
+            insurance_date=start + timedelta(days=40))
+        campaign = self.create_campaign('{"car": "{car_number}", "date": "{date}", "name": "{name}"}')
+        campaign.full_clean()
+        campaign.save()
+        # 未确认的不发送
+        self.assertEqual(run_sms_campaign_chunk(), (None, 0))
+        campaign.is_confirmed = True
+        campaign.save()
+        call_command('run_sms_jobs', '--once', '--chunk-size', '10', stdout=io.StringIO())
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.status, campaign.total_count, campaign.sent_count), (4, 27, 27))
+        records = MsgSendRecord.objects.filter(campaign=campaign).order_by('pk')
+        self.assertEqual(len(set(records.values_list('mobile', flat=True))), 27)
+        self.assertEqual(set(records.values_list('msg_type', flat=True)), {3})
+        self.assertEqual(json.loads(records.first().paras)['date'], '2026-11-01')
+
+    def test_clean(self):
+        with self.assertRaises(ValidationError):
+            self.create_campaign('{"car": "{nope}"}').full_clean()
+        # 替换以后超过发送记录数据的长度
+        template_param = json.dumps({'name{0}'.format(i): '{name}' for i in range(4)})
+        with self.assertRaises(ValidationError) as ctx:
+            self.create_campaign(template_param).full_clean()
+        self.assertIn('template_param', ctx.exception.message_dict)
+        self.create_campaign('{"name": "{name}", "car": "{car_number}"}').full_clean()
+
+
+class GetCodeViewTest(TestCase):
+    """
+    验证码 5 分钟内只能申请一次，不受其他短信的影响
+    """
+
+    def setUp(self):
+        self.user = WxUser.objects.create_user('user', None, 'password')
+        self.client.force_login(self.user)
+        self.mobile = '13800000001'
+
+    def get_code(self):
+        return self.client.get('/api/get_code/', {'mobile': self.mobile})
+
+    def test_throttle(self):
+        MsgSendRecord.objects.create(mobile=self.mobile, paras='{}', msg_type=3, status=3)
+        self.assertEqual(self.get_code().status_code, 200)
+        self.assertEqual(self.get_code().status_code, 400)
+        self.assertEqual(MsgSendRecord.objects.filter(mobile=self.mobile, msg_type=1).count(), 1)
+        MsgSendRecord.objects.filter(msg_type=1).update(datetime_created=MsgSendRecord.objects.get(
+            msg_type=1).datetime_created - timedelta(days=1))
+        self.assertEqual(self.get_code().status_code, 200)
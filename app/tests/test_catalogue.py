@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.filters import OrderingFilter, SearchFilter
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from app.models import ServicePackageType, ServicePackage
+from app.views_api import ServicePackageListView, StoreInfoListView
+
+
+class CatalogueCacheTest(TransactionTestCase):
+    """
+    使用共享的缓存时缓存目录数据，数据更新以后失效
+    """
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': self.cache_dir}})
+        self.settings.enable()
+        service_type = ServicePackageType.objects.create(name='保养')
+        ServicePackage.objects.create(name='b', price=10, service_type=service_type)
+        ServicePackage.objects.create(name='a', price=5, service_type=service_type)
+        self.service_type = service_type
+        self.client = APIClient()
+
+    def tearDown(self):
+        cache.clear()
+        self.settings.disable()
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache(self):
+        response = self.client.get('/api/service_package_types/')
+        self.assertEqual([p['name'] for p in response.json()[0]['service_packages']], ['a', 'b'])
+        self.assertIn('Last-Modified', response)
+        with CaptureQueriesContext(connection) as ctx:
+            cached = self.client.get('/api/service_package_types/', {'_': '123'})
+        self.assertEqual(len(ctx.captured_queries), 0)
+        self.assertEqual(cached.json(), response.json())
+        etag = response['ETag']
+        self.assertEqual(self.client.get('/api/service_package_types/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        ServicePackage.objects.create(name='c', price=1, service_type=self.service_type)
+        response = self.client.get('/api/service_package_types/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()[0]['service_packages']), 3)
+
+    def test_cache_key(self):
+        factory = APIRequestFactory()
+
+        def cache_key(view_class, params):
+            view = view_class(format_kwarg=None)
+            view.filter_backends = (DjangoFilterBackend, SearchFilter, OrderingFilter)
+            view.request = Request(factory.get('/api/x/', params))
+            return view.get_cache_key(view.request, 1)
+
+        key = cache_key(ServicePackageListView, {'service_type': '1'})
+        self.assertEqual(cache_key(ServicePackageListView, {'service_type': ' 1', 'utm': 'x', '_': '2'}), key)
+        self.assertNotEqual(cache_key(ServicePackageListView, {'service_type': '2'}), key)
+        self.assertNotEqual(cache_key(ServicePackageListView, {'service_type': '1', 'ordering': 'price'}), key)
+        self.assertNotEqual(cache_key(StoreInfoListView, {}), cache_key(ServicePackageListView, {}))
+        self.assertIsNone(cache_key(StoreInfoListView, {'search': '门店'}))
+        self.assertIsNotNone(cache_key(StoreInfoListView, {'search': ''}))
+
+
+class CatalogueLocalCacheTest(TransactionTestCase):
+    """
+    本地内存缓存无法清除其他进程的缓存，不缓存目录数据，只返回 ETag
+    """
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_local_cache(self):
+        ServicePackageType.objects.create(name='保养')
+        client = APIClient()
+        response = client.get('/api/service_package_types/')
+        self.assertNotIn('Last-Modified', response)
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                client.get('/api/service_package_types/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertGreater(len(ctx.captured_queries), 0)
@@ -0,0 +1,152 @@
+import datetime
+import io
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
+from django.test import TestCase, TransactionTestCase
+
+from app.models import StoreInfo, Superior, BelongTo, InsuranceCompany, ServiceRecord, ServiceItem, InsuranceRecord, \
+    ServiceDailyStatic, InsuranceDailyStatic, refresh_service_daily_static
+from car.utils import advisory_lock
+
+
+def service_statics():
+    return sorted(ServiceDailyStatic.objects.values_list(
+        'date', 'related_store_id', 'served_by_id', 'item_count', 'price', 'cost'), key=str)
+
+
+def insurance_statics():
+    return sorted(InsuranceDailyStatic.objects.values_list(
+        'date', 'belong_to_id', 'insurance_company_id', 'record_count', 'total_price', 'profits'), key=str)
+
+
+class DailyStaticTest(TransactionTestCase):
+    """
+    日汇总在事务提交以后更新，每一步的结果和 rebuild_daily_static 重新生成的结果一致
+    """
+
+    def setUp(self):
+        self.store = StoreInfo.objects.create(name='门店一')
+        self.other_store = StoreInfo.objects.create(name='门店二')
+        self.superior = Superior.objects.create(name='员工一')
+        self.reserve_time = datetime.datetime(2020, 6, 1, 10, 0)
+        self.company = InsuranceCompany.objects.create(name='保险公司')
+        self.belong_to = BelongTo.objects.create(name='渠道一')
+
+    def assertConsistent(self):
+        services, insurances = service_statics(), insurance_statics()
+        ServiceDailyStatic.objects.all().delete()
+        InsuranceDailyStatic.objects.all().delete()
+        call_command('rebuild_daily_static', stdout=io.StringIO())
+        self.assertEqual(services, service_statics())
+        self.assertEqual(insurances, insurance_statics())
+
+    def create_service(self):
+        sr = ServiceRecord.objects.create(reserve_time=self.reserve_time, related_store=self.store)
+        with transaction.atomic():
+            for served_by in (self.superior, self.superior, None):
+                ServiceItem.objects.create(
+                    related_service_record=sr, served_by=served_by, item_price=10, item_count=2, cost=5)
+        return sr
+
+    def test_service_append(self):
+        self.create_service()
+        self.assertEqual(service_statics(), [
+            (datetime.date(2020, 6, 1), self.store.pk, self.superior.pk, 2, Decimal('40'), Decimal('10')),
+            (datetime.date(2020, 6, 1), self.store.pk, None, 1, Decimal('20'), Decimal('5')),
+        ])
+        self.assertConsistent()
+
+    def test_service_edit(self):
+        sr = self.create_service()
+        item = ServiceItem.objects.filter(related_service_record=sr, served_by__isnull=True).get()
+        item.served_by = self.superior
+        item.save()
+        self.assertEqual(service_statics(), [
+            (datetime.date(2020, 6, 1), self.store.pk, self.superior.pk, 3, Decimal('60'), Decimal('15')),
+        ])
+        self.assertConsistent()
+
+    def test_service_move(self):
+        sr = self.create_service()
+        sr.reserve_time = self.reserve_time - datetime.timedelta(days=3)
+        sr.related_store = self.other_store
+        sr.save()
+        self.assertEqual(
+            set(ServiceDailyStatic.objects.values_list('date', 'related_store_id')),
+            {(datetime.date(2020, 5, 29), self.other_store.pk)})
+        self.assertConsistent()
+
+    def test_service_delete(self):
+        sr = self.create_service()
+        ServiceItem.objects.filter(related_service_record=sr, served_by=self.superior).first().delete()
+        self.assertEqual(ServiceDailyStatic.objects.get(served_by=self.superior).item_count, 1)
+        self.assertConsistent()
+        sr.delete()
+        self.assertFalse(ServiceDailyStatic.objects.exists())
+
+    def test_service_refresh_twice(self):
+        self.create_service()
+        statics = service_statics()
+        refresh_service_daily_static([datetime.date(2020, 6, 1)])
+        refresh_service_daily_static([datetime.date(2020, 6, 1), datetime.date(2020, 6, 2)])
+        self.assertEqual(service_statics(), statics)
+
+    def test_advisory_lock_requires_transaction(self):
+        with self.assertRaises(transaction.TransactionManagementError):
+            advisory_lock(ServiceDailyStatic._meta.db_table, [1])
+        with transaction.atomic():
+            advisory_lock(ServiceDailyStatic._meta.db_table, [1])
+
+    def test_insurance(self):
+        r = InsuranceRecord.objects.create(
+            record_date=datetime.date(2020, 1, 1), total_price=100, profits=10,
+            insurance_company=self.company, belong_to=self.belong_to)
+        InsuranceRecord.objects.create(
+            record_date=datetime.date(2020, 1, 1), total_price=50, profits=5,
+            insurance_company=self.company, belong_to=self.belong_to)
+        self.assertEqual(insurance_statics(), [
+            (datetime.date(2020, 1, 1), self.belong_to.pk, self.company.pk, 2, Decimal('150'), Decimal('15')),
+        ])
+        self.assertConsistent()
+        r.record_date = datetime.date(2020, 1, 2)
+        r.belong_to = None
+        r.save()
+        self.assertEqual(InsuranceDailyStatic.objects.count(), 2)
+        self.assertConsistent()
+        r.delete()
+        self.assertEqual(insurance_statics(), [
+            (datetime.date(2020, 1, 1), self.belong_to.pk, self.company.pk, 1, Decimal('50'), Decimal('5')),
+        ])
+        self.assertConsistent()
+
+    def test_rebuild_chunks(self):
+        for day in range(1, 6):
+            self.reserve_time = datetime.datetime(2020, 6, day, 10, 0)
+            self.create_service()
+            InsuranceRecord.objects.create(
+                record_date=datetime.date(2020, 1, day), total_price=100, profits=10,
+                insurance_company=self.company, belong_to=self.belong_to)
+        services, insurances = service_statics(), insurance_statics()
+        ServiceDailyStatic.objects.all().delete()
+        InsuranceDailyStatic.objects.all().delete()
+        # 每 2 天一个事务
+        out = io.StringIO()
+        call_command('rebuild_daily_static', '--chunk-size', '2', stdout=out)
+        self.assertEqual(services, service_statics())
+        self.assertEqual(insurances, insurance_statics())
+        self.assertEqual(out.getvalue().splitlines(), [
+            '维修日汇总：2/5 天', '维修日汇总：4/5 天', '维修日汇总：5/5 天',
+            '保险日汇总：2/5 天', '保险日汇总：4/5 天', '保险日汇总：5/5 天',
+        ])
+
+
+class DailyStaticConstraintTest(TestCase):
+
+    def test_unique(self):
+        store = StoreInfo.objects.create(name='门店一')
+        superior = Superior.objects.create(name='员工一')
+        ServiceDailyStatic.objects.create(date=datetime.date(2020, 6, 1), related_store=store, served_by=superior)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ServiceDailyStatic.objects.create(date=datetime.date(2020, 6, 1), related_store=store, served_by=superior)
@@ -0,0 +1,92 @@
+import io
+from datetime import date, timedelta
+
+from django.core.management import call_command
+from django.test import TransactionTestCase
+
+from app.models import WxUser, Superior, StoreInfo, Customer, CarInfo, InsuranceRecord, ServiceRecord, \
+    CarDueEvent, next_year
+
+
+class CarDueEventTest(TransactionTestCase):
+    """
+    保存车辆、保单和维修服务以后更新的到期提醒与 rebuild_car_due_events 重新生成的结果一致
+    到期提醒在事务提交以后更新，需要使用 TransactionTestCase；到期提醒页面配置了只读数据库时读取 replica
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.today = date.today()
+        self.superior = Superior.objects.create(name='归属一')
+        self.store = StoreInfo.objects.create(name='门店一')
+        self.customer = Customer.objects.create(name='客户一', mobile='13800000001', related_superior=self.superior)
+        self.car = CarInfo.objects.create(
+            car_number='浙A00001', customer=self.customer, insurance_date=self.today + timedelta(days=5),
+            annual_inspection_date=self.today + timedelta(days=50))
+
+    def snapshot(self):
+        return sorted(CarDueEvent.objects.values_list(
+            'car_id', 'due_type', 'due_date', 'customer_id', 'related_superior_id', 'related_store_id'))
+
+    def assertRebuilt(self):
+        """
+        检查当前的到期提醒与重新生成的一致
+        """
+        events = self.snapshot()
+        CarDueEvent.objects.all().delete()
+        call_command('rebuild_car_due_events', stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), events)
+        return events
+
+    def test_refresh(self):
+        events = self.assertRebuilt()
+        self.assertEqual([(e[1], e[2]) for e in events], [
+            (1, self.today + timedelta(days=5)), (2, self.today + timedelta(days=50))])
+        # 新保单：开始日期加一年
+        policy = InsuranceRecord.objects.create(
+            car=self.car, record_date=self.today, insurance_date=self.today + timedelta(days=3), is_payed=False)
+        self.assertEqual(CarDueEvent.objects.get(car=self.car, due_type=1).due_date,
+                         next_year(self.today + timedelta(days=3)))
+        self.assertRebuilt()
+        # 最近一次维修服务的门店
+        ServiceRecord.objects.create(car=self.car, related_store=self.store)
+        self.assertEqual(set(CarDueEvent.objects.values_list('related_store_id', flat=True)), {self.store.pk})
+        self.assertRebuilt()
+        # 客户归属
+        superior = Superior.objects.create(name='归属二')
+        self.customer.related_superior = superior
+        self.customer.save()
+        self.assertEqual(set(CarDueEvent.objects.values_list('related_superior_id', flat=True)), {superior.pk})
+        self.assertRebuilt()
+        policy.delete()
+        self.assertEqual(CarDueEvent.objects.get(car=self.car, due_type=1).due_date, self.today + timedelta(days=5))
+        self.assertRebuilt()
+        # 停用的车辆不提醒
+        self.car.is_active = False
+        self.car.save()
+        self.assertEqual(self.assertRebuilt(), [])
+
+    def test_refresh_twice(self):
+        # 重复更新不违反 (car, due_type) 唯一约束
+        events = self.snapshot()
+        call_command('rebuild_car_due_events', '--chunk-size', '1', stdout=io.StringIO())
+        call_command('rebuild_car_due_events', stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), events)
+
+    def test_next_year(self):
+        self.assertEqual(next_year(date(2024, 2, 29)), date(2025, 2, 28))
+        self.assertEqual(next_year(date(2024, 3, 1)), date(2025, 3, 1))
+
+    def test_view(self):
+        self.client.force_login(WxUser.objects.create_superuser('admin', None, 'password'))
+        response = self.client.get('/page/car_due_events/', {'days': 10, 'store': self.store.pk})
+        self.assertContains(response, '共 0 条')
+        ServiceRecord.objects.create(car=self.car, related_store=self.store)
+        response = self.client.get('/page/car_due_events/', {'days': 10, 'store': self.store.pk})
+        self.assertContains(response, '浙A00001')
+        self.assertContains(response, '10 天内到期，共 1 条')
+        response = self.client.get('/page/car_due_events/', {'days': 'x', 'due_type': '2'})
+        self.assertContains(response, '30 天内到期，共 0 条')
+        # 天数过大时按最大天数查询
+        response = self.client.get('/page/car_due_events/', {'days': '999999999'})
+        self.assertContains(response, '3650 天内到期，共 2 条')
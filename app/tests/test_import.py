@@ -0,0 +1,104 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from django.test import TestCase, override_settings
+
+from app.jobs import run_import_job
+from app.models import InsuranceRecord, InsuranceRecordUpload, PayedRecord
+from car.utils import date_series, date_value
+
+
+class DateSeriesTest(TestCase):
+    """
+    date_series 对整列的处理结果和 date_value 逐个处理的结果一致，任何类型的列都不会出错
+    """
+
+    def assertSameAsDateValue(self, series):
+        expected = list()
+        for v in series:
+            d = date_value(v)
+            expected.append(datetime.datetime.strptime(d, '%Y-%m-%d').date() if d else None)
+        self.assertEqual(list(date_series(series)), expected)
+
+    def test_str(self):
+        series = pd.Series(['2020.1.5', '2020/01/06', '2020-1-7', '2020-01-08 10:00', 'abc', ''])
+        self.assertEqual(list(date_series(series)), [
+            datetime.date(2020, 1, 5), datetime.date(2020, 1, 6), datetime.date(2020, 1, 7), None, None, None])
+        self.assertSameAsDateValue(series)
+
+    def test_numeric(self):
+        # Excel 中保存为序列号的日期列
+        self.assertEqual(list(date_series(pd.Series([43835, 43836]))), [None, None])
+        self.assertEqual(list(date_series(pd.Series([1.5, np.nan]))), [None, None])
+        self.assertEqual(list(date_series(pd.Series([np.nan, np.nan]))), [None, None])
+        self.assertSameAsDateValue(pd.Series([43835, 43836]))
+
+    def test_datetime(self):
+        series = pd.Series(pd.to_datetime(['2020-01-05 08:30', None]))
+        self.assertEqual(list(date_series(series)), [datetime.date(2020, 1, 5), None])
+
+    def test_mixed(self):
+        series = pd.Series([
+            '2020.1.5', 43835, datetime.datetime(2020, 2, 3, 4, 5), None, np.nan, 1.5, pd.Timestamp('2021-03-04'), ''
+        ], dtype=object)
+        self.assertEqual(list(date_series(series)), [
+            datetime.date(2020, 1, 5), None, datetime.date(2020, 2, 3), None, None, None, datetime.date(2021, 3, 4),
+            None])
+        self.assertSameAsDateValue(series)
+
+    def test_empty(self):
+        self.assertEqual(list(date_series(pd.Series([], dtype=object))), [])
+
+
+class InsuranceRecordImportTest(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def make_upload(self, name, record_dates):
+        rows = list()
+        for i, record_date in enumerate(record_dates):
+            rows.append({
+                '车牌号': '浙A{0:05d}'.format(i % 4), '被保险人名称': '张三{0}'.format(i % 3),
+                '手机号': '1380000{0:04d}'.format(i % 3), '签单日期': record_date, '含税总保费': 1000 + i,
+                '车船税': '', '已返费率': 0.12345, '已返金额': 100, '保险公司返点': 0.2, '返费金额': 10.555,
+                '利润': 50, '保险出单公司': '人保', '归属渠道': '渠道{0}'.format(i % 2),
+            })
+        pd.DataFrame(rows).to_excel(os.path.join(self.media_root, name), index=False)
+        upload = InsuranceRecordUpload(file=name)
+        upload.save()
+        return upload
+
+    def test_import(self):
+        upload = self.make_upload('a.xlsx', ['2020.1.{0}'.format(i + 1) for i in range(7)])
+        self.assertTrue(run_import_job(upload))
+        upload.refresh_from_db()
+        self.assertEqual((upload.status, upload.is_processed), (3, True))
+        self.assertEqual((upload.total_count, upload.created_count, upload.updated_count), (7, 7, 0))
+        self.assertEqual(InsuranceRecord.objects.filter(record_date=datetime.date(2020, 1, 3)).count(), 1)
+        self.assertEqual(PayedRecord.objects.count(), 7)
+        # 同一个文件重复导入时只更新，不会重复创建（备注中包含文件名）
+        upload = InsuranceRecordUpload(file='a.xlsx')
+        upload.save()
+        self.assertTrue(run_import_job(upload))
+        upload.refresh_from_db()
+        self.assertEqual((upload.created_count, upload.updated_count), (0, 7))
+        self.assertEqual(InsuranceRecord.objects.count(), 7)
+
+    def test_numeric_date_column(self):
+        # 日期列保存为 Excel 序列号时无法识别日期，但不影响整个文件的导入
+        upload = self.make_upload('c.xlsx', [43835 + i for i in range(5)])
+        self.assertTrue(run_import_job(upload))
+        upload.refresh_from_db()
+        self.assertEqual((upload.status, upload.total_count), (3, 5))
+        self.assertEqual(InsuranceRecord.objects.filter(record_date__isnull=True).count(), upload.created_count)
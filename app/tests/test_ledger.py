@@ -0,0 +1,216 @@
+from decimal import Decimal
+
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase
+
+from app.models import Customer, PayedRecord, AmountChangeRecord, CreditChangeRecord, rebuild_amount_ledgers, \
+    rebuild_credit_ledgers
+
+
+class AmountLedgerTest(TestCase):
+    """
+    余额变更记录的增量更新，每一步的结果和 rebuild_amount_ledgers 重新计算的结果一致
+    """
+
+    def setUp(self):
+        self.customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        self.other = Customer.objects.create(name='客户二', mobile='13800000002')
+
+    def amounts(self, customer):
+        return list(AmountChangeRecord.objects.filter(
+            customer=customer).order_by('pk').values_list('current_amounts', flat=True))
+
+    def current_amounts(self, customer):
+        return Customer.objects.get(pk=customer.pk).current_amounts
+
+    def assertConsistent(self):
+        self.assertEqual(rebuild_amount_ledgers([self.customer.pk, self.other.pk], dry_run=True), (0, 0))
+
+    def test_append(self):
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=100)
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=Decimal('-30.50'))
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=10)
+        self.assertEqual(self.amounts(self.customer), [Decimal('100'), Decimal('69.50'), Decimal('79.50')])
+        self.assertEqual(self.current_amounts(self.customer), Decimal('79.50'))
+        self.assertConsistent()
+
+    def test_edit(self):
+        r1 = AmountChangeRecord.objects.create(customer=self.customer, amounts=100)
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=Decimal('-30.50'))
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=10)
+        r1.amounts = 50
+        r1.save()
+        self.assertEqual(self.amounts(self.customer), [Decimal('50'), Decimal('19.50'), Decimal('29.50')])
+        self.assertEqual(self.current_amounts(self.customer), Decimal('29.50'))
+        self.assertConsistent()
+
+    def test_delete(self):
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=100)
+        r2 = AmountChangeRecord.objects.create(customer=self.customer, amounts=Decimal('-30.50'))
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=10)
+        r2.delete()
+        self.assertEqual(self.amounts(self.customer), [Decimal('100'), Decimal('110')])
+        self.assertEqual(self.current_amounts(self.customer), Decimal('110'))
+        self.assertConsistent()
+
+    def test_reassign_customer(self):
+        r1 = AmountChangeRecord.objects.create(customer=self.customer, amounts=100)
+        AmountChangeRecord.objects.create(customer=self.other, amounts=20)
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=10)
+        r1.customer = self.other
+        r1.save()
+        self.assertEqual(self.amounts(self.customer), [Decimal('10')])
+        # 余额按记录 ID 的顺序累加，转移过来的记录 ID 更小，排在前面
+        self.assertEqual(self.amounts(self.other), [Decimal('100'), Decimal('120')])
+        self.assertEqual(self.current_amounts(self.customer), Decimal('10'))
+        self.assertEqual(self.current_amounts(self.other), Decimal('120'))
+        self.assertConsistent()
+
+    def test_mixed_operations(self):
+        records = list()
+        for i, amounts in enumerate([100, -20, 35, -5, 60, -80, 12]):
+            customer = self.customer if i % 3 else self.other
+            records.append(AmountChangeRecord.objects.create(customer=customer, amounts=amounts))
+        records[1].amounts = 40
+        records[1].save()
+        records[3].customer = self.other
+        records[3].save()
+        records[4].delete()
+        records[0].customer = self.customer
+        records[0].amounts = Decimal('0.01')
+        records[0].save()
+        self.assertConsistent()
+
+    def test_rebuild(self):
+        r1 = AmountChangeRecord.objects.create(customer=self.customer, amounts=100)
+        r2 = AmountChangeRecord.objects.create(customer=self.customer, amounts=-40)
+        AmountChangeRecord.objects.filter(pk=r2.pk).update(current_amounts=999)
+        Customer.objects.filter(pk=self.customer.pk).update(current_amounts=5)
+        self.assertEqual(rebuild_amount_ledgers([self.customer.pk], dry_run=True), (1, 1))
+        self.assertEqual(rebuild_amount_ledgers([self.customer.pk]), (1, 1))
+        self.assertEqual(self.amounts(self.customer), [Decimal('100'), Decimal('60')])
+        self.assertEqual(self.current_amounts(self.customer), Decimal('60'))
+        r1.refresh_from_db()
+        self.assertEqual(r1.current_amounts, Decimal('100'))
+        self.assertConsistent()
+
+
+class CreditLedgerTest(TestCase):
+    """
+    积分变更记录的增量更新，累计积分只统计获得的积分，每一步的结果和 rebuild_credit_ledgers 一致
+    """
+
+    def setUp(self):
+        self.customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        self.other = Customer.objects.create(name='客户二', mobile='13800000002')
+
+    def credits(self, customer):
+        return list(CreditChangeRecord.objects.filter(
+            customer=customer).order_by('pk').values_list('current_credits', flat=True))
+
+    def customer_credits(self, customer):
+        return Customer.objects.filter(pk=customer.pk).values_list('current_credits', 'total_credits').get()
+
+    def assertConsistent(self):
+        self.assertEqual(rebuild_credit_ledgers([self.customer.pk, self.other.pk], dry_run=True), (0, 0))
+
+    def test_append(self):
+        CreditChangeRecord.objects.create(customer=self.customer, credits=10)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=-4)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=5)
+        self.assertEqual(self.credits(self.customer), [10, 6, 11])
+        self.assertEqual(self.customer_credits(self.customer), (11, 15))
+        self.assertConsistent()
+
+    def test_edit(self):
+        r1 = CreditChangeRecord.objects.create(customer=self.customer, credits=10)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=-4)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=5)
+        r1.credits = -2
+        r1.save()
+        self.assertEqual(self.credits(self.customer), [-2, -6, -1])
+        self.assertEqual(self.customer_credits(self.customer), (-1, 5))
+        self.assertConsistent()
+
+    def test_delete(self):
+        CreditChangeRecord.objects.create(customer=self.customer, credits=10)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=-4)
+        r3 = CreditChangeRecord.objects.create(customer=self.customer, credits=5)
+        r3.delete()
+        self.assertEqual(self.credits(self.customer), [10, 6])
+        self.assertEqual(self.customer_credits(self.customer), (6, 10))
+        self.assertConsistent()
+
+    def test_reassign_customer(self):
+        r1 = CreditChangeRecord.objects.create(customer=self.customer, credits=10)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=-4)
+        CreditChangeRecord.objects.create(customer=self.other, credits=3)
+        r1.customer = self.other
+        r1.save()
+        self.assertEqual(self.credits(self.customer), [-4])
+        self.assertEqual(self.credits(self.other), [10, 13])
+        self.assertEqual(self.customer_credits(self.customer), (-4, 0))
+        self.assertEqual(self.customer_credits(self.other), (13, 13))
+        self.assertConsistent()
+
+    def test_payed_record(self):
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=100)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=100)
+        payed_record = PayedRecord.objects.create(
+            customer=self.customer, total_price=100, total_payed=100, amount_payed=Decimal('20.50'), credit_payed=10)
+        customer = Customer.objects.get(pk=self.customer.pk)
+        self.assertEqual(customer.current_amounts, Decimal('79.50'))
+        self.assertEqual((customer.current_credits, customer.total_credits), (93, 103))
+        payed_record.amount_payed = 10
+        payed_record.save()
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk).current_amounts, Decimal('90'))
+        self.assertConsistent()
+        self.assertEqual(rebuild_amount_ledgers([self.customer.pk], dry_run=True), (0, 0))
+
+    def test_rebuild(self):
+        CreditChangeRecord.objects.create(customer=self.customer, credits=10)
+        r2 = CreditChangeRecord.objects.create(customer=self.customer, credits=-4)
+        CreditChangeRecord.objects.filter(pk=r2.pk).update(current_credits=0)
+        Customer.objects.filter(pk=self.customer.pk).update(current_credits=0, total_credits=0)
+        self.assertEqual(rebuild_credit_ledgers([self.customer.pk]), (1, 1))
+        self.assertEqual(self.credits(self.customer), [10, 6])
+        self.assertEqual(self.customer_credits(self.customer), (6, 10))
+
+
+class FailedSaveTest(TransactionTestCase):
+    """
+    自动提交模式下保存失败时，客户的余额、积分和之后记录的变更后余额、积分一起回滚
+    """
+
+    def setUp(self):
+        self.customer = Customer.objects.create(name='客户一', mobile='13800000001')
+
+    def test_amount(self):
+        r1 = AmountChangeRecord.objects.create(customer=self.customer, amounts=100)
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=10)
+        # change_type 不能为空，插入或更新时数据库报错
+        with self.assertRaises(IntegrityError):
+            AmountChangeRecord.objects.create(customer=self.customer, amounts=50, change_type=None)
+        r1.amounts = 20
+        r1.change_type = None
+        with self.assertRaises(IntegrityError):
+            r1.save()
+        self.assertEqual(list(AmountChangeRecord.objects.filter(customer=self.customer).order_by('pk').values_list(
+            'current_amounts', flat=True)), [Decimal('100'), Decimal('110')])
+        self.assertEqual(Customer.objects.get(pk=self.customer.pk).current_amounts, Decimal('110'))
+        self.assertEqual(rebuild_amount_ledgers([self.customer.pk], dry_run=True), (0, 0))
+
+    def test_credit(self):
+        r1 = CreditChangeRecord.objects.create(customer=self.customer, credits=100)
+        CreditChangeRecord.objects.create(customer=self.customer, credits=-10)
+        with self.assertRaises(IntegrityError):
+            CreditChangeRecord.objects.create(customer=self.customer, credits=50, change_type=None)
+        r1.credits = 20
+        r1.change_type = None
+        with self.assertRaises(IntegrityError):
+            r1.save()
+        self.assertEqual(list(CreditChangeRecord.objects.filter(customer=self.customer).order_by('pk').values_list(
+            'current_credits', flat=True)), [100, 90])
+        self.assertEqual(Customer.objects.filter(pk=self.customer.pk).values_list(
+            'current_credits', 'total_credits').get(), (90, 100))
+        self.assertEqual(rebuild_credit_ledgers([self.customer.pk], dry_run=True), (0, 0))
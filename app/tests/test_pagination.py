@@ -0,0 +1,137 @@
+from django.test import TestCase
+from rest_framework.exceptions import NotFound
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+
+from app.models import Customer, WxUser, AmountChangeRecord, CreditChangeRecord
+from car.utils import NormalResultsSetPagination
+
+
+class CursorPaginationTest(TestCase):
+    """
+    带有 cursor 参数时按 ID 倒序游标分页，不带时按页码分页
+    """
+
+    def setUp(self):
+        for i in range(25):
+            Customer.objects.create(name='客户{0}'.format(i))
+        self.factory = APIRequestFactory()
+
+    def paginate(self, params):
+        paginator = NormalResultsSetPagination()
+        results = paginator.paginate_queryset(Customer.objects.all(), Request(self.factory.get('/api/x/', params)))
+        return results, paginator.get_paginated_response([c.pk for c in results]).data
+
+    def test_cursor(self):
+        pks = list()
+        cursor = ''
+        while True:
+            results, data = self.paginate({'cursor': cursor, 'page_size': 10})
+            pks.extend(data['results'])
+            self.assertIsNone(data['count'])
+            self.assertEqual(data['length'], len(results))
+            if data['next_cursor'] is None:
+                self.assertIsNone(data['next'])
+                break
+            self.assertEqual(data['next_cursor'], str(results[-1].pk))
+            self.assertIn('cursor={0}'.format(data['next_cursor']), data['next'])
+            cursor = data['next_cursor']
+        self.assertEqual(len(pks), 25)
+        self.assertEqual(pks, sorted(Customer.objects.values_list('pk', flat=True), reverse=True))
+
+    def test_cursor_page_size(self):
+        results, data = self.paginate({'cursor': '', 'page_size': 100})
+        self.assertEqual(len(results), 20)
+        self.assertEqual(data['page_size'], 20)
+        results, data = self.paginate({'cursor': '', 'page_size': 25})
+        self.assertEqual(len(results), 20)
+        self.assertIsNotNone(data['next_cursor'])
+
+    def test_last_page(self):
+        pks = sorted(Customer.objects.values_list('pk', flat=True))
+        results, data = self.paginate({'cursor': str(pks[5])})
+        self.assertEqual([c.pk for c in results], pks[4::-1])
+        self.assertIsNone(data['next_cursor'])
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(NotFound):
+            self.paginate({'cursor': 'abc'})
+
+    def test_page(self):
+        results, data = self.paginate({'page': 2})
+        self.assertEqual(len(results), 10)
+        self.assertEqual((data['count'], data['page'], data['num_pages'], data['next_page']), (25, 2, 3, 3))
+        self.assertNotIn('next_cursor', data)
+
+
+class UserSummaryCursorTest(TestCase):
+    """
+    用户信息摘要返回的游标可以继续获取余额变更记录
+    """
+
+    def setUp(self):
+        self.user = WxUser.objects.create(username='u1', mobile='13800000001')
+        self.customer = Customer.objects.get(mobile='13800000001')
+        for i in range(15):
+            AmountChangeRecord.objects.create(customer=self.customer, amounts=i + 1)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_summary_cursor(self):
+        data = self.client.get('/api/user_info/', {'summary': 1}).data
+        self.assertEqual(len(data['amount_records']), 10)
+        self.assertIsNone(data['credit_records_cursor'])
+        pks = [r['pk'] for r in data['amount_records']]
+        data = self.client.get('/api/amount_change_records/', {'cursor': data['amount_records_cursor']}).data
+        self.assertIsNone(data['next_cursor'])
+        pks.extend(r['id'] for r in data['results'])
+        self.assertEqual(pks, list(AmountChangeRecord.objects.order_by('-pk').values_list('pk', flat=True)))
+
+    def test_full(self):
+        data = self.client.get('/api/user_info/').data
+        self.assertEqual(len(data['amount_records']), 15)
+        self.assertNotIn('amount_records_cursor', data)
+
+
+class ChangeRecordListCursorTest(TestCase):
+    """
+    余额和积分变更记录接口的游标分页只返回当前用户关联客户的记录
+    """
+
+    def setUp(self):
+        self.user = WxUser.objects.create(username='u1', mobile='13800000001')
+        other_user = WxUser.objects.create(username='u2', mobile='13800000002')
+        customer = Customer.objects.get(mobile='13800000001')
+        second = Customer.objects.create(name='客户二', mobile='13800000003')
+        second.related_user.add(self.user)
+        other = Customer.objects.get(mobile='13800000002')
+        for i in range(8):
+            for c in (customer, second, other):
+                AmountChangeRecord.objects.create(customer=c, amounts=i + 1)
+                CreditChangeRecord.objects.create(customer=c, credits=i + 1)
+        self.customer_ids = [customer.pk, second.pk]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertCursorPages(self, url, model):
+        pks = list()
+        cursor = ''
+        pages = 0
+        while cursor is not None:
+            data = self.client.get(url, {'cursor': cursor, 'page_size': 5}).data
+            pks.extend(r['id'] for r in data['results'])
+            cursor = data['next_cursor']
+            pages += 1
+        self.assertEqual(pages, 4)
+        self.assertEqual(pks, list(model.objects.filter(
+            customer_id__in=self.customer_ids).order_by('-pk').values_list('pk', flat=True)))
+
+    def test_amount_change_records(self):
+        self.assertCursorPages('/api/amount_change_records/', AmountChangeRecord)
+
+    def test_credit_change_records(self):
+        self.assertCursorPages('/api/credit_change_records/', CreditChangeRecord)
+
+    def test_anonymous(self):
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get('/api/amount_change_records/', {'cursor': ''}).status_code, 401)
@@ -0,0 +1,120 @@
+from unittest import skipUnless
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TransactionTestCase, override_settings
+
+from app.models import WxUser, Customer, AmountChangeRecord
+from car.routers import STICKY_COOKIE, read_from_replica, is_sticky, mark_sticky
+
+
+class QueryCounter:
+    """
+    统计数据库连接执行的查询数
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@skipUnless('replica' in settings.DATABASES, '需要在 DATABASES 中配置 replica，测试时设置 TEST 的 MIRROR 为 default')
+@override_settings(
+    DATABASE_ROUTERS=['car.routers.ReplicaRouter'],
+    MIDDLEWARE=settings.MIDDLEWARE + ['car.middlewares.ReplicaStickyMiddleware'],
+    REPLICA_STICKY_SECONDS=10,
+)
+class ReplicaRouterTest(TransactionTestCase):
+    """
+    只读数据库的路由：读操作使用从库，写操作、事务中的读操作和最近有写操作的客户端使用主库
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.admin = WxUser.objects.create_superuser('admin', None, 'password')
+        self.client.force_login(self.admin)
+        self.customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        AmountChangeRecord.objects.create(customer=self.customer, amounts=1)
+
+    def tearDown(self):
+        cache.clear()
+
+    def count_queries(self, func):
+        """
+        :return: 返回 (主库查询数, 从库查询数, func 的返回值)
+        """
+        default, replica = QueryCounter(), QueryCounter()
+        with connections['default'].execute_wrapper(default), connections['replica'].execute_wrapper(replica):
+            result = func()
+        return default.count, replica.count, result
+
+    def test_read_outside_context(self):
+        default, replica, _ = self.count_queries(lambda: list(Customer.objects.all()))
+        self.assertEqual((default, replica), (1, 0))
+
+    def test_read_in_context(self):
+        def read():
+            with read_from_replica():
+                return Customer.objects.get(pk=self.customer.pk)
+
+        default, replica, customer = self.count_queries(read)
+        self.assertEqual((default, replica), (0, 1))
+        self.assertEqual(getattr(customer, '_state').db, 'replica')
+
+    def test_write_routing(self):
+        def write():
+            with read_from_replica():
+                customer = Customer.objects.get(pk=self.customer.pk)
+                customer.name = '客户二'
+                customer.save(update_fields=['name'])
+            return customer
+
+        default, replica, customer = self.count_queries(write)
+        self.assertEqual(replica, 1)
+        self.assertGreater(default, 0)
+        self.assertEqual(getattr(customer, '_state').db, 'default')
+        self.assertEqual(Customer.objects.using('default').get(pk=self.customer.pk).name, '客户二')
+
+    def test_atomic_block(self):
+        def read():
+            with read_from_replica(), transaction.atomic():
+                return list(Customer.objects.all())
+
+        default, replica, _ = self.count_queries(read)
+        self.assertEqual(replica, 0)
+        self.assertGreater(default, 0)
+
+    def test_sticky_after_write(self):
+        default, replica, response = self.count_queries(lambda: self.client.get('/page/service_static/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(replica, 0)
+        # 导出 Excel 使用只读数据库，POST 请求以后同一个客户端读主库
+        default, replica, response = self.count_queries(lambda: self.client.post('/htgl/app/amountchangerecord/', {
+            'action': 'save_execl',
+            '_selected_action': list(AmountChangeRecord.objects.values_list('pk', flat=True)),
+        }))
+        self.assertGreater(replica, 0)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+        default, replica, response = self.count_queries(lambda: self.client.get('/page/service_static/'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(replica, 0)
+
+    def test_sticky_user(self):
+        factory = RequestFactory()
+        request = factory.post('/')
+        request.user = self.admin
+        mark_sticky(request, HttpResponse())
+        # 同一个用户的其他客户端没有 Cookie，按用户判断
+        request = factory.get('/')
+        request.user = self.admin
+        self.assertTrue(is_sticky(request))
+        request = factory.get('/')
+        request.user = AnonymousUser()
+        self.assertFalse(is_sticky(request))
@@ -0,0 +1,104 @@
+from decimal import Decimal
+
+from django.test import TestCase
+
+from app.models import Customer, Partner, CarInfo, InsuranceRecord, ServiceRecord, PayedRecord, AmountChangeRecord, \
+    CreditChangeRecord, rebuild_amount_ledgers, rebuild_credit_ledgers, rebuild_customer_totals
+from app.services import PaymentService
+
+
+def snapshot():
+    """
+    客户、余额变更、积分变更和收银记录的数据，不包含 ID；
+    批量处理时合伙人收益在全部收银记录以后写入，变更记录只需要每个客户的顺序相同
+    """
+    return (
+        list(Customer.objects.order_by('name').values_list(
+            'name', 'current_amounts', 'current_credits', 'total_credits', 'total_consumption',
+            'total_consumption_1', 'total_consumption_2', 'total_price', 'total_payed')),
+        list(AmountChangeRecord.objects.order_by('customer__name', 'pk').values_list(
+            'customer__name', 'change_type', 'amounts', 'current_amounts', 'notes')),
+        list(CreditChangeRecord.objects.order_by('customer__name', 'pk').values_list(
+            'customer__name', 'change_type', 'credits', 'current_credits', 'notes')),
+        list(PayedRecord.objects.order_by('pk').values_list(
+            'customer__name', 'total_price', 'total_payed', 'cash_payed', 'credit_change', 'notes')),
+    )
+
+
+class PaymentServiceTest(TestCase):
+    """
+    PaymentService 批量处理的结果和逐条保存时信号处理的结果一致
+    """
+
+    def build(self):
+        partner_customer = Customer.objects.create(name='合伙人', mobile='13800000000')
+        partner = Partner.objects.create(name='合伙人', related_customer=partner_customer)
+        customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        other = Customer.objects.create(name='客户二', mobile='13800000002')
+        AmountChangeRecord.objects.create(customer=customer, amounts=100)
+        car = CarInfo.objects.create(car_number='浙A00001', customer=customer)
+        other_car = CarInfo.objects.create(car_number='浙A00002', customer=other)
+        return partner, car, other_car
+
+    def clear(self):
+        for model in (AmountChangeRecord, CreditChangeRecord, PayedRecord, InsuranceRecord, ServiceRecord,
+                      CarInfo, Partner, Customer):
+            model.objects.all().delete()
+
+    def assertConsistent(self):
+        customer_ids = list(Customer.objects.values_list('pk', flat=True))
+        self.assertEqual(rebuild_amount_ledgers(customer_ids, dry_run=True), (0, 0))
+        self.assertEqual(rebuild_credit_ledgers(customer_ids, dry_run=True), (0, 0))
+        self.assertEqual(rebuild_customer_totals(customer_ids, dry_run=True), 0)
+
+    def test_insurance_payments(self):
+        def records(partner, car, other_car):
+            return [
+                dict(car=car, total_price=1000, payback_amount=100, is_payed=True, related_partner=partner),
+                dict(car=other_car, total_price=500, is_payed=True),
+                dict(car=car, total_price=300, is_payed=True),
+                dict(car=car, total_price=200, is_payed=False),
+            ]
+
+        for r in records(*self.build()):
+            InsuranceRecord.objects.create(**r)
+        expected = snapshot()
+        self.clear()
+        InsuranceRecord.objects.bulk_create([InsuranceRecord(**r) for r in records(*self.build())])
+        payed_records = PaymentService().record_insurance_payments(
+            InsuranceRecord.objects.order_by('pk').select_related('car__customer', 'related_partner__related_customer'))
+        self.assertEqual(len(payed_records), 3)
+        self.assertEqual(snapshot(), expected)
+        self.assertConsistent()
+
+    def test_service_payments(self):
+        def records(partner, car, other_car):
+            return [
+                dict(car=car, total_price=200, total_payed=200, is_payed=True, related_partner=partner),
+                dict(car=other_car, total_price=80, total_payed=60, is_payed=True),
+            ]
+
+        for r in records(*self.build()):
+            ServiceRecord.objects.create(**r)
+        expected = snapshot()
+        self.clear()
+        ServiceRecord.objects.bulk_create([ServiceRecord(**r) for r in records(*self.build())])
+        PaymentService().record_service_payments(
+            ServiceRecord.objects.order_by('pk').select_related('car__customer', 'related_partner__related_customer'))
+        self.assertEqual(snapshot(), expected)
+        self.assertConsistent()
+
+    def test_payments(self):
+        customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        AmountChangeRecord.objects.create(customer=customer, amounts=100)
+        CreditChangeRecord.objects.create(customer=customer, credits=100)
+        payed_records = PaymentService().record_payments([
+            PayedRecord(customer=customer, total_price=100, total_payed=100, amount_payed=30, credit_payed=10),
+            PayedRecord(customer=customer, total_price=50, total_payed=50, amount_payed=20),
+        ])
+        self.assertTrue(all(pr.pk for pr in payed_records))
+        customer.refresh_from_db()
+        self.assertEqual(customer.current_amounts, Decimal('50'))
+        self.assertEqual(list(AmountChangeRecord.objects.filter(customer=customer).order_by('pk').values_list(
+            'current_amounts', flat=True)), [Decimal('100'), Decimal('70'), Decimal('50')])
+        self.assertConsistent()
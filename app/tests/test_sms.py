@@ -0,0 +1,122 @@
+import io
+import json
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+from app.jobs import claim_sms_records, sms_request_groups, send_sms_records
+from app.models import MsgSendRecord
+from car.sms_aliyun import SmsClient
+from car.sms_fake import FakeSmsServer
+
+
+class SmsQueueTest(TransactionTestCase):
+    """
+    短信队列通过本地模拟的短信接口（car.sms_fake）发送
+    run_sms_jobs 每次循环调用 close_old_connections，不能在 TestCase 的事务中执行
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeSmsServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.server.fail_count = 0
+        self.server.delay = 0
+        self.settings = override_settings(
+            SMS_API_URL=self.server.url, ACCESS_KEY_ID='id', ACCESS_KEY_SECRET='secret', SMS_RETRY_SECONDS=0,
+            SMS_RATE_LIMIT=0)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+
+    def create_record(self, mobile, paras='{"code": "1234"}', template_code='T1', **kwargs):
+        return MsgSendRecord.objects.create(
+            mobile=mobile, paras=paras, template_code=template_code, status=1, **kwargs)
+
+    def send(self, client=None):
+        return send_sms_records(claim_sms_records(batch_size=500), client or SmsClient(retries=0))
+
+    def test_request_groups(self):
+        records = [self.create_record('1390000000{0}'.format(i)) for i in range(3)]
+        records += [self.create_record('1370000{0:04d}'.format(i), json.dumps({'code': str(i)})) for i in range(150)]
+        records.append(self.create_record('13600000000', template_code='T2'))
+        groups = [(action, template_code, len(items)) for action, template_code, items in sms_request_groups(records)]
+        self.assertEqual(groups, [
+            ('SendSms', 'T1', 3), ('SendBatchSms', 'T1', 100), ('SendBatchSms', 'T1', 50), ('SendSms', 'T2', 1)])
+
+    def test_send(self):
+        for i in range(3):
+            self.create_record('1390000000{0}'.format(i))
+        for i in range(150):
+            self.create_record('1370000{0:04d}'.format(i), json.dumps({'code': str(i)}))
+        MsgSendRecord.objects.create(mobile='13600000000', status=3)
+        call_command('run_sms_jobs', '--once', stdout=io.StringIO())
+        self.assertEqual(MsgSendRecord.objects.filter(status=3).count(), 154)
+        self.assertEqual(sorted(q['Action'] for q in self.server.requests), ['SendBatchSms', 'SendBatchSms', 'SendSms'])
+        request = [q for q in self.server.requests if q['Action'] == 'SendSms'][0]
+        self.assertEqual(request['PhoneNumbers'], '13900000000,13900000001,13900000002')
+        self.assertEqual(json.loads(request['TemplateParam']), {'code': '1234'})
+
+    def test_retry(self):
+        record = self.create_record('13800000001', paras="{'code': 1234}")
+        self.server.fail_count = 1
+        self.assertEqual(self.send(), (0, 0))
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.retry_count), (1, 1))
+        self.assertEqual(self.send(), (1, 0))
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.retry_count), (3, 1))
+        self.assertEqual(len(self.server.requests), 2)
+
+    @override_settings(SMS_MAX_RETRIES=2)
+    def test_max_retries(self):
+        record = self.create_record('13800000001')
+        self.server.fail_count = 100
+        for i in range(3):
+            self.send()
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.retry_count), (4, 3))
+        self.assertEqual(claim_sms_records(), [])
+
+    def test_connection_error(self):
+        record = self.create_record('13800000001')
+        with override_settings(SMS_API_URL='http://127.0.0.1:1/'):
+            self.assertEqual(self.send(SmsClient(retries=1, backoff_factor=0, timeout=(0.5, 0.5))), (0, 0))
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.retry_count), (1, 1))
+
+    def test_read_timeout(self):
+        # 请求已经发出，SendSms 不是幂等的，不重试也不重新发送
+        record = self.create_record('13800000001')
+        self.server.delay = 0.5
+        self.assertEqual(self.send(SmsClient(retries=2, timeout=(1, 0.1))), (0, 1))
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.retry_count), (5, 0))
+        self.assertIn('SmsResultUnknown', record.notes)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(claim_sms_records(), [])
+
+    def test_stale(self):
+        # 发送中的进程中断，请求可能已经发出，不重新发送
+        record = self.create_record('13800000001')
+        MsgSendRecord.objects.update(status=2)
+        self.assertEqual(claim_sms_records(), [])
+        record.refresh_from_db()
+        self.assertEqual(record.status, 2)
+        MsgSendRecord.objects.update(datetime_updated=timezone.now() - timedelta(seconds=600))
+        call_command('run_sms_jobs', '--once', stdout=io.StringIO())
+        record.refresh_from_db()
+        self.assertEqual((record.status, record.retry_count), (5, 0))
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(claim_sms_records(), [])
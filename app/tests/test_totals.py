@@ -0,0 +1,77 @@
+from decimal import Decimal
+
+from django.test import TestCase
+
+from app.models import Customer, CarInfo, InsuranceRecord, ServiceRecord, PayedRecord, CUSTOMER_TOTAL_FIELDS, \
+    rebuild_customer_totals
+
+
+class CustomerTotalsTest(TestCase):
+    """
+    客户的累计消费在收银记录保存和删除时按差额更新，每一步的结果和 rebuild_customer_totals 重新计算的结果一致
+    """
+
+    def setUp(self):
+        self.customer = Customer.objects.create(name='客户一', mobile='13800000001')
+        self.other = Customer.objects.create(name='客户二', mobile='13800000002')
+        self.car = CarInfo.objects.create(car_number='浙A00001', customer=self.customer)
+
+    def totals(self, customer):
+        return Customer.objects.filter(pk=customer.pk).values_list(*CUSTOMER_TOTAL_FIELDS).get()
+
+    def assertConsistent(self):
+        self.assertEqual(rebuild_customer_totals([self.customer.pk, self.other.pk], dry_run=True), 0)
+
+    def test_append(self):
+        InsuranceRecord.objects.create(car=self.car, total_price=1000, payback_amount=100, is_payed=True)
+        ServiceRecord.objects.create(car=self.car, total_price=200, total_payed=200, is_payed=True)
+        PayedRecord.objects.create(customer=self.customer, total_price=50, total_payed=40)
+        self.assertEqual(dict(zip(CUSTOMER_TOTAL_FIELDS, self.totals(self.customer))), {
+            'total_consumption': Decimal('1200'),
+            'total_consumption_1': Decimal('1000'),
+            'total_consumption_2': Decimal('200'),
+            'total_price': Decimal('1250'),
+            'total_payed': Decimal('1140'),
+        })
+        self.assertConsistent()
+
+    def test_edit(self):
+        ir = InsuranceRecord.objects.create(car=self.car, total_price=1000, payback_amount=100, is_payed=True)
+        ir.total_price = 1500
+        ir.save()
+        pr = PayedRecord.objects.create(customer=self.customer, total_price=50, total_payed=50)
+        pr.total_payed = 20
+        pr.save()
+        totals = dict(zip(CUSTOMER_TOTAL_FIELDS, self.totals(self.customer)))
+        self.assertEqual(totals['total_consumption_1'], Decimal('1500'))
+        self.assertEqual(totals['total_price'], Decimal('1550'))
+        self.assertConsistent()
+
+    def test_delete(self):
+        InsuranceRecord.objects.create(car=self.car, total_price=1000, is_payed=True)
+        sr = ServiceRecord.objects.create(car=self.car, total_price=200, total_payed=200, is_payed=True)
+        sr.delete()
+        totals = dict(zip(CUSTOMER_TOTAL_FIELDS, self.totals(self.customer)))
+        self.assertEqual((totals['total_consumption'], totals['total_consumption_2']), (Decimal('1000'), Decimal('0')))
+        PayedRecord.objects.filter(customer=self.customer).delete()
+        self.assertEqual(self.totals(self.customer), (Decimal('0'),) * len(CUSTOMER_TOTAL_FIELDS))
+        self.assertConsistent()
+
+    def test_reassign_customer(self):
+        pr = PayedRecord.objects.create(customer=self.customer, total_price=50, total_payed=50)
+        PayedRecord.objects.create(customer=self.other, total_price=30, total_payed=10)
+        pr.customer = self.other
+        pr.save()
+        self.assertEqual(self.totals(self.customer), (Decimal('0'),) * len(CUSTOMER_TOTAL_FIELDS))
+        totals = dict(zip(CUSTOMER_TOTAL_FIELDS, self.totals(self.other)))
+        self.assertEqual((totals['total_price'], totals['total_payed']), (Decimal('80'), Decimal('60')))
+        self.assertConsistent()
+
+    def test_rebuild(self):
+        InsuranceRecord.objects.create(car=self.car, total_price=1000, is_payed=True)
+        PayedRecord.objects.create(customer=self.other, total_price=30, total_payed=10)
+        expected = [self.totals(self.customer), self.totals(self.other)]
+        Customer.objects.update(total_consumption=0, total_price=999)
+        self.assertEqual(rebuild_customer_totals(), 2)
+        self.assertEqual([self.totals(self.customer), self.totals(self.other)], expected)
+        self.assertEqual(rebuild_customer_totals(), 0)
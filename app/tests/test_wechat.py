@@ -0,0 +1,162 @@
+import time
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from requests.adapters import HTTPAdapter
+from rest_framework.test import APIClient
+
+import car.wechat
+from app.models import WxUser
+from car.wechat import CircuitBreaker, WeChatClient, WeChatUnavailable
+from car.wechat_fake import FakeWeChatServer
+
+
+class BrokenAdapter(HTTPAdapter):
+    """
+    发送请求时抛出 requests 以外的异常
+    """
+
+    def send(self, request, **kwargs):
+        raise RuntimeError('broken')
+
+
+class CircuitBreakerTest(TestCase):
+    """
+    熔断器连续失败以后打开，恢复时间以后只放行一个试探请求
+    """
+
+    def test_open(self):
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.1)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.15)
+        # 试探请求没有结束之前，其他请求直接失败
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    def test_probe_failure(self):
+        breaker = CircuitBreaker(failure_threshold=1, recovery_timeout=0.1)
+        breaker.record_failure()
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+
+@override_settings(WX_APP_ID='app', WX_APP_SECRET='secret', WX_GZH_APP_ID='gzh', WX_GZH_APP_SECRET='secret')
+class WeChatLoginTest(TestCase):
+    """
+    微信登录通过本地模拟的微信接口（car.wechat_fake）请求
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = FakeWeChatServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.server.requests.clear()
+        self.server.fail_count = 0
+        self.server.delay = 0
+        # 登录接口使用进程内共享的微信客户端
+        car.wechat._wechat_client = self.wechat = WeChatClient(
+            api_url=self.server.url, timeout=(1, 0.5), failure_threshold=2, recovery_timeout=0.2)
+        self.client = APIClient()
+
+    def tearDown(self):
+        cache.clear()
+        car.wechat._wechat_client = None
+
+    def paths(self):
+        return [path for path, params in self.server.requests]
+
+    def login(self, code='abc', user_info=None):
+        data = {'code': code}
+        if user_info is not None:
+            data['user_info'] = user_info
+        return self.client.post('/api/wx_login/', data, format='json')
+
+    def login_gzh(self, code='xyz'):
+        return self.client.post('/api/wx_login_gzh/', {'code': code}, format='json')
+
+    def test_login(self):
+        response = self.login(user_info={'nickName': '昵称一', 'gender': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['jwt'])
+        self.assertEqual(WxUser.objects.get(openid='oabc').nick_name, '昵称一')
+        self.assertEqual(self.paths(), ['/sns/jscode2session'])
+
+    def test_invalid_code(self):
+        self.assertEqual(self.login('invalid').status_code, 204)
+        self.assertFalse(self.wechat.breaker.is_open)
+
+    def test_user_info_digest(self):
+        self.login(user_info={'nickName': '昵称一', 'gender': 1})
+        # 用户信息没有变化时只按主键读取缓存的用户
+        with self.assertNumQueries(1):
+            self.assertEqual(self.login(user_info={'nickName': '昵称一', 'gender': 1}).status_code, 200)
+        # 用户信息变化以后摘要不一致，更新用户信息
+        self.assertEqual(self.login(user_info={'nickName': '昵称二', 'gender': 1}).status_code, 200)
+        self.assertEqual(WxUser.objects.get(openid='oabc').nick_name, '昵称二')
+        self.assertEqual(WxUser.objects.count(), 1)
+
+    def test_gzh_cached_openid(self):
+        response = self.login_gzh()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['user']['nick_name'], '微信用户')
+        self.assertEqual(self.paths(), ['/sns/oauth2/access_token', '/sns/userinfo'])
+        # openid 对应的用户已经缓存，不再获取微信用户信息
+        self.assertEqual(self.login_gzh().status_code, 200)
+        self.assertEqual(self.paths(), ['/sns/oauth2/access_token', '/sns/userinfo', '/sns/oauth2/access_token'])
+        self.assertEqual(WxUser.objects.get(openid_gzh='oxyz').city, '杭州')
+
+    def test_circuit_open(self):
+        self.server.fail_count = 2
+        self.assertEqual(self.login().status_code, 503)
+        self.assertFalse(self.wechat.breaker.is_open)
+        self.assertEqual(self.login().status_code, 503)
+        self.assertTrue(self.wechat.breaker.is_open)
+        # 熔断器打开时不再请求微信接口
+        request_count = len(self.server.requests)
+        self.assertEqual(self.login().status_code, 503)
+        self.assertEqual(self.login_gzh().status_code, 503)
+        self.assertEqual(len(self.server.requests), request_count)
+        # 试探请求成功以后关闭
+        time.sleep(0.25)
+        self.assertEqual(self.login().status_code, 200)
+        self.assertFalse(self.wechat.breaker.is_open)
+        self.assertEqual(self.login_gzh().status_code, 200)
+
+    def test_probe_unexpected_error(self):
+        self.server.fail_count = 2
+        self.login()
+        self.login()
+        time.sleep(0.25)
+        adapter = self.wechat.session.get_adapter(self.server.url)
+        self.wechat.session.mount(self.server.url, BrokenAdapter())
+        with self.assertRaises(RuntimeError):
+            self.wechat.jscode2session('abc')
+        # 试探请求的异常计入失败，恢复时间以后可以再次试探
+        self.assertTrue(self.wechat.breaker.is_open)
+        self.wechat.session.mount(self.server.url, adapter)
+        time.sleep(0.25)
+        self.assertEqual(self.login().status_code, 200)
+
+    def test_timeout(self):
+        self.server.delay = 1
+        started = time.monotonic()
+        with self.assertRaises(WeChatUnavailable):
+            self.wechat.jscode2session('abc')
+        self.assertLess(time.monotonic() - started, 0.9)
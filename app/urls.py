@@ -13,6 +13,7 @@ urlpatterns = [
     re_path(r'^service_records/(?P<pk>\d+)/$', ServiceRecordDetailView.as_view(), name='service_record_detail'),
     re_path(r'^service_static/$', ServiceStaticView.as_view(), name='service_static'),
     re_path(r'^insurance_static/$', InsuranceStaticView.as_view(), name='insurance_static'),
+    re_path(r'^car_due_events/$', CarDueEventView.as_view(), name='car_due_events'),
     #
     re_path(r'^service_apply_1/$', ServiceApplyCreateView1.as_view(), name='service_apply_1'),  # 上门服务预约
     re_path(r'^service_apply_2/$', ServiceApplyCreateView2.as_view(), name='service_apply_2'),  # 到店服务预约
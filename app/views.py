@@ -1,3 +1,4 @@
+import datetime
 import json
 
 from django.contrib.auth.mixins import PermissionRequiredMixin
@@ -9,6 +10,10 @@ from django.urls import reverse
 from django.views import View
 from django.views.generic import CreateView, TemplateView, ListView, DetailView, UpdateView
 from django.utils.translation import gettext_lazy as _
+
+from car.routers import ReplicaMixin
+from car.utils import APPROXIMATE_COUNT_THRESHOLD, estimate_count, date_value
+
 from .forms import *
 
 
@@ -30,6 +35,9 @@ def get_obj_permission_required(obj):
 class AppListView(PermissionRequiredMixin, ListView):
     paginate_by = 10
     list_filter = None
+    # 条数超过 approximate_count_threshold 时使用数据库的估计条数，见 estimate_count
+    approximate_count = False
+    approximate_count_threshold = APPROXIMATE_COUNT_THRESHOLD
 
     @staticmethod
     def get_required_object_permissions(model_cls):
@@ -50,12 +58,41 @@ class AppListView(PermissionRequiredMixin, ListView):
                 queryset = queryset.filter(**filter_data)
         return queryset
 
+    def get_list_queryset(self):
+        """
+        获取当前请求的数据，同一个请求中只会执行一次 get_queryset
+        """
+        if not hasattr(self, '_list_queryset'):
+            object_list = getattr(self, 'object_list', None)
+            self._list_queryset = object_list if object_list is not None else self.get_queryset()
+        return self._list_queryset
+
+    def get_list_count(self):
+        """
+        获取当前请求的数据条数，同一个请求中只会执行一次 COUNT，分页器也使用该结果
+        """
+        if not hasattr(self, '_list_count'):
+            queryset = self.get_list_queryset()
+            if isinstance(queryset, QuerySet):
+                if self.approximate_count:
+                    count = estimate_count(queryset, self.approximate_count_threshold)
+                else:
+                    count = queryset.count()
+            else:
+                count = len(queryset)
+            self._list_count = count
+        return self._list_count
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        paginator = super().get_paginator(
+            queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page, **kwargs)
+        if queryset is self.get_list_queryset():
+            paginator.count = self.get_list_count()
+        return paginator
+
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(object_list=object_list, **kwargs)
-        if isinstance(self.get_queryset(), QuerySet):
-            context['data_length'] = self.get_queryset().count()
-        elif isinstance(self.get_queryset(), list):
-            context['data_length'] = len(self.get_queryset())
+        context['data_length'] = self.get_list_count()
         page_range = getattr(context['paginator'], 'page_range')
         current_page_num = getattr(context['page_obj'], 'number')
         page_range_list = list()
@@ -187,10 +224,11 @@ class SuccessView(TemplateView):
     template_name = 'success.html'
 
 
-class ServiceRecordView(AppListView):
+class ServiceRecordView(ReplicaMixin, AppListView):
     template_name = 'service_record_list.html'
     model = ServiceRecord
     paginate_by = 20
+    approximate_count = True
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -222,12 +260,12 @@ class ServiceRecordView(AppListView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
         context['title'] = _('服务记录')
-        context['total_count'] = self.get_queryset().count()
+        context['total_count'] = self.get_list_count()
         context['stores'] = StoreInfo.objects.all()
         return context
 
 
-class ServiceStaticView(AppListView):
+class ServiceStaticView(ReplicaMixin, AppListView):
     template_name = 'service_static.html'
     model = ServiceItem
     paginate_by = 20
@@ -258,16 +296,39 @@ class ServiceStaticView(AppListView):
                 ).order_by('pk').distinct()
         return queryset
 
+    def get_static_queryset(self):
+        """
+        没有搜索关键词时从维修日汇总表统计，避免每次扫描全部维修项目
+        :return: 返回 (统计数据, 门店名称字段, 项目数字段)
+        """
+        if self.request.GET.get('q'):
+            return self.get_list_queryset(), 'related_service_record__related_store__name', None
+        queryset = ServiceDailyStatic.objects.all()
+        store = self.request.GET.get('store')
+        if store:
+            queryset = queryset.filter(related_store_id=store)
+        date_start = date_value(self.request.GET.get('date_start'))
+        if date_start:
+            queryset = queryset.filter(date__gte=date_start)
+        date_end = date_value(self.request.GET.get('date_end'))
+        if date_end:
+            queryset = queryset.filter(date__lte=date_end)
+        return queryset, 'related_store__name', 'item_count'
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
         context['stores'] = StoreInfo.objects.all()
         context['title'] = _('服务统计')
-        context['total_count'] = self.get_queryset().count()
-        static_by_person_query = self.get_queryset().values(
+        static_queryset, store_field, count_field = self.get_static_queryset()
+        if count_field:
+            context['total_count'] = static_queryset.aggregate(count=Sum(count_field))['count'] or 0
+        else:
+            context['total_count'] = self.get_list_count()
+        static_by_person_query = static_queryset.values(
             "served_by__name"
         ).annotate(Sum("price"), Sum("cost")).order_by()
-        static_by_store_query = self.get_queryset().values(
-            "related_service_record__related_store__name"
+        static_by_store_query = static_queryset.values(
+            store_field
         ).annotate(Sum("price"), Sum("cost")).order_by()
         static_by_sales_person_data = []
         static_by_profits_person_data = []
@@ -312,7 +373,7 @@ class ServiceStaticView(AppListView):
             total_profits = total_sales - total_costs
         if static_by_store_query:
             for item in static_by_store_query:
-                store__name = item['related_service_record__related_store__name']
+                store__name = item[store_field]
                 if not store__name:
                     store__name = '未知'
                 if item['price__sum']:
@@ -351,7 +412,7 @@ class ServiceStaticView(AppListView):
         return context
 
 
-class InsuranceStaticView(AppListView):
+class InsuranceStaticView(ReplicaMixin, AppListView):
     template_name = 'insurance_static.html'
     model = InsuranceRecord
     paginate_by = 20
@@ -380,20 +441,43 @@ class InsuranceStaticView(AppListView):
                     record_date__lte=date_end).order_by('record_date').distinct()
         return queryset
 
+    def get_static_queryset(self):
+        """
+        没有搜索关键词时从保险日汇总表统计，避免每次扫描全部投保记录
+        :return: 返回 (统计数据, 保单数字段)
+        """
+        if self.request.GET.get('q'):
+            return self.get_list_queryset(), None
+        queryset = InsuranceDailyStatic.objects.all()
+        insurance_company = self.request.GET.get('insurance_company')
+        if insurance_company:
+            queryset = queryset.filter(insurance_company_id=insurance_company)
+        date_start = date_value(self.request.GET.get('date_start'))
+        if date_start:
+            queryset = queryset.filter(date__gte=date_start)
+        date_end = date_value(self.request.GET.get('date_end'))
+        if date_end:
+            queryset = queryset.filter(date__lte=date_end)
+        return queryset, 'record_count'
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data()
         context['ics'] = InsuranceCompany.objects.all()
         context['title'] = _('保险业务统计')
-        context['total_count'] = self.get_queryset().count()
+        static_queryset, count_field = self.get_static_queryset()
+        if count_field:
+            context['total_count'] = static_queryset.aggregate(count=Sum(count_field))['count'] or 0
+        else:
+            context['total_count'] = self.get_list_count()
         # belong_to
-        static_by_belong_to_query = self.get_queryset().values(
+        static_by_belong_to_query = static_queryset.values(
             "belong_to__name"
         ).annotate(Sum("total_price"), Sum("profits")).order_by()
         static_by_sales_belong_to_data = []
         static_by_profits_belong_to_data = []
         static_by_belong_to_data = []
         # insurance_company
-        static_by_insurance_company_query = self.get_queryset().values(
+        static_by_insurance_company_query = static_queryset.values(
             "insurance_company__name"
         ).annotate(Sum("total_price"), Sum("profits")).order_by()
         static_by_sales_insurance_company_data = []
@@ -522,3 +606,45 @@ class ServiceRecordDetailView(AppView):
         if formset.is_valid():
             formset.save()
         return redirect(request.path)
+
+
+class CarDueEventView(ReplicaMixin, AppListView):
+    """
+    即将到期的交强险和年检，按门店和客户归属筛选，从到期提醒表按到期日期的索引查询
+    """
+    template_name = 'car_due_event_list.html'
+    model = CarDueEvent
+    paginate_by = 20
+
+    max_days = 3650
+
+    def get_days(self):
+        try:
+            return min(max(int(self.request.GET.get('days') or 30), 0), self.max_days)
+        except ValueError:
+            return 30
+
+    def get_queryset(self):
+        today = datetime.date.today()
+        queryset = super().get_queryset().filter(
+            due_date__gte=today, due_date__lte=today + datetime.timedelta(days=self.get_days())
+        ).select_related('car', 'customer', 'related_store', 'related_superior')
+        due_type = self.request.GET.get('due_type')
+        if due_type in ('1', '2'):
+            queryset = queryset.filter(due_type=due_type)
+        store = self.request.GET.get('store')
+        if store:
+            queryset = queryset.filter(related_store_id=store)
+        superior = self.request.GET.get('superior')
+        if superior:
+            queryset = queryset.filter(related_superior_id=superior)
+        return queryset.order_by('due_date', 'pk')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data()
+        context['title'] = _('到期提醒')
+        context['total_count'] = self.get_list_count()
+        context['days'] = self.get_days()
+        context['stores'] = StoreInfo.objects.all()
+        context['superiors'] = Superior.objects.filter(is_active=True)
+        return context
@@ -1,10 +1,14 @@
+import hashlib
 import json
 import logging
 import random
 import re
 from datetime import datetime
 
-import requests
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django_filters import rest_framework as filters
 
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication
@@ -13,16 +17,16 @@ from rest_framework.generics import ListCreateAPIView, ListAPIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.status import *
+from rest_framework.utils.encoders import JSONEncoder
 from rest_framework.views import APIView
 
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.views import TokenObtainPairView
 
-from weixin import WXAPPAPI
-from weixin.oauth2 import OAuth2AuthExchangeError
-
-from car.sms_aliyun import sms_code
+from car.routers import ReplicaMixin
+from car.sms_aliyun import SMS_CODE_TEMPLATE
 from car.utils import NormalResultsSetPagination
+from car.wechat import WeChatError, WeChatUnavailable, get_wechat_client
 
 from .serializers import *
 
@@ -50,20 +54,68 @@ class AppFilter(filters.FilterSet):
         return filter_class
 
 
-def create_or_update_user_info(openid, user_info):
+# openid 对应的用户缓存时间，单位秒，0 表示不缓存
+WX_USER_CACHE_TIMEOUT = getattr(settings, 'WX_USER_CACHE_TIMEOUT', 60 * 60)
+
+
+def wx_user_cache_key(field, openid):
+    return 'wx_user:{0}:{1}'.format(field, openid)
+
+
+def user_info_digest(user_info):
+    return hashlib.md5(json.dumps(user_info, sort_keys=True, cls=JSONEncoder).encode('utf-8')).hexdigest()
+
+
+def get_cached_wx_user(field, openid, user_info=None):
     """
-    创建或者更新用户信息
+    通过缓存的用户 ID 获取用户，只按主键读取
+    :param field: openid 或 openid_gzh
+    :param openid: 微信 openid
+    :param user_info: 微信用户信息，和缓存时的不一致时返回 None，需要更新用户信息
+    :return: 返回用户对象，没有缓存或者已经失效时返回 None
+    """
+    if not WX_USER_CACHE_TIMEOUT or not openid:
+        return None
+    cached = cache.get(wx_user_cache_key(field, openid))
+    if not cached or (user_info and cached[1] != user_info_digest(user_info)):
+        return None
+    user = WxUser.objects.filter(pk=cached[0]).first()
+    # 合并账号时 openid 会转移到其他用户
+    if user is None or getattr(user, field) != openid:
+        return None
+    return user
+
+
+def get_or_update_wx_user(field, openid, user_info):
+    """
+    创建或者更新用户信息，用户 ID 和用户信息的摘要缓存 WX_USER_CACHE_TIMEOUT 秒，用户信息没有变化时不再更新
+    :param field: openid 或 openid_gzh
     :param openid: 微信 openid
     :param user_info: 微信用户信息
     :return: 返回用户对象
     """
-    if openid:
+    if not openid:
+        return None
+    user = get_cached_wx_user(field, openid, user_info)
+    if user is None:
         if user_info:
-            user, created = WxUser.objects.update_or_create(openid=openid, defaults=user_info)
+            user, created = WxUser.objects.update_or_create(defaults=user_info, **{field: openid})
         else:
-            user, created = WxUser.objects.get_or_create(openid=openid)
-        return user
-    return None
+            user, created = WxUser.objects.get_or_create(**{field: openid})
+        if WX_USER_CACHE_TIMEOUT:
+            cache.set(
+                wx_user_cache_key(field, openid), (user.pk, user_info_digest(user_info or {})), WX_USER_CACHE_TIMEOUT)
+    return user
+
+
+def create_or_update_user_info(openid, user_info):
+    """
+    创建或者更新用户信息
+    :param openid: 微信 openid
+    :param user_info: 微信用户信息
+    :return: 返回用户对象
+    """
+    return get_or_update_wx_user('openid', openid, user_info)
 
 
 def create_or_update_user_info_gzh(openid_gzh, user_info):
@@ -73,13 +125,7 @@ def create_or_update_user_info_gzh(openid_gzh, user_info):
     :param user_info: 微信用户信息
     :return: 返回用户对象
     """
-    if openid_gzh:
-        if user_info:
-            user, created = WxUser.objects.update_or_create(openid_gzh=openid_gzh, defaults=user_info)
-        else:
-            user, created = WxUser.objects.get_or_create(openid_gzh=openid_gzh)
-        return user
-    return None
+    return get_or_update_wx_user('openid_gzh', openid_gzh, user_info)
 
 
 @api_view(["GET"])
@@ -116,10 +162,12 @@ class WxLoginView(APIView):
             user_info_raw = {}
         logger.info("user_info: {0}".format(user_info_raw))
         if code:
-            api = WXAPPAPI(appid=settings.WX_APP_ID, app_secret=settings.WX_APP_SECRET)
             try:
-                session_info = api.exchange_code_for_session_key(code=code)
-            except OAuth2AuthExchangeError:
+                session_info = get_wechat_client().jscode2session(code)
+            except WeChatUnavailable:
+                return Response({'jwt': None, 'user': {}}, status=HTTP_503_SERVICE_UNAVAILABLE)
+            except WeChatError as e:
+                logger.info('jscode2session failed: {0}'.format(e))
                 session_info = None
             if session_info:
                 openid = session_info.get('openid', None)
@@ -146,30 +194,26 @@ class WxLoginView(APIView):
 
 def get_access_token(code):
     """
-    公众号微信授权，通过 code 获取 access_token
+    公众号微信授权，通过 code 获取 access_token，微信接口不可用时抛出 WeChatUnavailable
     :param code: 前端获取的 code
     :return: 返回 {"access_token":"","expires_in":7200,"refresh_token":"","openid":"","scope":"snsapi_userinfo"}
     """
     data = dict()
     if code:
-        res = requests.get(
-            url='https://api.weixin.qq.com/sns/oauth2/access_token?'
-                'appid={0}&'
-                'secret={1}&'
-                'code={2}&'
-                'grant_type=authorization_code'.format(
-                    settings.WX_GZH_APP_ID,
-                    settings.WX_GZH_APP_SECRET,
-                    code))
-        if res.status_code == 200:
-            data = res.json()
+        try:
+            data = get_wechat_client().oauth2_access_token(code)
+        except WeChatUnavailable:
+            raise
+        except WeChatError as e:
+            logger.info('oauth2 access_token failed: {0}'.format(e))
     return data
 
 
-def get_wx_gzh_user_info(code):
+def get_wx_gzh_user_info(access_token, openid):
     """
-    公众号微信授权，通过 code 获取用户信息
-    :param code: 前端获取的 code
+    公众号微信授权，通过 access_token 获取用户信息，微信接口不可用时抛出 WeChatUnavailable
+    :param access_token: 网页授权的 access_token
+    :param openid: 公众号 openid
     :return: {
           "openid":" OPENID",
           "nickname": NICKNAME,
@@ -182,17 +226,14 @@ def get_wx_gzh_user_info(code):
           "unionid": ""
         }
     """
-    data = get_access_token(code)
     user_info = dict()
-    access_token = data.get('access_token')
-    openid = data.get('openid')
     if access_token and openid:
-        res = requests.get(
-            url='https://api.weixin.qq.com/sns/userinfo?access_token={0}&openid={1}&lang=zh_CN'.format(
-                access_token,
-                openid))
-        if res.status_code == 200:
-            user_info = res.json()
+        try:
+            user_info = get_wechat_client().oauth2_user_info(access_token, openid)
+        except WeChatUnavailable:
+            raise
+        except WeChatError as e:
+            logger.info('oauth2 userinfo failed: {0}'.format(e))
     return user_info
 
 
@@ -200,11 +241,11 @@ class WxGzhLoginView(APIView):
     """
     post:
     公众号登录接口，传递参数 {'code': ''}
+    openid 对应的用户已经缓存时不再获取微信用户信息
     """
     authentication_classes = []
     permission_classes = []
     fields = {
-        'openid': 'openid',
         'nick_name': 'nickname',
         'language': 'language',
         'gender': 'sex',
@@ -214,43 +255,48 @@ class WxGzhLoginView(APIView):
         'avatar_url': 'headimgurl',
     }
 
-    def post(self, request):
+    def get_user(self, code):
+        """
+        通过 code 获取 openid，缓存中没有对应的用户时再获取微信用户信息，创建或者更新用户
+        :param code: 前端获取的 code
+        :return: 返回用户对象
+        """
+        data = get_access_token(code)
+        openid_gzh = data.get('openid')
+        user = get_cached_wx_user('openid_gzh', openid_gzh)
+        if user:
+            return user
+        user_info_raw = get_wx_gzh_user_info(data.get('access_token'), openid_gzh)
+        logger.info("user_info: {0}".format(user_info_raw))
+        if not user_info_raw:
+            return None
         user_info = dict()
+        for k, v in self.fields.items():
+            current_v = user_info_raw.get(v)
+            if current_v:
+                user_info[k] = current_v
+        return create_or_update_user_info_gzh(user_info_raw.get('openid'), user_info)
+
+    def post(self, request):
         code = request.data.get('code')
         logger.info("Code: {0}".format(code))
-        # 通过 code 获取用户信息
-        user_info_raw = get_wx_gzh_user_info(code)
-        if isinstance(user_info_raw, str):
-            user_info_raw = json.loads(user_info_raw)
-        if not isinstance(user_info_raw, dict):
-            user_info_raw = {}
-        logger.info("user_info: {0}".format(user_info_raw))
-        if user_info_raw:
-            openid_gzh = None
-            for k, v in self.fields.items():
-                if k == 'openid':
-                    openid_gzh = user_info_raw.get('openid')
-                else:
-                    current_v = user_info_raw.get(v)
-                    if current_v:
-                        if isinstance(current_v, str):
-                            current_v = current_v.encode('iso-8859-1').decode('utf-8')
-                        user_info[k] = current_v
-            if openid_gzh:
-                user = create_or_update_user_info_gzh(openid_gzh, user_info)
-                if user:
-                    token = AppTokenObtainPairSerializer.get_token(user).access_token
-                    return Response(
-                        {
-                            'jwt': str(token),
-                            'user': model_to_dict(
-                                user,
-                                fields=[
-                                    'nick_name', 'full_name', 'mobile', 'gender', 'avatar_url',
-                                    'is_partner', 'is_client', 'is_manager'
-                                ])
-                        },
-                        status=HTTP_200_OK)
+        try:
+            user = self.get_user(code)
+        except WeChatUnavailable:
+            return Response({'jwt': None, 'user': {}}, status=HTTP_503_SERVICE_UNAVAILABLE)
+        if user:
+            token = AppTokenObtainPairSerializer.get_token(user).access_token
+            return Response(
+                {
+                    'jwt': str(token),
+                    'user': model_to_dict(
+                        user,
+                        fields=[
+                            'nick_name', 'full_name', 'mobile', 'gender', 'avatar_url',
+                            'is_partner', 'is_client', 'is_manager'
+                        ])
+                },
+                status=HTTP_200_OK)
         return Response({'jwt': None, 'user': {}}, status=HTTP_204_NO_CONTENT)
 
 
@@ -301,14 +347,84 @@ class AppApi(APIView):
     permission_classes = (IsAuthenticated, )
 
 
-class ServicePackageTypeListView(ListAPIView):
+class CatalogueListView(ListAPIView):
     """
-    get:
-    获取套餐类别列表
+    公开的目录数据，序列化以后的结果按视图和筛选参数缓存，数据更新以后自动失效，
+    响应包含 ETag 和 Last-Modified，客户端带上 If-None-Match 或 If-Modified-Since 时可以返回 304
     """
     pagination_class = None
     permission_classes = ()
-    queryset = ServicePackageType.objects.filter(is_active=True).order_by('name')
+
+    def get_cache_key(self, request, version):
+        """
+        缓存的 key 只包含视图和筛选、排序参数，其他的查询参数不会产生新的缓存；带有搜索关键字时不缓存
+        :return: 返回缓存的 key，不缓存时返回 None
+        """
+        names = set()
+        for backend_class in self.filter_backends:
+            backend = backend_class()
+            if hasattr(backend, 'get_search_terms') and getattr(self, 'search_fields', None):
+                if backend.get_search_terms(request):
+                    return None
+            if hasattr(backend, 'get_filterset_class'):
+                filterset_class = backend.get_filterset_class(self, self.get_queryset())
+                if filterset_class is not None:
+                    names.update(filterset_class.base_filters)
+            if hasattr(backend, 'ordering_param'):
+                names.add(backend.ordering_param)
+        params = list()
+        for name in sorted(names):
+            values = sorted(v.strip() for v in request.query_params.getlist(name) if v.strip())
+            if values:
+                params.append([name, values])
+        return 'catalogue_{0}_{1}_{2}'.format(
+            version, type(self).__name__, hashlib.md5(json.dumps(params).encode()).hexdigest())
+
+    def get_catalogue(self, request):
+        """
+        获取缓存的目录数据，缓存不存在时查询并序列化
+        :return: 返回 {'data': 序列化数据, 'etag': ETag, 'last_modified': 更新时间戳，不缓存时为 None}
+        """
+        key = None
+        version = None
+        if catalogue_cache_enabled():
+            version = get_catalogue_version()
+            key = self.get_cache_key(request, version)
+        catalogue = cache.get(key) if key else None
+        if catalogue is None:
+            serializer = self.get_serializer(self.filter_queryset(self.get_queryset()), many=True)
+            data = json.loads(json.dumps(serializer.data, cls=JSONEncoder))
+            catalogue = {
+                'data': data,
+                'etag': hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest(),
+                'last_modified': version,
+            }
+            if key:
+                cache.set(key, catalogue, CATALOGUE_CACHE_TIMEOUT)
+        return catalogue
+
+    def list(self, request, *args, **kwargs):
+        catalogue = self.get_catalogue(request)
+        response = get_conditional_response(
+            request, etag=quote_etag(catalogue['etag']), last_modified=catalogue['last_modified'])
+        if response is None:
+            response = Response(catalogue['data'])
+        response['ETag'] = quote_etag(catalogue['etag'])
+        if catalogue['last_modified']:
+            response['Last-Modified'] = http_date(catalogue['last_modified'])
+        return response
+
+
+class ServicePackageTypeListView(CatalogueListView):
+    """
+    get:
+    获取套餐类别列表
+    """
+    queryset = ServicePackageType.objects.filter(is_active=True).order_by('name').prefetch_related(
+        Prefetch(
+            'servicepackage_set',
+            queryset=ServicePackage.objects.order_by('name'),
+            to_attr='prefetched_service_packages'))
     serializer_class = ServicePackageTypeSerializer
 
 
@@ -320,48 +436,40 @@ class ServicePackageFilter(AppFilter):
         }
 
 
-class ServicePackageListView(ListAPIView):
+class ServicePackageListView(CatalogueListView):
     """
     get:
     获取保养套餐列表
     """
-    pagination_class = None
-    permission_classes = ()
-    queryset = ServicePackage.objects.order_by('name')
+    queryset = ServicePackage.objects.select_related('service_type').order_by('name')
     serializer_class = ServicePackageSerializer
     filterset_class = ServicePackageFilter
 
 
-class OilPackageListView(ListAPIView):
+class OilPackageListView(CatalogueListView):
     """
     get:
     获取机油套餐列表
     """
-    pagination_class = None
-    permission_classes = ()
     queryset = OilPackage.objects.order_by('name')
     serializer_class = OilPackageSerializer
 
 
-class StoreInfoListView(ListAPIView):
+class StoreInfoListView(CatalogueListView):
     """
     get:
     获取门店信息列表
     """
-    pagination_class = None
-    permission_classes = ()
     queryset = StoreInfo.objects.order_by('name')
     serializer_class = StoreInfoSerializer
     search_fields = ('name', 'address')
 
 
-class InsuranceCompanyListView(ListAPIView):
+class InsuranceCompanyListView(CatalogueListView):
     """
     get:
     获取保险公司列表
     """
-    pagination_class = None
-    permission_classes = ()
     queryset = InsuranceCompany.objects.filter(display=True, is_active=True).order_by('pk')
     serializer_class = InsuranceCompanySerializer
     search_fields = ('name',)
@@ -430,7 +538,7 @@ class PartnerApplyListView(AppListCreateApi):
             return self.queryset.none()
 
 
-class AmountChangeRecordListView(AppListApi):
+class AmountChangeRecordListView(ReplicaMixin, AppListApi):
     """
     get:
     获取自己的余额变更记录，主要获取 amounts、notes 和 datetime_created 字段的数据。amounts-->金额， notes-->备注, datetime_created-->创建日期
@@ -441,11 +549,11 @@ class AmountChangeRecordListView(AppListApi):
 
     def get_queryset(self):
         if self.request.user.id:
-            return self.queryset.filter(customer__related_user_id=self.request.user.id)
+            return self.queryset.filter(customer__related_user=self.request.user.id)
         return self.queryset.none()
 
 
-class CreditChangeRecordListView(AppListApi):
+class CreditChangeRecordListView(ReplicaMixin, AppListApi):
     """
     get:
     获取自己的积分变更记录，主要获取 credits、notes 和 datetime_created 字段的数据。credits-->积分， notes-->备注, datetime_created-->创建日期
@@ -456,14 +564,41 @@ class CreditChangeRecordListView(AppListApi):
 
     def get_queryset(self):
         if self.request.user.id:
-            return self.queryset.filter(customer__related_user_id=self.request.user.id)
+            return self.queryset.filter(customer__related_user=self.request.user.id)
         return self.queryset.none()
 
 
-def get_user_detail(user):
+# 用户信息摘要中的余额和积分变更记录条数
+USER_DETAIL_HISTORY_SIZE = 10
+
+
+def get_change_records(queryset, fields, history_size=None):
+    """
+    获取余额或积分变更记录，按 ID 倒序
+    :param queryset: 变更记录查询
+    :param fields: {返回字段: 查询字段}
+    :param history_size: 返回的条数，为空时返回全部
+    :return: 返回 (变更记录, 下一页游标)，游标用于 /api/amount_change_records/ 和 /api/credit_change_records/ 的 cursor 参数
+    """
+    queryset = queryset.order_by('-pk').values(*fields.values())
+    if history_size:
+        queryset = queryset[:history_size + 1]
+    records = list()
+    for r in queryset:
+        records.append({k: r.get(v) for k, v in fields.items()})
+    next_cursor = None
+    if history_size and len(records) > history_size:
+        records = records[:history_size]
+        next_cursor = str(records[-1]['pk'])
+    return records, next_cursor
+
+
+def get_user_detail(user, history_size=None):
     """
     获取用户的信息
     :param user: 用户对象
+    :param history_size: 余额和积分变更记录的条数，为空时返回全部记录；
+        不为空时为摘要模式，同时返回 amount_records_cursor 和 credit_records_cursor，用于分页获取更多的记录
     :return: 返回用户信息
     """
     res = {
@@ -476,6 +611,9 @@ def get_user_detail(user):
         'bank_account_no': None,
         'bank_name': None,
     }
+    if history_size:
+        res['amount_records_cursor'] = None
+        res['credit_records_cursor'] = None
     if user:
         res['user'] = model_to_dict(
             user,
@@ -483,36 +621,33 @@ def get_user_detail(user):
                 'id', 'nick_name', 'full_name', 'mobile', 'gender', 'avatar_url',
                 'is_partner', 'is_client', 'is_manager'
             ])
-        amount_records_q = AmountChangeRecord.objects.filter(
-            customer__related_user=user
-        ).order_by('-pk').values(
-            'pk', 'customer__name', 'amounts', 'current_amounts', 'datetime_created', 'notes')
-        for ar in amount_records_q:
-            res['amount_records'].append(
-                {
-                    'pk': ar.get('pk'),
-                    'name': ar.get('customer__name'),
-                    'amounts': ar.get('amounts'),
-                    'current_amounts': ar.get('current_amounts'),
-                    'notes': ar.get('notes'),
-                    'datetime_created': ar.get('datetime_created'),
-                }
-            )
-        credit_records_q = CreditChangeRecord.objects.filter(
-            customer__related_user=user
-        ).order_by('-pk').values(
-            'pk', 'customer__name', 'credits', 'current_credits', 'datetime_created', 'notes')
-        for cr in credit_records_q:
-            res['credit_records'].append(
-                {
-                    'pk': cr.get('pk'),
-                    'name': cr.get('customer__name'),
-                    'credits': cr.get('credits'),
-                    'current_credits': cr.get('current_credits'),
-                    'notes': cr.get('notes'),
-                    'datetime_created': cr.get('datetime_created')
-                }
-            )
+        amount_records, amount_records_cursor = get_change_records(
+            AmountChangeRecord.objects.filter(customer__related_user=user),
+            {
+                'pk': 'pk',
+                'name': 'customer__name',
+                'amounts': 'amounts',
+                'current_amounts': 'current_amounts',
+                'notes': 'notes',
+                'datetime_created': 'datetime_created',
+            },
+            history_size)
+        res['amount_records'] = amount_records
+        credit_records, credit_records_cursor = get_change_records(
+            CreditChangeRecord.objects.filter(customer__related_user=user),
+            {
+                'pk': 'pk',
+                'name': 'customer__name',
+                'credits': 'credits',
+                'current_credits': 'current_credits',
+                'notes': 'notes',
+                'datetime_created': 'datetime_created',
+            },
+            history_size)
+        res['credit_records'] = credit_records
+        if history_size:
+            res['amount_records_cursor'] = amount_records_cursor
+            res['credit_records_cursor'] = credit_records_cursor
         fs = ['bank_account_name', 'bank_account_no', 'bank_name', 'current_amounts', 'current_credits']
         related_customer = Customer.objects.values(*fs).filter(related_user=user).first()
         if related_customer:
@@ -521,16 +656,42 @@ def get_user_detail(user):
     return res
 
 
+def get_user_summary(user):
+    """
+    获取用户的信息摘要，只包含最近 USER_DETAIL_HISTORY_SIZE 条变更记录，
+    设置了 USER_DETAIL_CACHE_TIMEOUT 时使用缓存，变更记录、客户和用户保存以后自动清除
+    :param user: 用户对象
+    :return: 返回用户信息
+    """
+    if not USER_DETAIL_CACHE_TIMEOUT:
+        return get_user_detail(user, USER_DETAIL_HISTORY_SIZE)
+    key = user_detail_cache_key(user.pk)
+    res = cache.get(key)
+    if res is None:
+        res = get_user_detail(user, USER_DETAIL_HISTORY_SIZE)
+        cache.set(key, res, USER_DETAIL_CACHE_TIMEOUT)
+    return res
+
+
+def get_user_info(request, user):
+    """
+    请求参数 summary 不为空时返回用户信息摘要，否则返回全部变更记录
+    """
+    if request.query_params.get('summary'):
+        return get_user_summary(user)
+    return get_user_detail(user)
+
+
 class UserInfoView(AppApi):
     """
     get:
-    获取自己的用户信息
+    获取自己的用户信息，参数 summary=1 时只返回最近的变更记录，更多的记录使用返回的 amount_records_cursor 和 credit_records_cursor 分页获取
     """
     def get(self, request):
         if self.request.user.id:
             user = WxUser.objects.filter(pk=request.user.id).first()
             if user:
-                res = get_user_detail(user)
+                res = get_user_info(request, user)
                 return Response(res, status=HTTP_200_OK)
         return Response({'detail': '请登录'}, status=HTTP_401_UNAUTHORIZED)
 
@@ -570,7 +731,7 @@ class UpdateMobileView(AppApi):
                                     exist_customer.save()
                             user.mobile = mobile
                             user.save()
-                            res = get_user_detail(user)
+                            res = get_user_info(request, user)
                             return Response(res, status=HTTP_200_OK)
                         return Response({'detail': '验证码过期'}, status=HTTP_400_BAD_REQUEST)
                     return Response({'detail': '验证失败'}, status=HTTP_400_BAD_REQUEST)
@@ -622,6 +783,7 @@ class UpdateUserInfoView(AppApi):
             else:
                 customers.update(**data)
                 customer = customers.first()
+                clear_customer_user_detail_cache(customers.values_list('pk', flat=True))
             return Response(model_to_dict(customer, fields=fields), status=HTTP_200_OK)
         return Response({'detail': '请登录'}, status=HTTP_401_UNAUTHORIZED)
 
@@ -639,25 +801,19 @@ class GetCodeView(APIView):
                 return Response('手机号未提供', status=HTTP_400_BAD_REQUEST)
             res = re.match(r'^1[2-9]\d{9}$', mobile)
             if res:
-                # 查看之前的发送记录
-                pre_send = MsgSendRecord.objects.filter(mobile=mobile).order_by('-pk').first()
+                # 查看之前的验证码发送记录，到期提醒等其他短信不限制
+                pre_send = MsgSendRecord.objects.filter(mobile=mobile, msg_type=1).order_by('-pk').first()
                 if pre_send:
-                    if (datetime.now() - pre_send.datetime_created).seconds < 300:
+                    if (datetime.now() - pre_send.datetime_created).total_seconds() < 300:
                         return Response('操作过于频繁，请在5分钟后重新申请', status=HTTP_400_BAD_REQUEST)
-                # 保存短信验证码
+                # 保存短信验证码，加入发送队列，由 run_sms_jobs 发送
                 code = random.randint(1000, 9999)
-                record = MsgSendRecord.objects.create(
-                    mobile=mobile, code=code, paras=str({'code': code}), msg_type=1,
+                MsgSendRecord.objects.create(
+                    mobile=mobile, code=code, paras=json.dumps({'code': str(code)}), msg_type=1,
+                    template_code=getattr(settings, 'SMS_CODE_TEMPLATE', SMS_CODE_TEMPLATE), status=1,
                     created_by_id=self.request.user.id
                 )
-                # 发送短信
-                sms = sms_code(mobile=mobile, code=code)
-                record.notes = sms.text
-                record.save()
-                if sms.status_code == 200:
-                    return Response('发送成功', status=HTTP_200_OK)
-                else:
-                    return Response(sms.text, status=HTTP_400_BAD_REQUEST)
+                return Response('发送成功', status=HTTP_200_OK)
             else:
                 return Response('手机号不符合规则', status=HTTP_400_BAD_REQUEST)
         else:
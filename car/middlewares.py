@@ -1,5 +1,22 @@
+import logging
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import connections
+from django.http import JsonResponse
 from django.utils.deprecation import MiddlewareMixin
 
+from car.routers import SAFE_METHODS, get_replica_alias, mark_sticky
+
+
+logger = logging.getLogger('django')
+
 
 class MiddlewareHead(MiddlewareMixin):
 
@@ -11,3 +28,159 @@ class MiddlewareHead(MiddlewareMixin):
             response['Access-Control-Allow-Credentials'] = 'true'
             response['X-Frame-Options'] = '*'
         return response
+
+
+def sql_fingerprint(sql):
+    """
+    SQL 语句的特征，参数已经是占位符，只需要把长度不同的 IN 列表合并
+    :param sql: SQL 语句
+    :return: 返回 SQL 特征
+    """
+    return re.sub(r'\(\s*%s(?:\s*,\s*%s)*\s*\)', '(...)', sql)
+
+
+class QueryProfile:
+    """
+    一个请求的查询统计
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.query_count = 0
+        self.query_time = 0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.time()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.query_time += time.time() - started
+            self.query_count += 1
+            self.fingerprints[sql_fingerprint(sql)] += 1
+
+    @property
+    def total_time(self):
+        return time.time() - self.started
+
+    def top_duplicates(self, n):
+        """
+        重复次数最多的 SQL，用于发现 N+1 查询
+        :param n: 返回的条数
+        :return: 返回 [(SQL 特征, 次数)]
+        """
+        return [(sql, count) for sql, count in self.fingerprints.most_common(n) if count > 1]
+
+
+class QueryProfileStats:
+    """
+    进程内的请求统计汇总，按视图名称统计请求数、查询数和耗时，并记录重复最多的 SQL
+    """
+    max_fingerprints = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = dict()
+        self.fingerprints = Counter()
+        self.started = time.time()
+
+    def add(self, view_name, profile):
+        with self.lock:
+            v = self.views.setdefault(view_name, {
+                'requests': 0, 'queries': 0, 'max_queries': 0, 'sql_time': 0, 'total_time': 0})
+            v['requests'] += 1
+            v['queries'] += profile.query_count
+            v['max_queries'] = max(v['max_queries'], profile.query_count)
+            v['sql_time'] += profile.query_time
+            v['total_time'] += profile.total_time
+            for sql, count in profile.top_duplicates(self.max_fingerprints):
+                self.fingerprints['{0} | {1}'.format(view_name, sql)] += count
+            if len(self.fingerprints) > self.max_fingerprints:
+                self.fingerprints = Counter(dict(self.fingerprints.most_common(self.max_fingerprints // 2)))
+
+    def reset(self):
+        with self.lock:
+            self.views = dict()
+            self.fingerprints = Counter()
+            self.started = time.time()
+
+    def to_dict(self, top=20):
+        with self.lock:
+            views = list()
+            for view_name, v in self.views.items():
+                views.append({
+                    'view': view_name,
+                    'requests': v['requests'],
+                    'avg_queries': round(v['queries'] / v['requests'], 1),
+                    'max_queries': v['max_queries'],
+                    'avg_sql_ms': round(v['sql_time'] * 1000 / v['requests'], 1),
+                    'avg_total_ms': round(v['total_time'] * 1000 / v['requests'], 1),
+                })
+            views.sort(key=lambda x: x['avg_queries'], reverse=True)
+            return {
+                'since': self.started,
+                'views': views,
+                'duplicated_sql': [
+                    {'sql': sql, 'count': count} for sql, count in self.fingerprints.most_common(top)],
+            }
+
+
+query_profile_stats = QueryProfileStats()
+
+
+class QueryProfileMiddleware:
+    """
+    按 PROFILE_SAMPLE_RATE 的比例抽样统计请求的查询数、SQL 耗时、总耗时和重复的 SQL，
+    结果写入响应头 X-Query-Count、X-Query-Time、X-Total-Time、X-Query-Duplicates，并汇总到 query_profile_stats，
+    重复次数超过 PROFILE_DUPLICATE_THRESHOLD 的请求会记录警告日志
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = getattr(settings, 'PROFILE_SAMPLE_RATE', 0)
+        self.duplicate_threshold = getattr(settings, 'PROFILE_DUPLICATE_THRESHOLD', 10)
+
+    def __call__(self, request):
+        if not self.sample_rate or random.random() >= self.sample_rate:
+            return self.get_response(request)
+        profile = QueryProfile()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(profile))
+            response = self.get_response(request)
+        resolver_match = getattr(request, 'resolver_match', None)
+        view_name = resolver_match.view_name if resolver_match else request.path
+        query_profile_stats.add(view_name, profile)
+        duplicates = profile.top_duplicates(1)
+        response['X-Query-Count'] = profile.query_count
+        response['X-Query-Time'] = '{0:.1f}'.format(profile.query_time * 1000)
+        response['X-Total-Time'] = '{0:.1f}'.format(profile.total_time * 1000)
+        response['X-Query-Duplicates'] = duplicates[0][1] if duplicates else 0
+        if duplicates and duplicates[0][1] > self.duplicate_threshold:
+            logger.warning('{0} 重复查询 {1} 次：{2}'.format(view_name, duplicates[0][1], duplicates[0][0]))
+        return response
+
+
+class ReplicaStickyMiddleware:
+    """
+    写请求成功以后，同一个客户端和用户在 REPLICA_STICKY_SECONDS 秒内的读操作使用主库，保证能读到自己写入的数据
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if request.method not in SAFE_METHODS and response.status_code < 400 and get_replica_alias():
+            mark_sticky(request, response)
+        return response
+
+
+@staff_member_required
+def query_profile_stats_view(request):
+    """
+    进程内的请求统计，参数 reset=1 时清空统计
+    """
+    if request.GET.get('reset'):
+        query_profile_stats.reset()
+    return JsonResponse(query_profile_stats.to_dict(), json_dumps_params={'ensure_ascii': False})
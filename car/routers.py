@@ -0,0 +1,165 @@
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.functional import SimpleLazyObject
+
+
+_state = threading.local()
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+STICKY_COOKIE = 'replica_sticky'
+
+
+def get_replica_alias():
+    """
+    只读数据库的名称，通过 REPLICA_DATABASE 设置，默认为 replica，DATABASES 中没有该数据库时返回 None
+    """
+    alias = getattr(settings, 'REPLICA_DATABASE', 'replica')
+    return alias if alias in settings.DATABASES else None
+
+
+def get_sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+
+
+def sticky_cache_key(user_id):
+    return 'replica_sticky:{0}'.format(user_id)
+
+
+def get_request_user(request):
+    """
+    获取请求中已经加载的用户，不触发 AuthenticationMiddleware 的延迟加载（加载用户本身也要读数据库）
+    """
+    user = request.__dict__.get('user')
+    if isinstance(user, SimpleLazyObject):
+        user = getattr(request, '_cached_user', None)
+    return user
+
+
+def is_sticky(request):
+    """
+    请求的客户端或用户在 REPLICA_STICKY_SECONDS 秒内有过写操作，需要读主库才能读到自己写入的数据
+    结果按用户缓存在请求上，DRF 的用户在认证以后才能获取
+    """
+    if request.COOKIES.get(STICKY_COOKIE):
+        return True
+    user = get_request_user(request)
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    cached = getattr(request, '_replica_sticky', None)
+    if cached is None or cached[0] != user_id:
+        cached = (user_id, bool(user_id and cache.get(sticky_cache_key(user_id))))
+        request._replica_sticky = cached
+    return cached[1]
+
+
+def mark_sticky(request, response):
+    """
+    写操作以后的一段时间内，同一个客户端和用户读主库
+    """
+    seconds = get_sticky_seconds()
+    response.set_cookie(STICKY_COOKIE, '1', max_age=seconds)
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        cache.set(sticky_cache_key(user.pk), 1, seconds)
+
+
+def replica_enabled():
+    """
+    当前线程的读操作是否使用只读数据库，事务中的读操作总是使用主库
+    """
+    if not getattr(_state, 'active', False) or get_replica_alias() is None:
+        return False
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return False
+    request = getattr(_state, 'request', None)
+    return request is None or not is_sticky(request)
+
+
+@contextmanager
+def read_from_replica(request=None):
+    """
+    在上下文中的读操作使用只读数据库
+    :param request: 当前请求，请求的客户端或用户最近有写操作时仍然读主库
+    """
+    previous = (getattr(_state, 'active', False), getattr(_state, 'request', None))
+    _state.active = True
+    _state.request = request
+    try:
+        yield
+    finally:
+        _state.active, _state.request = previous
+
+
+def render_in_replica(request, func, *args, **kwargs):
+    """
+    在只读数据库上执行视图，TemplateResponse 和 DRF 的 Response 在视图返回以后才渲染，需要在上下文中提前渲染
+    只有 GET、HEAD、OPTIONS 请求使用只读数据库
+    """
+    if request.method not in SAFE_METHODS:
+        return func(*args, **kwargs)
+    with read_from_replica(request):
+        response = func(*args, **kwargs)
+        if callable(getattr(response, 'render', None)) and not getattr(response, 'is_rendered', True):
+            response = response.render()
+    return response
+
+
+def replica_view(view_func):
+    """
+    函数视图使用只读数据库
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        return render_in_replica(request, view_func, request, *args, **kwargs)
+    return wrapper
+
+
+def replica_action(func):
+    """
+    后台的只读操作（例如导出 Excel）使用只读数据库
+    """
+    @wraps(func)
+    def wrapper(modeladmin, request, queryset):
+        with read_from_replica(request):
+            return func(modeladmin, request, queryset)
+    return wrapper
+
+
+class ReplicaMixin:
+    """
+    类视图的 GET 请求使用只读数据库，适用于 Django 和 DRF 的视图
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        return render_in_replica(request, super().dispatch, request, *args, **kwargs)
+
+
+class ReplicaRouter:
+    """
+    在 read_from_replica 上下文中的读操作使用只读数据库，写操作和迁移只在主库执行
+    DATABASE_ROUTERS = ['car.routers.ReplicaRouter']
+    """
+
+    def db_for_read(self, model, **hints):
+        if replica_enabled():
+            return get_replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        # 从只读数据库读取的数据保存时也要写入主库
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, get_replica_alias()}
+        if getattr(obj1, '_state').db in aliases and getattr(obj2, '_state').db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == get_replica_alias():
+            return False
+        return None
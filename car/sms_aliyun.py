@@ -1,10 +1,13 @@
 import base64
-import datetime
 import hashlib
 import hmac
-import os
+import json
+import logging
 import requests
-from requests.exceptions import ConnectionError
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
 import time
 from urllib import request
 import uuid
@@ -13,94 +16,276 @@ from django.conf import settings
 # https://blog.csdn.net/shu_8708/article/details/79150290
 
 
-def log(text):
-    def decorator(func):
-        def wrapper(*args, **kwargs):
-            print('Pid:{0} running {1} [function:{2}] at {3}'.format(os.getpid(),
-                                                                     text, func.__name__,
-                                                                     datetime.datetime.now()))
-            return func(*args, **kwargs)
-        return wrapper
-    return decorator
+logger = logging.getLogger('django')
+
+
+def en_code(x):
+    x = request.quote(x, safe='')
+    x = x.replace("+", "%20").replace("*", "%2A").replace("%7E", "~")
+    return x
+
+
+class SmsSigner:
+    """
+    阿里云接口的 URL 签名，同一个进程重复使用
+    每次请求相同的参数在创建时编码一次，签名时只编码变化的参数，HMAC 的密钥也只初始化一次
+    """
+    http_method = 'GET'
+
+    def __init__(self, secret, static_params=None, api_url=None):
+        """
+        :param secret: AccessKeySecret
+        :param static_params: 每次请求相同的参数，例如 AccessKeyId、Version
+        :param api_url: 接口地址，默认为 get_sms_api_url()
+        """
+        if secret is None:
+            raise ValueError('SecretID must input!')
+        self.api_url = api_url or get_sms_api_url()
+        self.static_items = [(en_code(k), en_code(v)) for k, v in (static_params or dict()).items()]
+        self.string_to_sign_prefix = '{0}&{1}&'.format(self.http_method, en_code('/'))
+        self.hmac = hmac.new((secret + '&').encode('utf-8'), digestmod=hashlib.sha1)
+
+    def query_string(self, params):
+        """
+        :param params: 本次请求变化的参数
+        :return: 返回按参数名排序并编码的查询字符串
+        """
+        items = list(self.static_items)
+        items.extend((en_code(k), en_code(v)) for k, v in params.items())
+        items.sort()
+        return '&'.join('{0}={1}'.format(k, v) for k, v in items)
+
+    def sign(self, query):
+        """
+        :param query: 查询字符串
+        :return: 返回编码以后的签名
+        """
+        h = self.hmac.copy()
+        h.update((self.string_to_sign_prefix + en_code(query)).encode('utf-8'))
+        return en_code(base64.b64encode(h.digest()))
+
+    def url_build(self, params):
+        """
+        :param params: 本次请求变化的参数
+        :return: 返回签名以后的请求地址
+        """
+        query = self.query_string(params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('SMS {0} signed: {1}'.format(params.get('Action'), query))
+        return '{0}?Signature={1}&{2}'.format(self.api_url, self.sign(query), query)
 
 
 class MsgUrlBuild:
+    """
+    使用完整的参数签名，每次都重新编码所有参数，多次发送时使用 SmsSigner
+    """
+
     def __init__(self, dic, secret_id=None):
-        self.HttpMethod = 'GET'
         self._info = dic
-        if secret_id is None:
-            raise ValueError('SecretID must input!')
-        self._secret_id = secret_id
-        # print('api information write complete!')
-        
-    @staticmethod
-    def en_code(x):
-        x = request.quote(x, safe='')
-        x = x.replace("+", "%20").replace("*", "%2A").replace("%7E", "~")
-        return x
-    
-    @log('build sorted dictionary')
-    def _build_query(self):
-        if self._info is None:
-            raise ValueError('please init first')
-        lst = sorted(self._info)
-        temp_ls = []
-        for k in lst:
-            v = self._info[k]
-            para = '{0}={1}'.format(self.en_code(k), self.en_code(v))
-            temp_ls.append(para)
-        return '&'.join(temp_ls)
-    
-    @log('build string to sign')
-    def _sign_to_sign(self, x):
-        return self.HttpMethod+'&'+self.en_code('/')+'&'+self.en_code(x)
-
-    @log('create a sign')
-    def _create_sign(self, x):
-        sha1 = hmac.new((self._secret_id+'&').encode('utf-8'), x.encode('utf-8'), hashlib.sha1).digest()
-        sign = base64.b64encode(sha1)
-        return self.en_code(sign)
-    
-    @log('reset the information of api')
+        self._signer = SmsSigner(secret_id)
+
     def reset_info(self, dic):
         self._info = dic
-    
-    @log('start build request')
+
     def url_build(self):
-        base_str = self._build_query()
-        tmp = self._sign_to_sign(base_str)
-        x = self._create_sign(tmp)
-        return 'http://dysmsapi.aliyuncs.com/?Signature={0}&{1}'.format(x, base_str)
+        if self._info is None:
+            raise ValueError('please init first')
+        return self._signer.url_build(self._info)
+
+
+# 验证码短信模板
+SMS_CODE_TEMPLATE = 'SMS_186953342'
+# SendSms 每次最多 1000 个号码，SendBatchSms 每次最多 100 个号码
+SEND_SMS_MAX_SIZE = 1000
+SEND_BATCH_SMS_MAX_SIZE = 100
+
 
+def get_sms_api_url():
+    """
+    短信接口地址，测试时可以通过 SMS_API_URL 设置为本地的模拟服务（car.sms_fake）
+    """
+    return getattr(settings, 'SMS_API_URL', 'http://dysmsapi.aliyuncs.com/')
 
-def sms_aliyun_url(mobile='17159866179', template_code='SMS_186953342', para='{"code":"2019"}'):
+
+def get_sign_name():
+    return getattr(settings, 'SMS_SIGN_NAME', '24h车服务')
+
+
+def get_static_params():
+    """
+    短信接口每次请求相同的公共参数
+    """
     form = dict()
     form["SignatureMethod"] = "HMAC-SHA1"
-    form["SignatureNonce"] = str(uuid.uuid1())
     form["AccessKeyId"] = settings.ACCESS_KEY_ID
     form["SignatureVersion"] = "1.0"
-    form['Timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    form['Action'] = "SendSms"
     form['Version'] = "2017-05-25"
     form['RegionId'] = "cn-hangzhou"
-    form['SignName'] = "24h车服务"  # 签名
-    form['TemplateParam'] = para  # 模板替换部分
-    form['PhoneNumbers'] = mobile  # 接受信息的号码
-    form['TemplateCode'] = template_code  # 模板号
-    xx = MsgUrlBuild(form, settings.ACCESS_KEY_SECRET)
-    msm_url = xx.url_build()
+    return form
+
+
+def get_common_params(action):
+    """
+    短信接口每次请求变化的公共参数
+    :param action: 接口名称，SendSms 或 SendBatchSms
+    """
+    form = dict()
+    form["SignatureNonce"] = str(uuid.uuid1())
+    form['Timestamp'] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    form['Action'] = action
+    return form
+
+
+def template_param_value(para):
+    """
+    模板参数转换为 JSON 对象，兼容以前保存的 str(dict) 格式
+    """
+    if isinstance(para, dict):
+        return para
+    try:
+        return json.loads(para)
+    except ValueError:
+        return json.loads(para.replace("'", '"'))
+
+
+class RateLimiter:
+    """
+    令牌桶限流，多个线程共享，每秒最多 rate 次，允许突发 burst 次
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        获取一个令牌，没有令牌时等待
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class SmsResultUnknown(requests.RequestException):
+    """
+    请求已经发出，读取结果时超时或连接中断，不知道短信是否发送成功
+    """
+
+
+class SmsClient:
+    """
+    阿里云短信接口，同一个进程复用 HTTP 连接池，请求设置超时，只有连接失败时按指数退避重试，
+    SendSms 不是幂等的，请求已经发出以后（读取超时、5xx）重试可能重复发送短信
+    多个线程可以共享一个客户端，请求次数按 rate_limit 限流
+    """
+
+    def __init__(self, timeout=None, retries=2, backoff_factor=0.5, pool_maxsize=10, rate_limit=None):
+        """
+        :param timeout: (连接超时, 读取超时)，单位秒，默认为 SMS_TIMEOUT 或 (3, 10)
+        :param retries: 连接失败的重试次数
+        :param backoff_factor: 重试的等待时间为 backoff_factor * 2 ^ (重试次数 - 1) 秒
+        :param pool_maxsize: 连接池大小
+        :param rate_limit: 每秒最多请求次数，默认为 SMS_RATE_LIMIT 或 20，0 为不限制
+        """
+        self.timeout = timeout or getattr(settings, 'SMS_TIMEOUT', (3, 10))
+        if rate_limit is None:
+            rate_limit = getattr(settings, 'SMS_RATE_LIMIT', 20)
+        self.limiter = RateLimiter(rate_limit) if rate_limit else None
+        retry = Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=backoff_factor)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.signer = SmsSigner(settings.ACCESS_KEY_SECRET, get_static_params())
+
+    def request(self, params):
+        """
+        :param params: 接口参数
+        :return: 返回接口结果，发送成功时 Code 为 OK；网络错误时抛出 requests 的异常，
+            请求已经发出以后读取超时或连接中断时抛出 SmsResultUnknown
+        """
+        if self.limiter:
+            self.limiter.acquire()
+        url = self.signer.url_build(params)
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+        except requests.ReadTimeout as e:
+            raise SmsResultUnknown(e, request=e.request)
+        except requests.ConnectionError as e:
+            # 重试次数用完时 urllib3 的错误包装在 MaxRetryError 中
+            reason = getattr(e.args[0], 'reason', None) if e.args else None
+            if isinstance(reason, (ReadTimeoutError, ProtocolError)):
+                raise SmsResultUnknown(e, request=e.request)
+            raise
+        try:
+            return response.json()
+        except ValueError:
+            return {'Code': 'HTTP{0}'.format(response.status_code), 'Message': response.text}
+
+    def send_sms(self, mobiles, template_code, template_param):
+        """
+        向多个号码发送相同内容的短信
+        :param mobiles: 手机号列表，最多 SEND_SMS_MAX_SIZE 个
+        :param template_code: 短信模板
+        :param template_param: 模板参数，dict 或 JSON 字符串
+        """
+        params = get_common_params('SendSms')
+        params['SignName'] = get_sign_name()
+        params['PhoneNumbers'] = ','.join(mobiles)
+        params['TemplateCode'] = template_code
+        params['TemplateParam'] = json.dumps(template_param_value(template_param), ensure_ascii=False)
+        return self.request(params)
+
+    def send_batch_sms(self, mobiles, template_code, template_params):
+        """
+        使用同一个模板向多个号码发送不同内容的短信
+        :param mobiles: 手机号列表，最多 SEND_BATCH_SMS_MAX_SIZE 个
+        :param template_code: 短信模板
+        :param template_params: 与手机号一一对应的模板参数
+        """
+        params = get_common_params('SendBatchSms')
+        params['PhoneNumberJson'] = json.dumps(list(mobiles))
+        params['SignNameJson'] = json.dumps([get_sign_name()] * len(mobiles), ensure_ascii=False)
+        params['TemplateCode'] = template_code
+        params['TemplateParamJson'] = json.dumps(
+            [template_param_value(p) for p in template_params], ensure_ascii=False)
+        return self.request(params)
+
+
+_sms_client = None
+
+
+def get_sms_client():
+    """
+    进程内共享的短信客户端
+    """
+    global _sms_client
+    if _sms_client is None:
+        _sms_client = SmsClient()
+    return _sms_client
+
+
+def sms_aliyun_url(mobile='17159866179', template_code=SMS_CODE_TEMPLATE, para='{"code":"2019"}'):
     try:
-        response = requests.get(msm_url)
-    except ConnectionError:
+        return get_sms_client().send_sms([mobile], template_code, para)
+    except requests.RequestException:
         # TODO return msm send failed message
         return None
-    return response
 
 
 def sms_code(mobile, code):
     paras = dict()
     paras['code'] = code
-    paras = str(paras)
     msg = sms_aliyun_url(mobile=mobile, para=paras)
     return msg
 
@@ -0,0 +1,70 @@
+"""
+本地模拟的阿里云短信接口，用于测试和性能测试，不会真正发送短信
+python3 -m car.sms_fake 8091
+settings.py 中设置 SMS_API_URL = 'http://127.0.0.1:8091/'
+"""
+import json
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeSmsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        params = dict(parse_qsl(urlparse(self.path).query))
+        self.server.requests.append(params)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.fail_count > 0:
+            self.server.fail_count -= 1
+            result = {'Code': 'isv.BUSINESS_LIMIT_CONTROL', 'Message': '触发流控'}
+        else:
+            result = {'Code': 'OK', 'Message': 'OK', 'RequestId': str(uuid.uuid4()), 'BizId': str(uuid.uuid4())}
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeSmsServer(ThreadingMixIn, HTTPServer):
+    """
+    记录收到的请求参数，fail_count 大于 0 时接下来的请求返回失败，delay 为每次请求返回之前的等待时间（秒）
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), FakeSmsHandler)
+        self.requests = list()
+        self.fail_count = 0
+        self.delay = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    server = FakeSmsServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8091)
+    print('Fake SMS server at {0}'.format(server.url))
+    server.serve_forever()
@@ -5,6 +5,8 @@ from django.urls import re_path, include
 
 from rest_framework.documentation import include_docs_urls
 
+from car.middlewares import query_profile_stats_view
+
 
 API_TITLE = 'API Documents'
 API_DESCRIPTION = 'API Information'
@@ -15,6 +17,7 @@ urlpatterns = [
     re_path(r'^page/', include('app.urls', namespace='page')),
     re_path(r'^api-auth/', include('rest_framework.urls')),
     re_path(r'^docs/', include_docs_urls(title=API_TITLE, description=API_DESCRIPTION)),
+    re_path(r'^profile_stats/$', query_profile_stats_view, name='profile_stats'),
 ]
 
 
@@ -2,26 +2,43 @@ import base64
 import binascii
 import datetime
 import hashlib
+import json
+import os
 import re
+import tempfile
+import threading
+import zlib
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
+import openpyxl
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+import pandas as pd
 import rsa
-import xlwt
 
 from django.conf import settings
-from django.http import FileResponse
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from django.utils.functional import cached_property
 
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
-def file_iterator(filename, chuck_size=512):
+def file_iterator(file, chuck_size=64 * 1024):
     """
-    将文件分块返回
-    :param filename: 文件名称
-    :param chuck_size: 块的大小，默认 512
+    将文件分块返回，读取完成以后关闭文件
+    :param file: 文件名称，或者已经打开的文件对象
+    :param chuck_size: 块的大小，默认 64KB
     :return: 文件以可迭代对象的方式分块返回
     """
-    with open(filename, "rb") as f:
+    if isinstance(file, str):
+        file = open(file, 'rb')
+    with file as f:
         while True:
             c = f.read(chuck_size)
             if c:
@@ -30,9 +47,11 @@ def file_iterator(filename, chuck_size=512):
                 break
 
 
-def export_excel(queryset, headers, columns, filename='file_name'):
+def export_excel(queryset, headers, columns, filename='file_name.xlsx', chunk_size=2000):
     """
     通过传递进去的数据构建 Excel 文件，并且以数据流的返回返回文件
+    数据通过 iterator 分批读取，使用 openpyxl 的 write_only 模式逐行写入临时文件，内存占用不随数据量增长，
+    临时文件在返回完成以后自动删除
     :param queryset: 数据列表，通常为筛选后的结果。
     :param headers:
         Excel 的表头，以列表的方式传入。
@@ -40,34 +59,74 @@ def export_excel(queryset, headers, columns, filename='file_name'):
     :param columns:
         数据列的名称，以列表的方式传入。
         例如：['pk', 'customer__name', 'customer__mobile', 'amounts', 'current_amounts']
-    :param filename: 返回文件的文件名，必须以 .xls 为后缀
+    :param filename: 返回文件的文件名，必须以 .xlsx 为后缀
+    :param chunk_size: 每次从数据库读取的条数
     :return:
     """
-    wb = xlwt.Workbook()
-    sheet = wb.add_sheet("data")
-    for i, h in enumerate(headers):
-        sheet.write(0, i, h)
-    cols = 1
-    for query in queryset.values(*columns):
-        for i, k in enumerate(columns):
-            v = query.get(k)
+    wb = openpyxl.Workbook(write_only=True)
+    sheet = wb.create_sheet("data")
+    sheet.append(headers)
+    for query in queryset.values_list(*columns).iterator(chunk_size=chunk_size):
+        row = list()
+        for v in query:
             if isinstance(v, datetime.datetime):
                 v = v.strftime('%Y-%m-%d %H:%M:%S')
-            sheet.write(cols, i, v)
-        cols += 1
-    wb.save(filename)
-    response = FileResponse(file_iterator(filename))
-    response['Content-Type'] = 'application/vnd.ms-excel'
-    response['Content-Disposition'] = 'attachment; filename={0}'.format(filename)
+            elif isinstance(v, str):
+                v = ILLEGAL_CHARACTERS_RE.sub('', v)
+            row.append(v)
+        sheet.append(row)
+    f = tempfile.TemporaryFile()
+    wb.save(f)
+    f.seek(0)
+    response = StreamingHttpResponse(file_iterator(f))
+    response['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    response['Content-Disposition'] = 'attachment; filename={0}'.format(os.path.basename(filename))
     return response
 
 
 class NormalResultsSetPagination(PageNumberPagination):
+    """
+    默认按页码分页；请求中带有 cursor 参数时按 ID 倒序游标分页，不需要 COUNT 和 OFFSET，适用于移动端下拉加载
+    第一页传空的 cursor，之后传上一次返回的 next_cursor，next_cursor 为 null 时表示没有更多数据
+    """
     page_size = 10
     page_size_query_param = 'page_size'
     max_page_size = 20
+    cursor_query_param = 'cursor'
+    cursor_query_description = '游标分页，第一页为空，之后为上一次返回的 next_cursor'
+    invalid_cursor_message = '无效的游标'
+    cursor = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view=view)
+        return self.paginate_queryset_by_cursor(queryset, request)
+
+    def paginate_queryset_by_cursor(self, queryset, request):
+        """
+        按 ID 倒序的游标分页，多取一条数据判断是否还有下一页
+        """
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        self.request = request
+        cursor = request.query_params.get(self.cursor_query_param)
+        self.cursor = {'page_size': page_size, 'next': None}
+        queryset = queryset.order_by('-pk')
+        if cursor:
+            try:
+                queryset = queryset.filter(pk__lt=int(cursor))
+            except ValueError:
+                raise NotFound(self.invalid_cursor_message)
+        results = list(queryset[:page_size + 1])
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.cursor['next'] = str(results[-1].pk)
+        return results
 
     def get_paginated_response(self, data):
+        if self.cursor is not None:
+            return self.get_cursor_paginated_response(data)
         if not self.page.has_next():
             next_page = None
         else:
@@ -84,6 +143,175 @@ class NormalResultsSetPagination(PageNumberPagination):
             'results': data
         })
 
+    def get_cursor_paginated_response(self, data):
+        next_link = None
+        if self.cursor['next'] is not None:
+            next_link = replace_query_param(
+                self.request.build_absolute_uri(), self.cursor_query_param, self.cursor['next'])
+        return Response({
+            'next': next_link,
+            'previous': None,
+            'next_page': None,
+            'next_cursor': self.cursor['next'],
+            'length': len(data),
+            'count': None,
+            'page': None,
+            'num_pages': None,
+            'page_size': self.cursor['page_size'],
+            'results': data
+        })
+
+    def get_schema_fields(self, view):
+        fields = super().get_schema_fields(view)
+        fields.append(
+            coreapi.Field(
+                name=self.cursor_query_param,
+                required=False,
+                location='query',
+                schema=coreschema.String(
+                    title='Cursor',
+                    description=self.cursor_query_description
+                )
+            )
+        )
+        return fields
+
+
+_on_commit_local = threading.local()
+
+
+def defer_on_commit(func, values, using=None):
+    """
+    在当前事务提交以后执行 func(values)，同一个事务中多次调用会合并 values，只执行一次；不在事务中时立即执行
+    :param func: 回调函数，参数为合并以后的 values 集合
+    :param values: 需要处理的数据，必须可以哈希
+    :param using: 数据库别名
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        func(set(values))
+        return
+    pending = getattr(_on_commit_local, 'callbacks', None)
+    if pending is None:
+        pending = _on_commit_local.callbacks = dict()
+    key = (connection.alias, func)
+    callback = pending.get(key)
+    # 事务回滚以后回调会被丢弃，需要重新注册
+    if callback is not None and any(f is callback for sids, f in connection.run_on_commit):
+        callback.values.update(values)
+        return
+
+    def callback():
+        if pending.get(key) is callback:
+            del pending[key]
+        func(callback.values)
+
+    callback.values = set(values)
+    pending[key] = callback
+    transaction.on_commit(callback, using=using)
+
+
+def advisory_lock(name, keys, using=None):
+    """
+    在当前事务中获取 PostgreSQL 的事务级 advisory lock，name 和 key 相同的事务依次执行，事务结束时自动释放
+    多个 key 按顺序加锁，避免死锁；其他数据库不加锁（SQLite 的写操作本身是串行的）
+    :param name: 锁的名称，例如表名
+    :param keys: 整数 key，例如日期的 toordinal()
+    :param using: 数据库别名
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        raise transaction.TransactionManagementError('advisory_lock() 需要在事务中执行')
+    if connection.vendor != 'postgresql':
+        return
+    # pg_advisory_xact_lock(int, int) 的两个参数都是 32 位整数
+    namespace = zlib.crc32(name.encode('utf-8')) & 0x7fffffff
+    with connection.cursor() as cursor:
+        for key in sorted(set(keys)):
+            cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [namespace, key])
+
+
+def approximate_count(queryset):
+    """
+    获取没有筛选条件的数据的估计条数，只支持 PostgreSQL，数据来自 pg_class.reltuples，由 ANALYZE / autovacuum 更新
+    :param queryset: 数据查询
+    :return: 返回估计条数，无法估计时返回 None
+    """
+    query = queryset.query
+    if query.where or query.distinct or query.low_mark or query.high_mark is not None:
+        return None
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+            [getattr(queryset.model, '_meta').db_table])
+        row = cursor.fetchone()
+    if row is None or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+def explain_count(queryset):
+    """
+    获取有筛选条件的数据的估计条数，只支持 PostgreSQL，数据来自查询计划的估计行数
+    :param queryset: 数据查询
+    :return: 返回估计条数，无法估计时返回 None
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) {0}'.format(sql), params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    try:
+        return int(plan[0]['Plan']['Plan Rows'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+# 数据条数超过该值时使用数据库的估计条数
+APPROXIMATE_COUNT_THRESHOLD = 10000
+
+
+def estimate_count(queryset, threshold=APPROXIMATE_COUNT_THRESHOLD):
+    """
+    获取大表的数据条数，先执行一次最多统计 threshold + 1 条的 COUNT，不超过阈值时是准确条数，
+    超过阈值时使用数据库的估计条数（approximate_count 或 explain_count），无法估计时再执行完整的 COUNT
+    :param queryset: 数据查询
+    :param threshold: 准确统计的最大条数
+    :return: 返回数据条数
+    """
+    count = queryset.order_by()[:threshold + 1].count()
+    if count <= threshold:
+        return count
+    estimate = approximate_count(queryset)
+    if estimate is None:
+        estimate = explain_count(queryset)
+    if estimate is None:
+        return queryset.count()
+    return max(estimate, count)
+
+
+class ApproximateCountPaginator(Paginator):
+    """
+    大表的分页器，条数通过 estimate_count 获取，超过 count_threshold 时使用数据库的估计条数
+    """
+
+    def __init__(self, *args, count_threshold=APPROXIMATE_COUNT_THRESHOLD, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count_threshold = count_threshold
+
+    @cached_property
+    def count(self):
+        if not isinstance(self.object_list, QuerySet):
+            return len(self.object_list)
+        return estimate_count(self.object_list, self.count_threshold)
+
 
 def generate_keys():
     """
@@ -173,6 +401,20 @@ def num_value(num, decimal_places=4):
     return res
 
 
+def decimal_value(num, decimal_places=2):
+    """
+    金额数据的处理，统一转换为 Decimal，避免浮点数累加的误差
+    :param num: 数字数据
+    :param decimal_places: 小数点的位数
+    :return: 返回处理后的数据，无法转换时返回 None
+    """
+    try:
+        res = Decimal(str(num)).quantize(Decimal(1).scaleb(-decimal_places), rounding=ROUND_HALF_UP)
+    except (InvalidOperation, ValueError, TypeError):
+        res = None
+    return res
+
+
 def date_value(ori_date):
     """
     日期数据的处理
@@ -195,3 +437,61 @@ def date_value(ori_date):
         print(ori_date)
     return res
 
+
+def str_series(series, upper=False):
+    """
+    文本列的处理，与 str_value 相同，对整列数据一次完成
+    :param series: pandas 数据列
+    :param upper: 是否要大写
+    :return: 返回格式化后的数据列，空文本为 None
+    """
+    res = series.astype(str).str.replace(' ', '', regex=False)
+    if upper is True:
+        res = res.str.upper()
+    return res.astype(object).where(res != '', None)
+
+
+def num_series(series, decimal_places=4):
+    """
+    数字列的处理，与 num_value 相同，对整列数据一次完成
+    :param series: pandas 数据列
+    :param decimal_places: 小数点的位数
+    :return: 返回处理后的数据列，无法转换的数据为 None
+    """
+    res = pd.to_numeric(series, errors='coerce').round(decimal_places)
+    return res.astype(object).where(res.notna(), None)
+
+
+def date_series(series):
+    """
+    日期列的处理，与 date_value 相同，对整列数据一次完成
+    :param series: pandas 数据列
+    :return: 返回处理后的数据列，元素为 datetime.date，无法转换的数据为 None
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        res = series
+    else:
+        # 只有文本和 datetime 可以转换为日期，数字（例如 Excel 的日期序列号）等其他数据为 None
+        is_str = series.map(lambda v: isinstance(v, str)).astype(bool)
+        is_datetime = series.map(lambda v: isinstance(v, datetime.datetime)).astype(bool)
+        str_dates = pd.to_datetime(
+            series[is_str].astype(str).str.replace(r'[./]', '-', regex=True), format='%Y-%m-%d', errors='coerce')
+        datetimes = pd.to_datetime(series[is_datetime].astype(object), errors='coerce')
+        res = pd.concat([str_dates, datetimes]).reindex(series.index)
+    return res.dt.date.astype(object).where(res.notna(), None)
+
+
+def bulk_create(model, objs, batch_size=1000):
+    """
+    按批写入数据，Django 2.2 中指定 batch_size 以后不再受数据库单条语句参数个数的限制，这里取两者中较小的值
+    :param model: 数据模型
+    :param objs: 数据对象
+    :param batch_size: 每次写入的条数
+    :return: 返回写入的数据对象
+    """
+    objs = list(objs)
+    if not objs:
+        return objs
+    fields = getattr(model, '_meta').concrete_fields
+    max_batch_size = connections[model.objects.db].ops.bulk_batch_size(fields, objs)
+    return model.objects.bulk_create(objs, batch_size=max(min(batch_size, max_batch_size), 1))
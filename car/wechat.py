@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.conf import settings
+
+
+logger = logging.getLogger('django')
+
+
+class WeChatError(Exception):
+    """
+    微信接口返回 errcode
+    """
+
+    def __init__(self, errcode, errmsg=None):
+        super().__init__('{0}: {1}'.format(errcode, errmsg))
+        self.errcode = errcode
+        self.errmsg = errmsg
+
+
+class WeChatUnavailable(WeChatError):
+    """
+    微信接口超时、连接失败、返回 5xx 或者熔断器打开
+    """
+
+    def __init__(self, errmsg=None):
+        super().__init__(None, errmsg)
+
+
+class CircuitBreaker:
+    """
+    熔断器，多个线程共享
+    连续失败 failure_threshold 次以后打开，recovery_timeout 秒内的请求直接失败，不再等待超时；
+    之后放行一个试探请求，成功时关闭，失败时重新打开
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30):
+        """
+        :param failure_threshold: 连续失败的次数
+        :param recovery_timeout: 打开的时间，单位秒
+        """
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        :return: 是否可以发送请求
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.monotonic() - self.opened_at < self.recovery_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.probing:
+                    logger.warning('WeChat circuit opened after {0} failures'.format(self.failures))
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+def get_wechat_api_url():
+    """
+    微信接口地址，测试时可以通过 WX_API_URL 设置为本地的模拟服务（car.wechat_fake）
+    """
+    return getattr(settings, 'WX_API_URL', 'https://api.weixin.qq.com/')
+
+
+class WeChatClient:
+    """
+    微信登录接口，同一个进程复用 HTTPS 连接池，请求设置超时，连接失败时重试一次
+    超时、连接失败和 5xx 计入熔断器，微信接口不可用时登录请求立即返回，不会占满 uWSGI 的工作进程
+    """
+
+    def __init__(self, api_url=None, timeout=None, retries=1, pool_maxsize=10,
+                 failure_threshold=None, recovery_timeout=None):
+        """
+        :param api_url: 接口地址，默认为 get_wechat_api_url()
+        :param timeout: (连接超时, 读取超时)，单位秒，默认为 WX_TIMEOUT 或 (2, 5)
+        :param retries: 连接失败的重试次数，读取超时不重试
+        :param pool_maxsize: 连接池大小
+        :param failure_threshold: 熔断的连续失败次数，默认为 WX_CIRCUIT_FAILURES 或 5
+        :param recovery_timeout: 熔断的时间，默认为 WX_CIRCUIT_SECONDS 或 30 秒
+        """
+        self.api_url = api_url or get_wechat_api_url()
+        self.timeout = timeout or getattr(settings, 'WX_TIMEOUT', (2, 5))
+        self.breaker = CircuitBreaker(
+            failure_threshold or getattr(settings, 'WX_CIRCUIT_FAILURES', 5),
+            recovery_timeout or getattr(settings, 'WX_CIRCUIT_SECONDS', 30))
+        retry = Retry(total=retries, connect=retries, read=0, status=0, backoff_factor=0.2)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request(self, path, params):
+        """
+        :param path: 接口路径，例如 sns/jscode2session
+        :param params: 查询参数
+        :return: 返回接口结果；errcode 不为 0 时抛出 WeChatError，不可用时抛出 WeChatUnavailable
+        """
+        if not self.breaker.allow():
+            raise WeChatUnavailable('circuit open')
+        try:
+            response = self.session.get(self.api_url + path, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            logger.warning('WeChat {0} failed: {1}'.format(path, e))
+            raise WeChatUnavailable(str(e))
+        except Exception:
+            # 其他异常也计入失败，否则试探请求一直没有结束，熔断器不会再关闭
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise WeChatUnavailable('HTTP{0}'.format(response.status_code))
+        self.breaker.record_success()
+        # 微信接口的 Content-Type 没有 charset，requests 会按 ISO-8859-1 解码，这里直接按 UTF-8 解码
+        try:
+            data = json.loads(response.content.decode('utf-8'))
+        except ValueError:
+            raise WeChatError('HTTP{0}'.format(response.status_code), response.text)
+        if data.get('errcode'):
+            raise WeChatError(data.get('errcode'), data.get('errmsg'))
+        return data
+
+    def jscode2session(self, code):
+        """
+        小程序登录，通过 code 获取 openid
+        :param code: 小程序获取的 code
+        :return: 返回 {"openid": "", "session_key": "", "unionid": ""}
+        """
+        return self.request('sns/jscode2session', {
+            'appid': settings.WX_APP_ID,
+            'secret': settings.WX_APP_SECRET,
+            'js_code': code,
+            'grant_type': 'authorization_code',
+        })
+
+    def oauth2_access_token(self, code):
+        """
+        公众号网页授权，通过 code 获取 access_token
+        :param code: 前端获取的 code
+        :return: 返回 {"access_token":"","expires_in":7200,"refresh_token":"","openid":"","scope":"snsapi_userinfo"}
+        """
+        return self.request('sns/oauth2/access_token', {
+            'appid': settings.WX_GZH_APP_ID,
+            'secret': settings.WX_GZH_APP_SECRET,
+            'code': code,
+            'grant_type': 'authorization_code',
+        })
+
+    def oauth2_user_info(self, access_token, openid):
+        """
+        公众号网页授权，获取用户信息
+        :param access_token: 网页授权的 access_token
+        :param openid: 公众号的 openid
+        :return: 返回 {"openid":"","nickname":"","sex":1,"province":"","city":"","country":"","headimgurl":""}
+        """
+        return self.request('sns/userinfo', {'access_token': access_token, 'openid': openid, 'lang': 'zh_CN'})
+
+
+_wechat_client = None
+_wechat_client_lock = threading.Lock()
+
+
+def get_wechat_client():
+    """
+    进程内共享的微信客户端，熔断状态也在进程内共享
+    """
+    global _wechat_client
+    if _wechat_client is None:
+        with _wechat_client_lock:
+            if _wechat_client is None:
+                _wechat_client = WeChatClient()
+    return _wechat_client
@@ -0,0 +1,93 @@
+"""
+本地模拟的微信登录接口，用于测试和性能测试
+python3 -m car.wechat_fake 8092
+settings.py 中设置 WX_API_URL = 'http://127.0.0.1:8092/'
+code 为 invalid 时返回 errcode 40029，openid 为 "o" + code
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlparse
+
+
+class FakeWeChatHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        self.server.requests.append((url.path, params))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.server.fail_count > 0:
+            self.server.fail_count -= 1
+            return self.reply(503, {'errcode': -1, 'errmsg': 'system error'})
+        code = params.get('js_code') or params.get('code')
+        if code == 'invalid':
+            result = {'errcode': 40029, 'errmsg': 'invalid code'}
+        elif url.path == '/sns/jscode2session':
+            result = {'openid': 'o' + code, 'session_key': 'session-' + code}
+        elif url.path == '/sns/oauth2/access_token':
+            result = {
+                'access_token': 'token-' + code, 'expires_in': 7200, 'refresh_token': 'refresh-' + code,
+                'openid': 'o' + code, 'scope': 'snsapi_userinfo'}
+        elif url.path == '/sns/userinfo':
+            result = {
+                'openid': params.get('openid'), 'nickname': '微信用户', 'sex': 1, 'language': 'zh_CN',
+                'city': '杭州', 'province': '浙江', 'country': '中国', 'headimgurl': '', 'privilege': []}
+        else:
+            return self.reply(404, {'errcode': 404, 'errmsg': 'not found'})
+        self.reply(200, result)
+
+    def reply(self, status, result):
+        body = json.dumps(result, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        # 和微信接口一样，Content-Type 没有 charset
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeWeChatServer(ThreadingMixIn, HTTPServer):
+    """
+    记录收到的请求 (路径, 参数)，delay 为每个请求的延迟秒数，fail_count 大于 0 时接下来的请求返回 503
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), FakeWeChatHandler)
+        self.requests = list()
+        self.delay = 0
+        self.fail_count = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # 客户端读取超时以后已经关闭连接，写入响应失败时不打印异常
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+if __name__ == '__main__':
+    server = FakeWeChatServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8092)
+    print('Fake WeChat server at {0}'.format(server.url))
+    server.serve_forever()